@@ -6,6 +6,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import sqlite3
 from datetime import datetime
+from time_rolling import time_rolling
 
 class RunningAnalysis:
     def __init__(self, db_path):
@@ -69,6 +70,31 @@ class RunningAnalysis:
             print(f"Error saving training log to database: {e}")
             
             
+    def load_threshold_hr(self, hrv_db_path='e:/jheel_dev/DataBasesDev/artemis_hrv.db'):
+        """Add the DFA alpha1 threshold heart rates of each run day (hrv_dfa.py, HRV database) to the training log"""
+        try:
+            conn = sqlite3.connect(hrv_db_path)
+            thresholds = pd.read_sql_query("""
+            SELECT DATE(start_time) AS day,
+                   AVG(hrvt1_hr) AS hrvt1_hr,
+                   AVG(hrvt2_hr) AS hrvt2_hr
+            FROM hrv_dfa_thresholds
+            WHERE hrvt1_hr IS NOT NULL
+            GROUP BY DATE(start_time)
+            """, conn)
+            conn.close()
+            
+            days = pd.to_datetime(self.training_log['date']).dt.strftime('%Y-%m-%d')
+            self.training_log = (
+                self.training_log.drop(columns=['hrvt1_hr', 'hrvt2_hr'], errors='ignore')
+                .assign(day=days)
+                .merge(thresholds, on='day', how='left')
+                .drop(columns='day')
+            )
+        except Exception as e:
+            print(f"Error loading threshold heart rates: {e}")
+            
+            
     # Create a new method called create_metrics_breakdown_table to create a new table in the database to store the metrics breakdown data.        
     def create_metrics_breakdown_table(self):
         """Create metrics_breakdown table if it doesn't exist"""
@@ -261,11 +287,14 @@ class RunningAnalysis:
         plt.ylabel('Total Distance (km)')
         plt.xticks(rotation=45)
         
-        # 2. Moving Average of Running Economy
+        # 2. Moving Average of Running Economy - over the sessions of the last 7 calendar days
         plt.subplot(2, 3, 2)
-        self.training_log['running_economy_ma'] = self.training_log['running_economy'].rolling(window=3).mean()
+        self.training_log['date'] = pd.to_datetime(self.training_log['date'])
+        self.training_log['running_economy_ma'] = time_rolling(
+            self.training_log['date'], self.training_log['running_economy'], windows=('7D',)
+        )['running_economy_7D_mean']
         plt.plot(self.training_log['date'], self.training_log['running_economy'], 'g-', label='Original')
-        plt.plot(self.training_log['date'], self.training_log['running_economy_ma'], 'r-', label='3-Session Moving Avg')
+        plt.plot(self.training_log['date'], self.training_log['running_economy_ma'], 'r-', label='7-Day Moving Avg')
         plt.title('Running Economy Trend')
         plt.xlabel('Date')
         plt.ylabel('Running Economy')
@@ -452,6 +481,9 @@ def main():
             heart_rate=150
         )
         
+    # Aerobic / anaerobic threshold heart rate from DFA alpha1, next to the running economy data
+    analysis.load_threshold_hr()
+    
     # Create metrics_breakdown table
     analysis.create_metrics_breakdown_table()
     
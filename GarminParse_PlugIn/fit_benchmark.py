@@ -0,0 +1,408 @@
+"""Reproducible FIT ingestion benchmark with a synthetic activity generator.
+
+Generates a folder of synthetic activities with fit_tool - file_id, the fbb
+HRV developer data id and field descriptions, ``record`` messages carrying the
+beat-to-beat developer fields and one ``session`` message carrying the jHeel /
+HRV summary fields - then times every ingestion stage on it separately:
+
+* decode       - fitparse, the session-only reader, the FIT cache (cold and warm)
+* mapping      - artemis_mapping on the decoded session messages
+* db_write     - insert_data_into_db and bulk_insert_data_into_db into a fresh DB
+* end to end   - jHeel v5.0 parse_all_fit_files_in_folder + insert, and
+                 HRVProcessor.process_fit_file (HRVAnalyzer v2.0) per file, through
+                 the FIT cache and in streaming mode
+
+Each stage is run ``--repeat`` times for timing and once more under
+tracemalloc for peak memory, so the timings are not slowed by tracing.
+records/s is measured against the record messages in the input files; it is
+left empty for the stages that only touch sessions.
+
+Results are printed as a table and written as JSON (``--output``).  Passing an
+earlier JSON file with ``--compare`` flags every stage that got slower than
+``--tolerance`` and exits with status 1, so the benchmark can gate a change.
+
+    python fit_benchmark.py --files 20 --records 3600 --output bench.json
+    python fit_benchmark.py --files 20 --records 3600 --compare bench.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from fit_tool.base_type import BaseType
+from fit_tool.developer_field import DeveloperField
+from fit_tool.fit_file_builder import FitFileBuilder
+from fit_tool.profile.messages.developer_data_id_message import DeveloperDataIdMessage
+from fit_tool.profile.messages.field_description_message import FieldDescriptionMessage
+from fit_tool.profile.messages.file_id_message import FileIdMessage
+from fit_tool.profile.messages.record_message import RecordMessage
+from fit_tool.profile.messages.session_message import SessionMessage
+from fit_tool.profile.profile_type import FileType, Manufacturer, Sport
+
+from fit_dispatcher import load_script
+
+
+logger = logging.getLogger(__file__)
+
+
+BENCHMARK_VERSION = 1
+
+_here = os.path.dirname(os.path.abspath(__file__))
+JHEEL_SCRIPT = os.path.join(_here, 'jHeel_plugin v5.0.py')
+HRV_ANALYZER_SCRIPT = os.path.join(_here, '..', 'Mercury_HRV', 'HRVAnalyzer', 'HRVAnalyzer_v2.0.py')
+
+# application id of fbbbrown's Heart Monitor + HRV app (HRVProcessor._application_id)
+FBB_HRV_APPLICATION_ID = bytes(b'\x0b\xdc\x0eu\x9b\xaaAz\x8c\x9f\xe9vf*].')
+
+# developer fields written on every record message: (name, base type, units)
+RECORD_DEV_FIELDS = [
+    ('hrv_s', BaseType.UINT16, 'ms'),
+    ('hrv_btb', BaseType.UINT16, 'ms'),
+    ('hrv_hr', BaseType.UINT8, 'bpm'),
+    ('RRint', BaseType.UINT16, 'ms'),
+    ('rmssd', BaseType.UINT16, 'ms'),
+    ('sdnn', BaseType.UINT16, 'ms'),
+    ('stress_hrp', BaseType.UINT8, '%'),
+]
+
+# developer fields written on the session message
+SESSION_DEV_FIELDS = [
+    ('hrv_rmssd', BaseType.UINT16, 'ms'),
+    ('hrv_sdrr_f', BaseType.UINT16, 'ms'),
+    ('hrv_sdrr_l', BaseType.UINT16, 'ms'),
+    ('hrv_pnn50', BaseType.UINT8, '%'),
+    ('hrv_pnn20', BaseType.UINT8, '%'),
+    ('stress_hrpa', BaseType.UINT8, '%'),
+    ('RMSSD', BaseType.UINT16, 'ms'),
+    ('SDNN', BaseType.UINT16, 'ms'),
+    ('SD1', BaseType.UINT16, 'ms'),
+    ('SD2', BaseType.UINT16, 'ms'),
+    ('pNN50', BaseType.UINT8, '%'),
+    ('Mean HR', BaseType.UINT8, 'bpm'),
+    ('Mean RR', BaseType.UINT16, 'ms'),
+    ('VO2maxSmooth', BaseType.UINT8, 'ml/kg/min'),
+    ('VO2maxSession', BaseType.UINT8, 'ml/kg/min'),
+]
+
+_BASE_TYPE_SIZE = {BaseType.UINT8: 1, BaseType.UINT16: 2}
+
+
+# Synthetic activity generator
+
+def _developer_field(field_id, base_type, value):
+    field = DeveloperField(developer_data_index=0, field_id=field_id, size=_BASE_TYPE_SIZE[base_type],
+                           base_type=base_type)
+    field.set_value(0, value)
+    return field
+
+
+def write_synthetic_activity(file_path, activity_index, n_records, seed=0):
+    """Write one synthetic fbb HRV activity with n_records one-second records and one session."""
+    rng = random.Random(seed * 1000003 + activity_index)
+    start = datetime.datetime(2025, 1, 1, 6, 0, 0) + datetime.timedelta(days=activity_index)
+    start_ms = round(start.timestamp() * 1000)
+
+    builder = FitFileBuilder(auto_define=True, min_string_size=50)
+
+    message = FileIdMessage()
+    message.type = FileType.ACTIVITY
+    message.manufacturer = Manufacturer.DEVELOPMENT.value
+    message.product = 1
+    message.time_created = start_ms
+    message.serial_number = 0x12345678
+    builder.add(message)
+
+    message = DeveloperDataIdMessage()
+    message.application_id = FBB_HRV_APPLICATION_ID
+    message.developer_data_index = 0
+    builder.add(message)
+
+    for field_id, (name, base_type, units) in enumerate(RECORD_DEV_FIELDS + SESSION_DEV_FIELDS):
+        message = FieldDescriptionMessage()
+        message.developer_data_index = 0
+        message.field_definition_number = field_id
+        message.fit_base_type_id = base_type
+        message.field_name = name
+        message.units = units
+        builder.add(message)
+
+    session_field_ids = range(len(RECORD_DEV_FIELDS), len(RECORD_DEV_FIELDS) + len(SESSION_DEV_FIELDS))
+
+    rr_intervals = []
+    distance = 0.0
+    records = []
+    for i in range(n_records):
+        heart_rate = max(40, min(200, round(140 + 15 * rng.gauss(0, 1))))
+        rr = round(60000 / heart_rate + rng.gauss(0, 25))
+        rr_intervals.append(rr)
+        distance += 3.0 + rng.random()
+
+        values = [rr, rr, heart_rate, rr, rng.randint(10, 80), rng.randint(20, 90), rng.randint(0, 100)]
+        message = RecordMessage(developer_fields=[
+            _developer_field(field_id, base_type, value)
+            for field_id, ((_, base_type, _), value) in enumerate(zip(RECORD_DEV_FIELDS, values))])
+        message.timestamp = start_ms + i * 1000
+        message.heart_rate = heart_rate
+        message.distance = distance
+        records.append(message)
+    builder.add_all(records)
+
+    mean_rr = round(sum(rr_intervals) / len(rr_intervals)) if rr_intervals else 0
+    values = [rng.randint(10, 80) for _ in SESSION_DEV_FIELDS]
+    values[SESSION_DEV_FIELDS.index(('Mean RR', BaseType.UINT16, 'ms'))] = mean_rr
+    message = SessionMessage(developer_fields=[
+        _developer_field(field_id, base_type, value)
+        for field_id, (_, base_type, _), value in zip(session_field_ids, SESSION_DEV_FIELDS, values)])
+    message.timestamp = start_ms + n_records * 1000
+    message.start_time = start_ms
+    message.sport = Sport.RUNNING
+    message.total_elapsed_time = float(n_records)
+    message.total_distance = distance
+    message.avg_heart_rate = round(60000 / mean_rr) if mean_rr else 0
+    builder.add(message)
+
+    builder.build().to_file(file_path)
+
+
+def generate_activities(folder_path, n_files, n_records, seed=0):
+    """Fill folder_path with n_files synthetic activities named like Garmin exports (<activity_id>_ACTIVITY.fit)."""
+    os.makedirs(folder_path, exist_ok=True)
+    fit_files = []
+    for i in range(n_files):
+        file_path = os.path.join(folder_path, f'{10000000 + i}_ACTIVITY.fit')
+        write_synthetic_activity(file_path, i, n_records, seed)
+        fit_files.append(file_path)
+    return fit_files
+
+
+# Stage runner - best-of-N timing, then one extra run under tracemalloc for the peak
+
+def run_stage(name, func, files, records, repeat=3, setup=None):
+    timings = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        timings.append(time.perf_counter() - start)
+
+    if setup is not None:
+        setup()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    best = min(timings)
+    result = {
+        'stage': name,
+        'files': files,
+        'records': records,
+        'best_s': round(best, 6),
+        'mean_s': round(sum(timings) / len(timings), 6),
+        'files_per_s': round(files / best, 2) if files and best > 0 else None,
+        'records_per_s': round(records / best, 1) if records and best > 0 else None,
+        'peak_mb': round(peak / 2 ** 20, 3),
+    }
+    logger.info("%s: %.3fs", name, best)
+    return result
+
+
+def run_benchmark(n_files=20, n_records=3600, repeat=3, seed=0, work_dir=None, keep=False):
+    work_dir = work_dir or tempfile.mkdtemp(prefix='fit_benchmark_')
+    fit_dir = os.path.join(work_dir, 'activities')
+    db_path = os.path.join(work_dir, 'bench.db')
+    cache_dir = os.path.join(work_dir, 'fit_cache')
+
+    try:
+        start = time.perf_counter()
+        fit_files = generate_activities(fit_dir, n_files, n_records, seed)
+        generate_s = time.perf_counter() - start
+        total_records = n_files * n_records
+        total_bytes = sum(os.path.getsize(path) for path in fit_files)
+
+        # the scripts are imported as they are; their ingestion targets are pointed at the work folder
+        with contextlib.redirect_stdout(io.StringIO()):
+            jheel = load_script(JHEEL_SCRIPT)
+            hrv_analyzer = load_script(HRV_ANALYZER_SCRIPT)
+        import fit_cache
+        from fit_session_reader import read_sessions
+        from fitparse import FitFile
+        logging.getLogger().setLevel(logging.WARNING)
+        jheel.database_path = db_path
+
+        def fresh_db():
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+        def fresh_jheel_db():
+            fresh_db()
+            jheel.create_table_if_not_exists()
+
+        def fresh_cache():
+            shutil.rmtree(cache_dir, ignore_errors=True)
+            fit_cache._default_cache = fit_cache.FitCache(cache_dir)
+
+        def activity_id(file_path):
+            return os.path.basename(file_path).split('_')[0]
+
+        # inputs of the mapping and write stages, decoded once up front
+        session_messages = []
+        for file_path in fit_files:
+            session_messages.extend((activity_id(file_path), msg)
+                                    for msg in FitFile(file_path).get_messages('session'))
+        session_rows = [jheel.artemis_mapping.extract_message(key, msg) for key, msg in session_messages]
+        n_sessions = len(session_rows)
+
+        def decode_fitparse():
+            for file_path in fit_files:
+                for msg in FitFile(file_path).get_messages():
+                    {field.name: field.value for field in msg.fields}
+
+        def decode_session_reader():
+            for file_path in fit_files:
+                list(read_sessions(file_path))
+
+        def decode_cache():
+            cache = fit_cache._default_cache
+            for file_path in fit_files:
+                decoded = cache.get(file_path)
+                for _ in decoded.messages('record'):
+                    pass
+
+        def mapping():
+            for key, msg in session_messages:
+                jheel.artemis_mapping.extract_message(key, msg)
+
+        def parse_all_and_insert():
+            jheel.insert_data_into_db(jheel.parse_all_fit_files_in_folder(fit_dir))
+
+        def process_fit_files(streaming=False):
+            processor = hrv_analyzer.HRVProcessor(db_path=db_path, streaming=streaming)
+            for file_path in fit_files:
+                processor.process_fit_file(file_path)
+
+        def warm_cache():
+            fresh_db()
+            if not os.path.isdir(cache_dir):
+                fresh_cache()
+                decode_cache()
+
+        stages = [
+            run_stage('decode_fitparse', decode_fitparse, n_files, total_records, repeat),
+            # skips the record payloads - no records/s, compare its files/s with decode_fitparse
+            run_stage('decode_session_reader', decode_session_reader, n_files, 0, repeat),
+            run_stage('decode_cache_cold', decode_cache, n_files, total_records, repeat, setup=fresh_cache),
+            run_stage('decode_cache_warm', decode_cache, n_files, total_records, repeat),
+            run_stage('mapping_sessions', mapping, n_files, 0, repeat),
+            run_stage('db_write_insert', lambda: jheel.insert_data_into_db(session_rows), n_files, 0, repeat,
+                      setup=fresh_jheel_db),
+            run_stage('db_write_bulk', lambda: jheel.bulk_insert_data_into_db(session_rows), n_files, 0, repeat,
+                      setup=fresh_jheel_db),
+            run_stage('e2e_parse_all_fit_files_in_folder', parse_all_and_insert, n_files, total_records, repeat,
+                      setup=fresh_jheel_db),
+            run_stage('e2e_process_fit_file_cold', process_fit_files, n_files, total_records, repeat,
+                      setup=lambda: (fresh_db(), fresh_cache())),
+            run_stage('e2e_process_fit_file_warm', process_fit_files, n_files, total_records, repeat,
+                      setup=warm_cache),
+            run_stage('e2e_process_fit_file_streaming', lambda: process_fit_files(streaming=True), n_files,
+                      total_records, repeat, setup=fresh_db),
+        ]
+
+        return {
+            'benchmark': 'fit_ingestion',
+            'version': BENCHMARK_VERSION,
+            'created': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'params': {'files': n_files, 'records_per_file': n_records, 'repeat': repeat, 'seed': seed},
+            'input': {'records': total_records, 'sessions': n_sessions, 'bytes': total_bytes,
+                      'generate_s': round(generate_s, 3)},
+            'stages': stages,
+        }
+    finally:
+        if not keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Regression check against an earlier result file - compares best_s stage by stage
+
+def compare_results(results, baseline, tolerance=0.15):
+    baseline_stages = {stage['stage']: stage for stage in baseline.get('stages', [])}
+    if baseline.get('params') != results['params']:
+        logger.warning("Baseline was run with different parameters: %s", baseline.get('params'))
+
+    regressions = []
+    for stage in results['stages']:
+        previous = baseline_stages.get(stage['stage'])
+        if previous is None or not previous['best_s']:
+            continue
+        change = stage['best_s'] / previous['best_s'] - 1
+        stage['change_vs_baseline'] = round(change, 4)
+        if change > tolerance:
+            regressions.append((stage['stage'], previous['best_s'], stage['best_s'], change))
+    return regressions
+
+
+def print_results(results):
+    print(f"FIT ingestion benchmark - {results['params']['files']} files x "
+          f"{results['params']['records_per_file']} records ({results['input']['bytes'] / 2 ** 20:.1f} MB)")
+    print(f"{'stage':<36}{'best s':>10}{'files/s':>10}{'records/s':>12}{'peak MB':>10}{'vs base':>9}")
+    for stage in results['stages']:
+        change = stage.get('change_vs_baseline')
+        print(f"{stage['stage']:<36}{stage['best_s']:>10.3f}"
+              f"{stage['files_per_s'] if stage['files_per_s'] is not None else '-':>10}"
+              f"{stage['records_per_s'] if stage['records_per_s'] is not None else '-':>12}"
+              f"{stage['peak_mb']:>10.2f}"
+              f"{f'{change:+.1%}' if change is not None else '':>9}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the FIT ingestion stages on synthetic activities.')
+    parser.add_argument('--files', type=int, default=20, help='number of synthetic activities')
+    parser.add_argument('--records', type=int, default=3600, help='record messages per activity (1 per second)')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage, the best one is reported')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic data')
+    parser.add_argument('--work-dir', help='folder for the generated files and databases (default: a temp folder)')
+    parser.add_argument('--keep', action='store_true', help='keep the generated files and databases')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--compare', help='earlier JSON results to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.15, help='allowed slowdown before a stage is flagged')
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.files, args.records, args.repeat, args.seed, args.work_dir, args.keep)
+
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare_results(results, json.load(f), args.tolerance)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results written to {args.output}')
+
+    for name, before, after, change in regressions:
+        print(f'REGRESSION {name}: {before:.3f}s -> {after:.3f}s ({change:+.1%})')
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
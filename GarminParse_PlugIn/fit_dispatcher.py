@@ -0,0 +1,148 @@
+"""Single-pass FIT dispatcher - decode each file once and fan its messages out to consumers.
+
+The jHeel field extractor, the fbb HRV record/session writer and the RunAnal
+session extractor used to scan the activity folder one after another, each
+decoding every file again.  Each of those scripts now exposes
+``fit_consumers()``; the dispatcher decodes a file once (through the shared
+FIT cache), walks every message type once and hands each message to all
+consumers registered for that type.  Consumers turn messages into rows and get
+them back in batches through their ``write_batch`` callback.
+
+Run this module directly to feed all plugin scripts from one folder scan.
+"""
+
+import importlib.util
+import logging
+import os
+import re
+import sys
+import time
+
+from fit_cache import get_decoded_fit
+
+
+logger = logging.getLogger(__file__)
+
+
+class FitConsumer:
+    """A message-type filter, a message -> row function and a batch-write callback."""
+
+    def __init__(self, name, message_types, on_message, write_batch, batch_size=1000, setup=None):
+        # on_message(activity_id, fields, index) returns the row to write, or None to skip the message;
+        # index counts the messages of that type within the file
+        self.name = name
+        self.message_types = tuple(message_types)
+        self.on_message = on_message
+        self.write_batch = write_batch
+        self.batch_size = batch_size
+        self.setup = setup
+        self.rows = []
+        self.rows_written = 0
+
+    def accept(self, activity_id, fields, index):
+        row = self.on_message(activity_id, fields, index)
+        if row is not None:
+            self.rows.append(row)
+            # after a failed write the rows stay buffered - the next attempt is one batch later
+            if len(self.rows) % self.batch_size == 0:
+                self.flush()
+
+    def flush(self):
+        """Write the buffered rows; on a write error they are kept for the next flush and False is returned."""
+        if not self.rows:
+            return True
+        try:
+            self.write_batch(self.rows)
+        except Exception as e:
+            logger.error("Error writing %d rows for consumer %s: %s", len(self.rows), self.name, e)
+            return False
+        self.rows_written += len(self.rows)
+        self.rows = []
+        return True
+
+
+class FitDispatcher:
+    """Decode every FIT file once and dispatch its messages to the registered consumers."""
+
+    def __init__(self, decode=get_decoded_fit):
+        self.decode = decode
+        self.consumers = []
+
+    def register(self, consumer):
+        self.consumers.append(consumer)
+        if consumer.setup is not None:
+            consumer.setup()
+        logger.info("Registered consumer %s for %s", consumer.name, ', '.join(consumer.message_types))
+
+    def dispatch_file(self, fit_file_path, activity_id):
+        decoded_fit = self.decode(fit_file_path)
+        message_types = []
+        for consumer in self.consumers:
+            for message_type in consumer.message_types:
+                if message_type not in message_types:
+                    message_types.append(message_type)
+
+        for message_type in message_types:
+            interested = [consumer for consumer in self.consumers if message_type in consumer.message_types]
+            for index, fields in enumerate(decoded_fit.messages(message_type)):
+                for consumer in interested:
+                    consumer.accept(activity_id, fields, index)
+
+    def dispatch_folder(self, folder_path):
+        start = time.perf_counter()
+        files = 0
+        for filename in os.listdir(folder_path):
+            if not filename.endswith('.fit'):
+                continue
+            activity_id = os.path.splitext(filename)[0].split('_')[0]  # Get everything before '_' character
+            try:
+                self.dispatch_file(os.path.join(folder_path, filename), activity_id)
+                files += 1
+            except Exception as e:
+                logger.error("Error dispatching file %s: %s", filename, e)
+        self.flush()
+
+        elapsed = time.perf_counter() - start
+        logger.info("Dispatched %d files in %.1fs", files, elapsed)
+        for consumer in self.consumers:
+            logger.info("Consumer %s wrote %d rows", consumer.name, consumer.rows_written)
+        return files
+
+    def flush(self):
+        for consumer in self.consumers:
+            if not consumer.flush():
+                logger.error("Consumer %s has %d unwritten rows", consumer.name, len(consumer.rows))
+
+
+def load_script(script_path):
+    """Import a jHeel script by path - the names contain spaces and dots - with its folder on sys.path."""
+    script_dir = os.path.dirname(os.path.abspath(script_path))
+    if script_dir not in sys.path:
+        sys.path.insert(0, script_dir)
+    module_name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(script_path))[0])
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_consumers(script_path):
+    """Import a plugin script by path and return its fit_consumers()."""
+    return load_script(script_path).fit_consumers()
+
+
+_here = os.path.dirname(os.path.abspath(__file__))
+
+PLUGIN_SCRIPTS = [
+    os.path.join(_here, 'jHeel_plugin v5.0.py'),
+    os.path.join(_here, '..', 'Mercury_HRV', 'HRVAnalyzer', 'jHeel_plugin_v4.9fbbHRV.py'),
+    os.path.join(_here, '..', 'refactoringArchives', 'purseRunningData_v1.py'),
+]
+
+
+if __name__ == "__main__":
+    dispatcher = FitDispatcher()
+    for script_path in PLUGIN_SCRIPTS:
+        for consumer in load_consumers(script_path):
+            dispatcher.register(consumer)
+    dispatcher.dispatch_folder('c:/users/stma/healthdata/fitfiles/activities')
@@ -0,0 +1,63 @@
+"""Declarative FIT field -> table column mapping for the jHeel plugins.
+
+A table is described once as a list of ``(column, sql_type, fit_names, units)``
+entries.  ``FieldMapping`` compiles that list into the CREATE TABLE statement,
+the INSERT statement and a lookup from FIT field name to column position, so a
+session message is turned into an insert-ready row in a single pass over its
+fields.  Adding a Connect IQ field means adding one entry to the list.
+
+The first entry is the key column; it is not read from the FIT message but
+filled with the activity id passed to ``extract``.
+"""
+
+import logging
+
+
+logger = logging.getLogger(__file__)
+
+
+class FieldMapping:
+    """A table mapping compiled once per application."""
+
+    def __init__(self, table_name, fields, insert_verb='INSERT OR REPLACE'):
+        self.table_name = table_name
+        self.fields = list(fields)
+        self.columns = [column for column, _, _, _ in self.fields]
+        self.units = {column: units for column, _, _, units in self.fields if units}
+        self.width = len(self.fields)
+
+        # FIT field name -> column index; a column may accept several spellings,
+        # the first one present in the message wins
+        self._index = {}
+        for i, (_, _, fit_names, _) in enumerate(self.fields):
+            for fit_name in fit_names or ():
+                self._index.setdefault(fit_name, i)
+
+        self.ddl = 'CREATE TABLE IF NOT EXISTS {} (\n    {}\n)'.format(
+            table_name, ',\n    '.join(f'{column} {sql_type}' for column, sql_type, _, _ in self.fields))
+        self.insert_sql = '{} INTO {} ({}) VALUES ({})'.format(
+            insert_verb, table_name, ', '.join(self.columns), ', '.join('?' * self.width))
+
+    def extract(self, key, fields):
+        """Build the row for one message from an iterable of (field_name, value) pairs."""
+        row = [None] * self.width
+        row[0] = key
+        index = self._index
+        for name, value in fields:
+            i = index.get(name)
+            if i is not None and row[i] is None:
+                row[i] = value
+        return row
+
+    def extract_message(self, key, message):
+        """Build the row for one fitparse message without materializing a field dict."""
+        return self.extract(key, ((field.name, field.value) for field in message.fields))
+
+    @staticmethod
+    def is_empty(row):
+        """True when nothing but the key column was found in the message."""
+        return all(value is None for value in row[1:])
+
+    def row_to_dict(self, row):
+        """{column: value} view of a row, for logging and ad-hoc inspection."""
+        return dict(zip(self.columns, row))
@@ -0,0 +1,357 @@
+"""Session-only FIT reader for the jHeel plugins.
+
+fitparse decodes every message of a FIT file, including the per-second
+``record`` messages, even when only the ``session`` summary is needed.  This
+reader walks the definition and data headers itself, skips unwanted data
+messages by their byte length and decodes only ``file_id``, ``session`` and the
+developer ``field_description`` messages needed to name the Connect IQ fields.
+
+The decoded fields are returned as ``{field_name: value}`` dicts using the same
+names fitparse produces, so the existing session field mapping works on either.
+
+``iter_fit_messages`` is the streaming form: the file is memory-mapped and the
+messages are yielded one at a time, so ``record`` messages (with their
+developer fields) can be consumed in constant memory however long the
+recording is, and a caller can stop after the first messages.
+"""
+
+import datetime
+import logging
+import mmap
+import struct
+
+
+logger = logging.getLogger(__file__)
+
+
+FIT_EPOCH = datetime.datetime(1989, 12, 31)
+MIN_ABSOLUTE_TIMESTAMP = 0x10000000
+TIMESTAMP_FIELD = 253
+
+MESG_FILE_ID = 0
+MESG_SESSION = 18
+MESG_RECORD = 20
+MESG_FIELD_DESCRIPTION = 206
+MESG_DEVELOPER_DATA_ID = 207
+
+SESSION_MESSAGES = ('file_id', 'session')
+
+# base type number -> (struct code, size, invalid value); None = compare raw bytes to 0xFF..
+_BASE_TYPES = {
+    0: ('B', 1, 0xFF),                  # enum
+    1: ('b', 1, 0x7F),                  # sint8
+    2: ('B', 1, 0xFF),                  # uint8
+    3: ('h', 2, 0x7FFF),                # sint16
+    4: ('H', 2, 0xFFFF),                # uint16
+    5: ('i', 4, 0x7FFFFFFF),            # sint32
+    6: ('I', 4, 0xFFFFFFFF),            # uint32
+    7: ('s', 1, None),                  # string
+    8: ('f', 4, None),                  # float32
+    9: ('d', 8, None),                  # float64
+    10: ('B', 1, 0x00),                 # uint8z
+    11: ('H', 2, 0x0000),               # uint16z
+    12: ('I', 4, 0x00000000),           # uint32z
+    13: ('B', 1, 0xFF),                 # byte
+    14: ('q', 8, 0x7FFFFFFFFFFFFFFF),    # sint64
+    15: ('Q', 8, 0xFFFFFFFFFFFFFFFF),    # uint64
+    16: ('Q', 8, 0x0000000000000000),   # uint64z
+}
+
+_FILE_TYPES = {
+    1: 'device', 2: 'settings', 3: 'sport', 4: 'activity', 5: 'workout', 6: 'course',
+    7: 'schedules', 9: 'weight', 10: 'totals', 11: 'goals', 14: 'blood_pressure',
+    15: 'monitoring_a', 20: 'activity_summary', 28: 'monitoring_daily', 32: 'monitoring_b',
+}
+
+_MANUFACTURERS = {1: 'garmin', 255: 'development'}
+
+_SPORTS = {
+    0: 'generic', 1: 'running', 2: 'cycling', 3: 'transition', 4: 'fitness_equipment',
+    5: 'swimming', 6: 'basketball', 7: 'soccer', 8: 'tennis', 9: 'american_football',
+    10: 'training', 11: 'walking', 12: 'cross_country_skiing', 13: 'alpine_skiing',
+    14: 'snowboarding', 15: 'rowing', 16: 'mountaineering', 17: 'hiking', 18: 'multisport',
+    19: 'paddling', 20: 'flying', 21: 'e_biking', 22: 'motorcycling', 23: 'boating',
+    24: 'driving', 25: 'golf', 26: 'hang_gliding', 27: 'horseback_riding', 28: 'hunting',
+    29: 'fishing', 30: 'inline_skating', 31: 'rock_climbing', 32: 'sailing',
+    33: 'ice_skating', 34: 'sky_diving', 35: 'snowshoeing', 36: 'snowmobiling',
+    37: 'stand_up_paddleboarding', 38: 'surfing', 39: 'wakeboarding', 40: 'water_skiing',
+    41: 'kayaking', 42: 'rafting', 43: 'windsurfing', 44: 'kitesurfing', 45: 'tactical',
+    46: 'jumpmaster', 47: 'boxing', 254: 'all',
+}
+
+# global message number -> (message name, {field number: (field name, scale, offset, kind)})
+# kind: None = plain number, 'date_time' = FIT timestamp, or an enum lookup dict
+_PROFILE = {
+    MESG_FILE_ID: ('file_id', {
+        0: ('type', 1, 0, _FILE_TYPES),
+        1: ('manufacturer', 1, 0, _MANUFACTURERS),
+        2: ('product', 1, 0, None),
+        3: ('serial_number', 1, 0, None),
+        4: ('time_created', 1, 0, 'date_time'),
+        5: ('number', 1, 0, None),
+        8: ('product_name', 1, 0, None),
+    }),
+    MESG_SESSION: ('session', {
+        253: ('timestamp', 1, 0, 'date_time'),
+        254: ('message_index', 1, 0, None),
+        0: ('event', 1, 0, None),
+        1: ('event_type', 1, 0, None),
+        2: ('start_time', 1, 0, 'date_time'),
+        3: ('start_position_lat', 1, 0, None),
+        4: ('start_position_long', 1, 0, None),
+        5: ('sport', 1, 0, _SPORTS),
+        6: ('sub_sport', 1, 0, None),
+        7: ('total_elapsed_time', 1000, 0, None),
+        8: ('total_timer_time', 1000, 0, None),
+        9: ('total_distance', 100, 0, None),
+        10: ('total_cycles', 1, 0, None),
+        11: ('total_calories', 1, 0, None),
+        13: ('total_fat_calories', 1, 0, None),
+        14: ('avg_speed', 1000, 0, None),
+        15: ('max_speed', 1000, 0, None),
+        16: ('avg_heart_rate', 1, 0, None),
+        17: ('max_heart_rate', 1, 0, None),
+        18: ('avg_cadence', 1, 0, None),
+        19: ('max_cadence', 1, 0, None),
+        20: ('avg_power', 1, 0, None),
+        21: ('max_power', 1, 0, None),
+        22: ('total_ascent', 1, 0, None),
+        23: ('total_descent', 1, 0, None),
+        24: ('total_training_effect', 10, 0, None),
+        25: ('first_lap_index', 1, 0, None),
+        26: ('num_laps', 1, 0, None),
+        64: ('min_heart_rate', 1, 0, None),
+    }),
+    MESG_RECORD: ('record', {
+        253: ('timestamp', 1, 0, 'date_time'),
+        0: ('position_lat', 1, 0, None),
+        1: ('position_long', 1, 0, None),
+        2: ('altitude', 5, 500, None),
+        3: ('heart_rate', 1, 0, None),
+        4: ('cadence', 1, 0, None),
+        5: ('distance', 100, 0, None),
+        6: ('speed', 1000, 0, None),
+        7: ('power', 1, 0, None),
+        13: ('temperature', 1, 0, None),
+        73: ('enhanced_speed', 1000, 0, None),
+        78: ('enhanced_altitude', 5, 500, None),
+    }),
+    MESG_FIELD_DESCRIPTION: ('field_description', {
+        0: ('developer_data_index', 1, 0, None),
+        1: ('field_definition_number', 1, 0, None),
+        2: ('fit_base_type_id', 1, 0, None),
+        3: ('field_name', 1, 0, None),
+        6: ('scale', 1, 0, None),
+        7: ('offset', 1, 0, None),
+        8: ('units', 1, 0, None),
+    }),
+    MESG_DEVELOPER_DATA_ID: ('developer_data_id', {
+        0: ('developer_id', 1, 0, None),
+        1: ('application_id', 1, 0, None),
+        2: ('manufacturer_id', 1, 0, None),
+        3: ('developer_data_index', 1, 0, None),
+        4: ('application_version', 1, 0, None),
+    }),
+}
+
+
+class FitFormatError(Exception):
+    """Raised when the file is not a FIT file or is truncated."""
+
+
+class _Definition:
+    """A local message definition: which fields a data message carries and its byte size."""
+
+    __slots__ = ('global_num', 'endian', 'fields', 'dev_fields', 'size', 'timestamp_offset')
+
+    def __init__(self, global_num, endian, fields, dev_fields):
+        self.global_num = global_num
+        self.endian = endian
+        self.fields = fields
+        self.dev_fields = dev_fields
+        self.size = sum(size for _, size, _ in fields) + sum(size for _, size, _ in dev_fields)
+        # offset of the uint32 timestamp inside the data message, used to follow
+        # compressed timestamp headers without decoding the skipped messages
+        self.timestamp_offset = None
+        offset = 0
+        for num, size, _ in fields:
+            if num == TIMESTAMP_FIELD and size == 4:
+                self.timestamp_offset = offset
+                break
+            offset += size
+
+
+def _decode_value(data, offset, size, base_type, endian):
+    """Decode one field from the raw bytes; arrays come back as tuples, invalid values as None."""
+    raw = data[offset:offset + size]
+    code, type_size, invalid = _BASE_TYPES.get(base_type & 0x1F, ('B', 1, 0xFF))
+
+    if code == 's':
+        value = raw.split(b'\x00', 1)[0]
+        return value.decode('utf-8', errors='replace') if value else None
+
+    if size % type_size:
+        return bytes(raw)
+
+    count = size // type_size
+    values = struct.unpack(endian + code * count, raw)
+    if invalid is None:
+        values = [None if raw[i * type_size:(i + 1) * type_size] == b'\xff' * type_size else v
+                  for i, v in enumerate(values)]
+    else:
+        values = [None if v == invalid else v for v in values]
+
+    if count == 1:
+        return values[0]
+    if all(v is None for v in values):
+        return None
+    return tuple(values)
+
+
+def _convert(value, scale, offset, kind):
+    """Apply the profile scale/offset and map date_time and enum fields like fitparse does."""
+    if value is None or isinstance(value, (str, bytes, tuple)):
+        return value
+    if kind == 'date_time':
+        if value >= MIN_ABSOLUTE_TIMESTAMP:
+            return FIT_EPOCH + datetime.timedelta(seconds=value)
+        return value
+    if isinstance(kind, dict):
+        return kind.get(value, value)
+    if scale != 1 or offset != 0:
+        return value / scale - offset
+    return value
+
+
+def read_fit_messages(file_path, message_names=SESSION_MESSAGES):
+    """Decode only the named messages of a FIT file.
+
+    Returns a list of (message_name, {field_name: value}) tuples in file order.
+    Every other data message is skipped by its length without being decoded.
+    """
+    with open(file_path, 'rb') as f:
+        data = f.read()
+    return read_fit_messages_from_bytes(data, message_names)
+
+
+def read_fit_messages_from_bytes(data, message_names=SESSION_MESSAGES):
+    """Same as read_fit_messages for FIT content already held in memory."""
+    return list(iter_fit_messages_from_bytes(data, message_names))
+
+
+def iter_fit_messages(file_path, message_names=SESSION_MESSAGES):
+    """Yield the named messages of a FIT file as (message_name, {field_name: value}), one at a time.
+
+    The file is memory-mapped rather than read, so memory use does not grow with the file.
+    """
+    with open(file_path, 'rb') as f:
+        if not f.seek(0, 2):
+            raise FitFormatError('Empty FIT file')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            yield from iter_fit_messages_from_bytes(data, message_names)
+
+
+def iter_fit_messages_from_bytes(data, message_names=SESSION_MESSAGES):
+    """Generator behind read_fit_messages_from_bytes and iter_fit_messages."""
+    wanted = {num for num, (name, _) in _PROFILE.items() if name in message_names}
+    wanted.add(MESG_FIELD_DESCRIPTION)
+
+    dev_field_descriptions = {}
+    file_offset = 0
+
+    # a .fit file may hold several chained FIT files - each with its own header and CRC
+    while file_offset + 12 <= len(data):
+        header_size = data[file_offset]
+        if data[file_offset + 8:file_offset + 12] != b'.FIT':
+            raise FitFormatError('Invalid FIT file header')
+        data_size = struct.unpack_from('<I', data, file_offset + 4)[0]
+        offset = file_offset + header_size
+        end = offset + data_size
+        if end > len(data):
+            raise FitFormatError('FIT file is truncated')
+
+        definitions = {}
+        last_timestamp = None
+
+        while offset < end:
+            header = data[offset]
+            offset += 1
+
+            if header & 0x80:
+                # compressed timestamp header - always a data message
+                local_num = (header >> 5) & 0x03
+                time_offset = header & 0x1F
+                if last_timestamp is not None:
+                    timestamp = (last_timestamp & ~0x1F) + time_offset
+                    if time_offset < (last_timestamp & 0x1F):
+                        timestamp += 0x20
+                    last_timestamp = timestamp
+            elif header & 0x40:
+                # definition message
+                local_num = header & 0x0F
+                endian = '>' if data[offset + 1] else '<'
+                global_num = struct.unpack_from(endian + 'H', data, offset + 2)[0]
+                num_fields = data[offset + 4]
+                offset += 5
+                fields = [tuple(data[offset + i * 3:offset + i * 3 + 3]) for i in range(num_fields)]
+                offset += num_fields * 3
+                dev_fields = []
+                if header & 0x20:
+                    num_dev_fields = data[offset]
+                    offset += 1
+                    dev_fields = [tuple(data[offset + i * 3:offset + i * 3 + 3]) for i in range(num_dev_fields)]
+                    offset += num_dev_fields * 3
+                definitions[local_num] = _Definition(global_num, endian, fields, dev_fields)
+                continue
+            else:
+                local_num = header & 0x0F
+
+            definition = definitions.get(local_num)
+            if definition is None:
+                raise FitFormatError(f'Data message for undefined local message {local_num}')
+
+            if definition.global_num not in wanted:
+                if definition.timestamp_offset is not None:
+                    timestamp = struct.unpack_from(definition.endian + 'I', data, offset + definition.timestamp_offset)[0]
+                    if timestamp != 0xFFFFFFFF:
+                        last_timestamp = timestamp
+                offset += definition.size
+                continue
+
+            name, profile = _PROFILE[definition.global_num]
+            fields = {}
+            for num, size, base_type in definition.fields:
+                value = _decode_value(data, offset, size, base_type, definition.endian)
+                offset += size
+                if num == TIMESTAMP_FIELD and isinstance(value, int):
+                    last_timestamp = value
+                field_name, scale, field_offset, kind = profile.get(num, (f'unknown_{num}', 1, 0, None))
+                fields[field_name] = _convert(value, scale, field_offset, kind)
+
+            if header & 0x80 and TIMESTAMP_FIELD in profile and last_timestamp is not None:
+                fields.setdefault('timestamp', _convert(last_timestamp, 1, 0, 'date_time'))
+
+            for num, size, dev_data_index in definition.dev_fields:
+                description = dev_field_descriptions.get((dev_data_index, num))
+                if description is None:
+                    fields[f'unknown_dev_{dev_data_index}_{num}'] = bytes(data[offset:offset + size])
+                else:
+                    field_name, base_type = description
+                    fields[field_name] = _decode_value(data, offset, size, base_type, definition.endian)
+                offset += size
+
+            if definition.global_num == MESG_FIELD_DESCRIPTION:
+                key = (fields.get('developer_data_index'), fields.get('field_definition_number'))
+                dev_field_descriptions[key] = (fields.get('field_name'), fields.get('fit_base_type_id') or 0)
+                if name not in message_names:
+                    continue
+
+            yield name, fields
+
+        # skip the 2 byte file CRC
+        file_offset = end + 2
+
+
+def read_sessions(file_path):
+    """Return the session messages of a FIT file as a list of {field_name: value} dicts."""
+    return [fields for name, fields in read_fit_messages(file_path, ('session',)) if name == 'session']
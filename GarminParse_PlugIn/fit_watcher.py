@@ -0,0 +1,162 @@
+"""Watch a FIT drop folder and hand every new activity to an ingestion callback.
+
+On Linux the folder is watched with inotify (through ctypes, no extra
+dependency); elsewhere, or when inotify is not available, the folder is polled.
+Watch sync tools write files in several chunks, so a file is only handed over
+once its size and mtime have been stable for ``settle_time`` seconds.
+"""
+
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+
+logger = logging.getLogger(__file__)
+
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0x00000800
+IN_WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify:
+    """Minimal inotify wrapper - yields the names of files changed in one folder."""
+
+    def __init__(self, folder_path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(folder_path), IN_WATCH_MASK) < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {folder_path}')
+
+    def read_names(self, timeout):
+        """Wait up to timeout seconds and return the file names with pending events."""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        names = []
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(buffer):
+            _, _, _, name_length = _EVENT_HEADER.unpack_from(buffer, offset)
+            offset += _EVENT_HEADER.size
+            name = buffer[offset:offset + name_length].rstrip(b'\x00')
+            offset += name_length
+            if name:
+                names.append(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+def _file_signature(file_path):
+    try:
+        stat = os.stat(file_path)
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+def folder_snapshot(folder_path, extension='.fit'):
+    """{file_path: (size, mtime)} of the files in folder_path - the baseline of watch_folder"""
+    with os.scandir(folder_path) as entries:
+        return {entry.path: _file_signature(entry.path) for entry in entries
+                if entry.name.lower().endswith(extension)}
+
+
+def watch_folder(folder_path, on_new_file, extension='.fit', settle_time=5.0, poll_interval=2.0,
+                 process_existing=False, use_inotify=None, stop=None, snapshot=None):
+    """Call on_new_file(file_path) for every file that lands in folder_path, until stop() is True.
+
+    Files already in the folder are only handed over when process_existing is True.
+    snapshot (from folder_snapshot) replaces the scan taken at start - take it before an initial
+    pass over the folder, so files landing during that pass are handed over too.
+    use_inotify=None picks inotify on Linux and falls back to polling if it cannot be set up.
+    """
+    if use_inotify is None:
+        use_inotify = sys.platform.startswith('linux')
+
+    inotify = None
+    if use_inotify:
+        try:
+            inotify = _Inotify(folder_path)
+            logger.info("Watching %s with inotify", folder_path)
+        except (OSError, AttributeError) as e:
+            logger.warning("inotify unavailable (%s) - polling %s every %ss", e, folder_path, poll_interval)
+    if inotify is None:
+        logger.info("Polling %s every %ss", folder_path, poll_interval)
+
+    def scan():
+        return folder_snapshot(folder_path, extension)
+
+    if process_existing:
+        seen = {}
+    else:
+        seen = dict(snapshot) if snapshot is not None else scan()
+    # file_path -> (signature, time the signature was last seen changing)
+    pending = {}
+    if process_existing:
+        now = time.monotonic()
+        pending = {file_path: (signature, now) for file_path, signature in scan().items()}
+    elif snapshot is not None:
+        # files that landed or changed since the snapshot
+        now = time.monotonic()
+        pending = {file_path: (signature, now) for file_path, signature in scan().items()
+                   if signature is not None and seen.get(file_path) != signature}
+
+    try:
+        while stop is None or not stop():
+            if inotify is not None:
+                changed = [os.path.join(folder_path, name) for name in inotify.read_names(min(poll_interval, settle_time))
+                           if name.lower().endswith(extension)]
+                candidates = {file_path: _file_signature(file_path) for file_path in changed}
+            else:
+                time.sleep(poll_interval)
+                candidates = {file_path: signature for file_path, signature in scan().items()
+                              if seen.get(file_path) != signature}
+
+            now = time.monotonic()
+            for file_path, signature in candidates.items():
+                if signature is None or seen.get(file_path) == signature:
+                    continue
+                previous = pending.get(file_path)
+                if previous is None or previous[0] != signature:
+                    pending[file_path] = (signature, now)
+
+            # debounce - hand over files whose size and mtime stopped changing
+            for file_path, (signature, changed_at) in list(pending.items()):
+                if now - changed_at < settle_time:
+                    continue
+                current = _file_signature(file_path)
+                if current is None:
+                    del pending[file_path]
+                    continue
+                if current != signature:
+                    pending[file_path] = (current, now)
+                    continue
+                del pending[file_path]
+                seen[file_path] = current
+                logger.info("New activity file %s", file_path)
+                try:
+                    on_new_file(file_path)
+                except Exception as e:
+                    logger.error("Error ingesting %s: %s", file_path, e)
+    finally:
+        if inotify is not None:
+            inotify.close()
@@ -8,83 +8,102 @@
 
 import sqlite3
 import os
+import sys
 import logging
 import datetime
+import hashlib
+import time
 
 
 
-# Set up logging
-
-# Get the current date and time
-now = datetime.datetime.now()
-
-# Format it as a string
-timestamp = now.strftime('%Y%m%d_%H%M%S')
-
-# Include the timestamp in the log file name
-logging.basicConfig(filename=f'c:/temp/logs/jheel_parse_Fields-v5{timestamp}.log', level=logging.INFO)
-
-# Include the timestamp in the log file name
-logging.info('Starting script...')
-print('Starting script...')
-
 # Set up the database connection
 # database_path = os.path.abspath('c:/users/stma/healthdata/dbs/garmin_activities.db')
 # database_path = os.path.abspath('e:/jheel_dev/DataBasesDev/artemis.db')
- 
-def create_table_if_not_exists():
-    conn = sqlite3.connect(r'g:/My Drive/Phoenix/DataBasesDev/artemis.db')
+database_path = 'g:/My Drive/Phoenix/DataBasesDev/artemis.db'
+
+# Artemistbl_Fields - one entry per column: (column, SQL type, FIT field name(s), units)
+# this list is the only place to edit when a new Connect IQ field is added
+from fit_field_mapping import FieldMapping
+
+artemis_fields = [
+    ('activity_id', 'INT PRIMARY KEY', None, None),
+    ('timestamp', 'TEXT', ('timestamp',), None),
+    ('sport', 'TEXT', ('sport',), None),
+    ('avg_heart_rate', 'INT', ('avg_heart_rate',), 'bpm'),
+    ('total_elapsed_time', 'INT', ('total_elapsed_time',), 's'),
+    ('distance', 'REAL', ('total_distance',), 'm'),
+    ('hrv', 'INT', ('HRV',), 'ms'),
+    ('fat', 'INT', ('Fat',), 'g'),
+    ('total_fat', 'INT', ('Total Fat',), 'g'),
+    ('carbs', 'INT', ('Carbs',), 'g'),
+    ('total_carbs', 'INT', ('Total Carbs',), 'g'),
+    ('VO2maxSmooth', 'INT', ('VO2maxSmooth',), 'ml/kg/min'),
+    ('VO2maxSession', 'INT', ('VO2maxSession',), 'ml/kg/min'),
+    ('CardiacDrift', 'INT', ('CardiacDrift',), '%'),
+    ('CooperTest', 'INT', ('CooperTest',), 'm'),
+    ('steps', 'INT', ('Steps', 'steps'), 'steps'),
+    ('stress_hrpa', 'INT', ('stress_hrpa',), None),
+    ('HR_RS_Deviation_Index', 'INT', ('HR-RS Deviation Index',), None),
+    ('hrv_sdrr_f', 'INT', ('hrv_sdrr_f',), 'ms'),
+    ('hrv_pnn50', 'INT', ('hrv_pnn50',), '%'),
+    ('hrv_pnn20', 'INT', ('hrv_pnn20',), '%'),
+    ('rmssd', 'INT', ('RMSSD',), 'ms'),
+    ('lnrmssd', 'INT', ('lnRMSSD',), None),
+    ('sdnn', 'INT', ('SDNN',), 'ms'),
+    ('sdsd', 'INT', ('SDSD',), 'ms'),
+    ('nn50', 'INT', ('NN50',), 'beats'),
+    ('nn20', 'INT', ('NN20',), 'beats'),
+    ('pnn20', 'INT', ('pNN20',), '%'),
+    ('Long', 'INT', ('Long',), 'beats'),
+    ('Short', 'INT', ('Short',), 'beats'),
+    ('Ectopic_S', 'INT', ('Ectopic-S',), 'beats'),
+    ('hrv_rmssd', 'INT', ('hrv_rmssd',), 'ms'),
+    ('SD2', 'INT', ('SD2',), 'ms'),
+    ('SD1', 'INT', ('SD1',), 'ms'),
+    ('LF', 'INT', ('LF',), 'ms2'),
+    ('HF', 'INT', ('HF',), 'ms2'),
+    # VLF, MeanHR and MeanRR: the old per-row insert wrote LF into VLF and swapped MeanHR / MeanRR -
+    # rows it stored keep those values until re-ingested with create_table_if_not_exists(rebuild=True)
+    ('VLF', 'INT', ('VLF',), 'ms2'),
+    ('pNN50', 'INT', ('pNN50',), '%'),
+    ('LFnu', 'INT', ('LFnu',), 'nu'),
+    ('HFnu', 'INT', ('HFnu',), 'nu'),
+    ('MeanHR', 'INT', ('Mean HR',), 'bpm'),
+    ('MeanRR', 'INT', ('Mean RR',), 'ms'),
+    ('Running_Economy', 'TXT', ('Running Economy',), None),
+]
+
+# compiled once per process - DDL, INSERT statement and the field name -> column lookup
+artemis_mapping = FieldMapping('Artemistbl_Fields', artemis_fields)
+
+# rebuild=True drops the table and the ingestion manifest so the next run reparses every file
+def create_table_if_not_exists(rebuild=False):
+    conn = sqlite3.connect(database_path)
     cursor = conn.cursor()
 
     #drop table if exists
-    cursor.execute('DROP TABLE IF EXISTS Artemistbl_Fields')
-    logging.info('Table dropped successfully.')
+    if rebuild:
+        cursor.execute('DROP TABLE IF EXISTS Artemistbl_Fields')
+        cursor.execute('DROP TABLE IF EXISTS Artemistbl_Manifest')
+        logging.info('Table dropped successfully.')
+
+    cursor.execute(artemis_mapping.ddl)
+    
+    logging.info('Table Artemistbl_Fields created successfully.')
 
+    # ingestion manifest - one row per .fit file already parsed into Artemistbl_Fields
     cursor.execute('''
-        CREATE TABLE IF NOT EXISTS Artemistbl_Fields (
-            activity_id INT PRIMARY KEY,
-            timestamp TEXT,
-            sport TEXT,
-            avg_heart_rate INT,
-            total_elapsed_time INT,
-            distance REAL,
-            hrv INT,
-            fat INT,
-            total_fat INT,  
-            carbs INT,
-            total_carbs INT,
-            VO2maxSmooth INT,
-            VO2maxSession INT,
-            CardiacDrift INT,    
-            CooperTest INT,
-            steps INT,
-            stress_hrpa INT,
-            HR_RS_Deviation_Index INT,
-            hrv_sdrr_f INT,
-            hrv_pnn50 INT,                          
-            hrv_pnn20 INT,
-            rmssd INT,
-            lnrmssd INT,
-            sdnn INT,
-            sdsd INT,
-            nn50 INT,
-            nn20 INT,
-            pnn20 INT,
-            Long  INT,
-            Short INT,
-            Ectopic_S INT,
-            hrv_rmssd INT,
-            SD2 INT,
-            SD1 INT,
-            LF INT,
-            HF INT,
-            VLF INT,
-            pNN50 INT, 
-            LFnu INT, HFnu INT,MeanHR INT, MeanRR INT, Running_Economy TXT
+        CREATE TABLE IF NOT EXISTS Artemistbl_Manifest (
+            file_path TEXT PRIMARY KEY,
+            file_size INT,
+            mtime REAL,
+            content_hash TEXT,
+            activity_id TEXT,
+            ingested_at TEXT
         )
     ''')
-    
-    logging.info('Table Artemistbl_Fields created successfully.')
+
+    logging.info('Table Artemistbl_Manifest created successfully.')
 
     conn.commit()
     conn.close()
@@ -92,6 +111,11 @@ def create_table_if_not_exists():
 
 # Parse all .fit files in the specified folder (folder_path)
 from fitparse import FitFile
+from fit_session_reader import read_sessions
+from fit_cache import get_decoded_fit
+from fit_watcher import folder_snapshot, watch_folder
+from fit_dispatcher import FitConsumer
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
 def parse_all_fit_files_in_folder(folder_path):
     all_session_data = []
@@ -114,7 +138,55 @@ def parse_all_fit_files_in_folder(folder_path):
     return all_session_data
 
 
-# Parse a single .fit file and return the session data
+# Hash the file content in chunks - used by the manifest to detect modified files
+
+def file_content_hash(file_path):
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Read the manifest as {file_path: (file_size, mtime, content_hash)} - all files or just one
+
+def load_manifest(file_path=None):
+    conn = sqlite3.connect(database_path)
+    cursor = conn.cursor()
+    if file_path is None:
+        cursor.execute('SELECT file_path, file_size, mtime, content_hash FROM Artemistbl_Manifest')
+    else:
+        cursor.execute('SELECT file_path, file_size, mtime, content_hash FROM Artemistbl_Manifest WHERE file_path = ?',
+                       (file_path,))
+    manifest = {row[0]: row[1:] for row in cursor.fetchall()}
+    conn.close()
+    return manifest
+
+
+# Yield (filename, fit_file_path, activity_id, manifest_row, changed) for every file that is
+# new or was touched since the manifest entry; changed is False when only the mtime moved.
+
+def iter_changed_fit_files(fit_files, manifest):
+    for filename, fit_file_path, activity_id in fit_files:
+        stat = os.stat(fit_file_path)
+        known = manifest.get(fit_file_path)
+        if known is not None and known[0] == stat.st_size and known[1] == stat.st_mtime:
+            continue
+
+        content_hash = file_content_hash(fit_file_path)
+        manifest_row = (fit_file_path, stat.st_size, stat.st_mtime, content_hash, activity_id)
+        # touched but not modified - only refresh the manifest entry
+        changed = known is None or known[2] != content_hash
+        yield filename, fit_file_path, activity_id, manifest_row, changed
+
+
+manifest_insert_sql = '''
+    INSERT OR REPLACE INTO Artemistbl_Manifest (file_path, file_size, mtime, content_hash, activity_id, ingested_at)
+    VALUES (?, ?, ?, ?, ?, ?)
+'''
+
+
+# Parse a single .fit file and return the session rows (in Artemistbl_Fields column order)
 
 def parse_fit_file(file_path, activity_id):
     fit_file = FitFile(file_path)
@@ -125,171 +197,244 @@ def parse_fit_file(file_path, activity_id):
     for msg in messages:
 
             if msg.name == 'session':
-                fields = msg.fields
-                field_dict = {field.name: field.value for field in fields}
-                
-                timestamp = field_dict.get('timestamp')
-                sport = field_dict.get('sport')
-                avg_heart_rate = field_dict.get('avg_heart_rate')
-
-
-
-                total_elapsed_time = field_dict.get('total_elapsed_time')
-                activity_id = activity_id
-                distance = field_dict.get('total_distance')
-                hrv = field_dict.get('HRV')
-                fat = field_dict.get('Fat')  
-                total_fat = field_dict.get('Total Fat')
-                carbs = field_dict.get('Carbs')
-                total_carbs = field_dict.get('Total Carbs')
-                VO2maxSmooth = field_dict.get('VO2maxSmooth')
-                VO2maxSession = field_dict.get('VO2maxSession')
-                CardiaDrift = field_dict.get('CardiacDrift')
-                CooperTest = field_dict.get('CooperTest')
-                steps = field_dict.get('Steps')
-                stress_hrpa = field_dict.get('stress_hrpa')
-                HR_RS_Deviation_Index = field_dict.get('HR-RS Deviation Index')
-                hrv_sdrr_f = field_dict.get('hrv_sdrr_f')
-                hrv_pnn50 = field_dict.get('hrv_pnn50')
-                hrv_pnn20 = field_dict.get('hrv_pnn20')
-                rmssd = field_dict.get('RMSSD')
-                lnrmssd = field_dict.get('lnRMSSD')
-                sdnn = field_dict.get('SDNN')
-                sdsd = field_dict.get('SDSD')
-                nn50 = field_dict.get('NN50')
-                nn20 = field_dict.get('NN20')
-                pnn20 = field_dict.get('pNN20')
-                Long = field_dict.get('Long')
-                Short = field_dict.get('Short')
-                Ectopic_S = field_dict.get('Ectopic-S')
-                hrv_rmssd = field_dict.get('hrv_rmssd')
-                SD2 = field_dict.get('SD2')
-                SD1 = field_dict.get('SD1')
-                LF = field_dict.get('LF')
-                HF = field_dict.get('HF')
-                VLF = field_dict.get('VLF')
-                pNN50 = field_dict.get('pNN50')
-                LFnu = field_dict.get('LFnu')
-                HFnu = field_dict.get('HFnu')
-                MeanHR = field_dict.get('Mean HR')
-                MeanRR = field_dict.get('Mean RR')
-                Running_Economy = field_dict.get('Running Economy')
-
-                if steps is None:
-                    steps = field_dict.get('steps')
-                
-                session_data.append({
-                    'activity_id': activity_id,
-                    'timestamp': timestamp, # '2021-09-01 12:00:00
-                    'sport': sport,
-                    'avg_heart_rate': avg_heart_rate,
-                    'total_elapsed_time': total_elapsed_time,
-                    'distance': distance,
-                    'hrv': hrv,
-                    'fat': fat,
-                    'Total Fat': total_fat, # 'extra field for total fat
-                    'Carbs' : carbs, 
-                    'Total Carbs' : total_carbs, # 'extra field for total carbs
-                    'VO2maxSmooth' : VO2maxSmooth,
-                    'VO2maxSession' : VO2maxSession,
-                    'CardiacDrift' : CardiaDrift,
-                    'CooperTest' : CooperTest,
-                    'Steps' : steps,
-                    'stress_hrpa' : stress_hrpa,
-                    'HR-RS_Deviation Index' : HR_RS_Deviation_Index,
-                    'hrv_sdrr_f' : hrv_sdrr_f,
-                    'hrv_pnn50' : hrv_pnn50,
-                    'hrv_pnn20' : hrv_pnn20,
-                    'RMSSD' : rmssd,
-                    'lnRMSSD' : lnrmssd,
-                    'SDNN' : sdnn,
-                    'SDSD' : sdsd,
-                    'NN50' : nn50,
-                    'NN20' : nn20,
-                    'pnn20' : pnn20,
-                    'Long' : Long,
-                    'Short' : Short,
-                    'Ectopic_S' : Ectopic_S,
-                    'hrv_rmssd' : hrv_rmssd,
-                    'SD2' : SD2,
-                    'SD1' : SD1,
-                    'HF' : HF,
-                    'LF' : LF,
-                    'VLF' : VLF,
-                    'pNN50' : pNN50,
-                    'LFnu'  : LFnu,
-                    'HFnu' : HFnu,
-                    'MeanHR' : MeanHR,
-                    'MeanRR' : MeanRR,
-                    'Running Economy' : Running_Economy
-
-                })
-                
+                session_data.append(artemis_mapping.extract_message(activity_id, msg))
                 logging.info(f'Parsed session data for activity ID {activity_id}.')
 
     return session_data
 
 
-# Insert the session data into the database
+# Fast path - decode only the session messages (record payloads are skipped by length)
+# and map them with the same artemis_mapping as parse_fit_file
+
+def parse_fit_file_sessions_only(file_path, activity_id):
+    session_data = []
+    for field_dict in read_sessions(file_path):
+        session_data.append(artemis_mapping.extract(activity_id, field_dict.items()))
+        logging.info(f'Parsed session data for activity ID {activity_id}.')
+    return session_data
+
+
+# Cached path - the decoded file comes from the content-addressed FIT cache shared with the
+# HRV and RunAnal parsers, so a file already decoded by any of them is not decoded again
+
+def parse_fit_file_cached(file_path, activity_id):
+    session_data = []
+    for field_dict in get_decoded_fit(file_path).messages('session'):
+        session_data.append(artemis_mapping.extract(activity_id, field_dict.items()))
+        logging.info(f'Parsed session data for activity ID {activity_id}.')
+    return session_data
+
+
+# Insert the session rows into the database
 
 def insert_data_into_db(data):
-    conn = sqlite3.connect('g:/My Drive/Phoenix/DataBasesDev/artemis.db')
+    conn = sqlite3.connect(database_path)
     cursor = conn.cursor()
 
-    # Specify the fields you care about
-    specific_fields = ['fat','Total Fat','Carbs','Total Carbs',
-                    'VO2maxSmooth','sport',
-                    'avg_heart_rate', 'total_elapsed_time',
-                    'VO2maxSession', 'timestamp',
-                    'CardiacDrift',
-                    'CooperTest',
-                    'Steps',
-                    'stress_hrpa',
-                    'HR-RS_Deviation Index',
-                    'hrv_sdrr_f',
-                    'hrv_pnn50',
-                    'hrv_pnn20',
-                    'RMSSD',
-                    'lnRMSSD',
-                    'SDNN',
-                    'SDSD',
-                    'NN50',
-                    'NN20',
-                    'pnn20',
-                    'Long',
-                    'Short', 
-                    'Ectopic_S',
-                    'hrv_rmssd',
-                    'SD2',
-                    'SD1',
-                    'LF',
-                    'HF',
-                    'VLF','pNN50','LFnu','HFnu','MeanHR', 'MeanRR', 'Running Economy']  # Replace with your specific fields
-
     for session in data:
-        # Check if all specific fields in the session dictionary are None
-        if all(session[field] is None for field in specific_fields):
-            # If they are, skip this iteration
+        # Skip sessions where none of the mapped fields were present
+        if artemis_mapping.is_empty(session):
             continue
 
-        # The activity_id does not exist in the table, so insert the new record
-        cursor.execute('''
-            INSERT OR REPLACE INTO Artemistbl_Fields (activity_id, distance, hrv, fat, total_fat,carbs, total_carbs,  VO2maxSmooth, sport, avg_heart_rate, total_elapsed_time, steps, stress_hrpa, HR_RS_Deviation_Index ,hrv_sdrr_f, hrv_pnn50, hrv_pnn20, rmssd, lnrmssd, sdnn, sdsd, nn50, nn20, pnn20, Long, Short, Ectopic_S, hrv_rmssd, VO2maxSession, timestamp, CardiacDrift, CooperTest, SD2, SD1, HF, LF, VLF, pNN50, LFnu, HFnu, MeanHR, MeanRR, Running_Economy)
-            VALUES (?,?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?,?,?,?,?,?,?,?,?,?,?,?)
-        ''', (session['activity_id'], session['distance'], session['hrv'], session['fat'], session['Total Fat'],session['Carbs'], session['Total Carbs'],session['VO2maxSmooth'], session['sport'], 
-              session['avg_heart_rate'], session['total_elapsed_time'],
-              session['Steps'], session['stress_hrpa'], session['HR-RS_Deviation Index'],session['hrv_sdrr_f'], session['hrv_pnn50'], session['hrv_pnn20'], session['RMSSD'], session['lnRMSSD'], session['SDNN'], session['SDSD'], session['NN50'], session['NN20'], session['pnn20'], session['Long'], session['Short'], session['Ectopic_S'], session['hrv_rmssd'], session['VO2maxSession'], 
-              session ['timestamp'],session['CardiacDrift'], session['CooperTest'], session['SD2'], session['SD1'], session['HF'] , session['LF'], session['LF'], session['pNN50'], session['LFnu'], session['HFnu'],
-              session['MeanRR'], session['MeanHR'], session['Running Economy']))
+        cursor.execute(artemis_mapping.insert_sql, session)
 
     conn.commit()
     conn.close()
 
+
+# Open a connection tuned for bulk loading - WAL journal, fewer fsyncs and a 64MB page cache
+
+def connect_for_bulk_write(path=None):
+    conn = sqlite3.connect(path or database_path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA cache_size=-65536')
+    return conn
+
+
+# Bulk writer - consumes any iterator of session rows (e.g. the FitDispatcher consumer below),
+# writes them with executemany in batches inside a single transaction and reports rows/s
+
+def bulk_insert_data_into_db(data, batch_size=1000):
+    conn = connect_for_bulk_write()
+    start = time.perf_counter()
+    rows_written = 0
+    try:
+        with conn:
+            batch = []
+            for session in data:
+                if artemis_mapping.is_empty(session):
+                    continue
+                batch.append(session)
+                if len(batch) >= batch_size:
+                    conn.executemany(artemis_mapping.insert_sql, batch)
+                    rows_written += len(batch)
+                    batch = []
+            if batch:
+                conn.executemany(artemis_mapping.insert_sql, batch)
+                rows_written += len(batch)
+    finally:
+        conn.close()
+
+    elapsed = time.perf_counter() - start
+    rate = rows_written / elapsed if elapsed > 0 else float(rows_written)
+    logging.info(f'Bulk insert: {rows_written} rows in {elapsed:.2f}s ({rate:.0f} rows/s).')
+    print(f'Bulk insert: {rows_written} rows in {elapsed:.2f}s ({rate:.0f} rows/s).')
+    return rows_written
+
+
+# Streaming ingestion pipeline: list -> decode + map -> batch -> write.
+# Every stage is a generator, so only a bounded window of files in flight and one batch of rows
+# are held in memory whatever the archive size. Each batch is committed together with the manifest
+# entries of its files - an interrupted run keeps everything committed so far and the next run
+# resumes with the files that are still missing from the manifest.
+
+def iter_fit_files(folder_path):
+    with os.scandir(folder_path) as entries:
+        for entry in entries:
+            if entry.name.endswith('.fit'):
+                activity_id = os.path.splitext(entry.name)[0].split('_')[0]  # Get everything before '_' character
+                yield entry.name, entry.path, activity_id
+
+
+# Decode + map stage - yields (filename, manifest_row, session_rows) per file.
+# manifest_row is None when the parse failed, so the file stays out of the manifest and is retried.
+# With max_workers > 1 files are parsed in a process pool with at most window files in flight.
+
+def iter_parsed_fit_files(changed_files, parse_func=None, max_workers=1, window=None):
+    if parse_func is None:
+        parse_func = parse_fit_file_sessions_only
+
+    if max_workers == 1:
+        for filename, fit_file_path, activity_id, manifest_row, changed in changed_files:
+            session_rows = []
+            if changed:
+                try:
+                    session_rows = parse_func(fit_file_path, activity_id)
+                except Exception as e:
+                    logging.error(f'Error parsing file {filename}: {e}')
+                    print(f'Error parsing file {filename}: {e}')
+                    manifest_row = None
+            yield filename, manifest_row, session_rows
+        return
+
+    window = window or (max_workers or os.cpu_count()) * 4
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+
+        def completed():
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename, manifest_row = pending.pop(future)
+                try:
+                    session_rows = future.result()
+                except Exception as e:
+                    logging.error(f'Error parsing file {filename}: {e}')
+                    print(f'Error parsing file {filename}: {e}')
+                    session_rows, manifest_row = [], None
+                yield filename, manifest_row, session_rows
+
+        for filename, fit_file_path, activity_id, manifest_row, changed in changed_files:
+            if not changed:
+                yield filename, manifest_row, []
+                continue
+            pending[executor.submit(parse_func, fit_file_path, activity_id)] = (filename, manifest_row)
+            if len(pending) >= window:
+                yield from completed()
+
+        while pending:
+            yield from completed()
+
+
+# Batch + write stage - commits every batch_rows session rows (or batch_files files) in one
+# transaction with their manifest entries and reports progress after each commit
+
+def write_parsed_fit_files(parsed_files, batch_rows=1000, batch_files=200):
+    conn = connect_for_bulk_write()
+    start = time.perf_counter()
+    files_done = rows_done = 0
+    batch, manifest_batch = [], []
+
+    def commit():
+        nonlocal files_done, rows_done, batch, manifest_batch
+        ingested_at = datetime.datetime.now().isoformat(timespec='seconds')
+        with conn:
+            conn.executemany(artemis_mapping.insert_sql, batch)
+            conn.executemany(manifest_insert_sql, [row + (ingested_at,) for row in manifest_batch])
+        files_done += len(manifest_batch)
+        rows_done += len(batch)
+        batch, manifest_batch = [], []
+
+        elapsed = max(time.perf_counter() - start, 1e-9)
+        logging.info(f'Committed {files_done} files, {rows_done} rows ({files_done / elapsed:.1f} files/s).')
+        print(f'Committed {files_done} files, {rows_done} rows ({files_done / elapsed:.1f} files/s).')
+
+    try:
+        for filename, manifest_row, session_rows in parsed_files:
+            if manifest_row is None:
+                continue
+            batch.extend(row for row in session_rows if not artemis_mapping.is_empty(row))
+            manifest_batch.append(manifest_row)
+            if len(batch) >= batch_rows or len(manifest_batch) >= batch_files:
+                commit()
+        if manifest_batch:
+            commit()
+    finally:
+        conn.close()
+
+    return files_done, rows_done
+
+
+# Run the whole pipeline over a folder - only new or modified files are decoded
+
+def ingest_folder(folder_path, parse_func=None, max_workers=1, batch_rows=1000):
+    changed_files = iter_changed_fit_files(iter_fit_files(folder_path), load_manifest())
+    parsed_files = iter_parsed_fit_files(changed_files, parse_func, max_workers)
+    files_done, rows_done = write_parsed_fit_files(parsed_files, batch_rows)
+    logging.info(f'Ingested {files_done} files, {rows_done} session rows from {folder_path}.')
+    return files_done, rows_done
+
+
+# Long-running mode - ingest the folder, then every new .fit file within seconds of it landing in
+# the drop folder. Each file goes through the same pipeline stages as ingest_folder (manifest check,
+# decode, write). The folder snapshot is taken before the initial ingest, so files that land while it
+# runs are handed over by the watcher - the manifest skips the ones the ingest already picked up.
+
+def watch_and_ingest(folder_path, parse_func=None, settle_time=5.0, max_workers=1):
+    snapshot = folder_snapshot(folder_path)
+    ingest_folder(folder_path, parse_func=parse_func, max_workers=max_workers)
+
+    def ingest_file(fit_file_path):
+        filename = os.path.basename(fit_file_path)
+        activity_id = os.path.splitext(filename)[0].split('_')[0]  # Get everything before '_' character
+        changed_files = iter_changed_fit_files([(filename, fit_file_path, activity_id)], load_manifest(fit_file_path))
+        write_parsed_fit_files(iter_parsed_fit_files(changed_files, parse_func))
+
+    logging.info(f'Watching {folder_path} for new activities...')
+    print(f'Watching {folder_path} for new activities... (Ctrl+C to stop)')
+    try:
+        watch_folder(folder_path, ingest_file, settle_time=settle_time, snapshot=snapshot)
+    except KeyboardInterrupt:
+        logging.info('Watch stopped.')
+
+
+# Consumer for fit_dispatcher - Artemistbl_Fields rows from the single decode per file shared with
+# the fbb HRV and RunAnal plugins (bulk_insert_data_into_db skips the rows with no jHeel fields)
+
+def fit_consumers():
+    return [
+        FitConsumer('Artemistbl_Fields', ('session',),
+                    lambda activity_id, fields, index: artemis_mapping.extract(activity_id, fields.items()),
+                    bulk_insert_data_into_db,
+                    setup=create_table_if_not_exists),
+    ]
+
+
 #create view to join activities and garmin tables.
 def create_view_if_not_exists():
     # conn = sqlite3.connect('c:/users/stma/healthdata/dbs/garmin_activities.db')
     # conn = sqlite3.connect('c:/users/stma/healthdata/dbs/garmin_activities.db')
-    conn = sqlite3.connect('g:/My Drive/Phoenix/DataBasesDev/artemis.db')
+    conn = sqlite3.connect(database_path)
     cursor = conn.cursor()
 
     cursor.execute('''
@@ -307,6 +452,20 @@ def create_view_if_not_exists():
 
 # run the script as wanted - main function - jHeel artemis data
 if __name__ == "__main__":  
+    # Set up logging - only in the main process, the parse workers re-import this module
+
+    # Get the current date and time
+    now = datetime.datetime.now()
+
+    # Format it as a string
+    timestamp = now.strftime('%Y%m%d_%H%M%S')
+
+    # Include the timestamp in the log file name
+    logging.basicConfig(filename=f'c:/temp/logs/jheel_parse_Fields-v5{timestamp}.log', level=logging.INFO)
+
+    logging.info('Starting script...')
+    print('Starting script...')
+
     # create view and table
     create_table_if_not_exists()
     # create_view()
@@ -314,10 +473,17 @@ if __name__ == "__main__":
     # all_session_data = parse_all_fit_files_in_folder('c:/steliosdev/jheel_dev/devinout/testfit')
     # all_session_data = parse_all_fit_files_in_folder('c:/users/stma/healthdata/fitfiles/activitiesTEST')
     # all_session_data = parse_all_fit_files_in_folder('c:/users/stma/healthdata/fitfiles/activities2025')
-    all_session_data = parse_all_fit_files_in_folder('c:/users/djsco/healthdata/fitfiles/activities')
-    insert_data_into_db(all_session_data)
+    # all_session_data = parse_all_fit_files_in_folder('c:/users/djsco/healthdata/fitfiles/activities')
+    # only new or modified files are parsed - create_table_if_not_exists(rebuild=True) forces a full rebuild
+    folder_path = 'c:/users/djsco/healthdata/fitfiles/activities'
+    # streaming pipeline - decoded in a process pool, committed in batches with the manifest
+    # --watch keeps running and ingests new activities as the watch sync drops them in the folder
+    if '--watch' in sys.argv:
+        watch_and_ingest(folder_path, parse_func=parse_fit_file_cached, max_workers=os.cpu_count())
+    else:
+        ingest_folder(folder_path, parse_func=parse_fit_file_cached, max_workers=os.cpu_count())
     logging.info('All data inserted successfully.')
     print('All data inserted successfully.')
 
-logging.info('Script completed successfully.')
-print('Script completed successfully.')
\ No newline at end of file
+    logging.info('Script completed successfully.')
+    print('Script completed successfully.')
\ No newline at end of file
@@ -4,13 +4,18 @@ Processes heart rate variance data from FIT files using fbbbrown's Heart Monitor
 **** curently only processes HRV data from FIT files generated by the Meditate app ****
 """ ## v2.0 0 - Calculats also Recovery Score for each activity
 
+import itertools
 import logging
 import os
 import sqlite3
+import sys
 from datetime import datetime
 import pandas as pd
 import numpy as np
 from fitparse import FitFile
+from fit_watcher import folder_snapshot, watch_folder
+from fit_cache import get_decoded_fit
+from fit_session_reader import iter_fit_messages
 
 # Setup logging
 logging.basicConfig(
@@ -19,13 +24,51 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# messages read from each file in streaming mode - anything else is skipped by length
+HRV_MESSAGES = ('file_id', 'developer_data_id', 'record', 'session')
+
 class HRVProcessor:
     """Main class for processing and analyzing HRV data"""
     
     _application_id = bytearray(b'\x0b\xdc\x0eu\x9b\xaaAz\x8c\x9f\xe9vf*].')
 
-    def __init__(self, db_path='e:/jheel_dev/DataBasesDev/artemis_hrv.db'):
+    _insert_record_sql = """
+        INSERT OR IGNORE INTO hrv_recordsDEV1
+        (activity_id, record, timestamp, hrv_s, hrv_btb, hrv_hr, stress_hrp)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """
+
+    # adds the sessions matching {where} to their day's totals; x / 0 is NULL in SQLite, like AVG of no values
+    _upsert_daily_totals_sql = """
+        INSERT INTO daily_hrv_totalsDEV1
+        SELECT
+            DATE(timestamp), COUNT(*),
+            SUM(hrv_rmssd), COUNT(hrv_rmssd),
+            SUM(hrv_sdrr_f), COUNT(hrv_sdrr_f),
+            SUM(hrv_sdrr_l), COUNT(hrv_sdrr_l),
+            SUM(hrv_pnn50), COUNT(hrv_pnn50),
+            SUM(hrv_pnn20), COUNT(hrv_pnn20),
+            SUM(stress_hrpa), COUNT(stress_hrpa),
+            MIN(min_hr)
+        FROM hrv_sessionsDEV1
+        WHERE {where}
+        GROUP BY DATE(timestamp)
+        ON CONFLICT(date) DO UPDATE SET
+            sessions = sessions + excluded.sessions,
+            sum_rmssd = COALESCE(sum_rmssd, 0) + COALESCE(excluded.sum_rmssd, 0), n_rmssd = n_rmssd + excluded.n_rmssd,
+            sum_sdrr_f = COALESCE(sum_sdrr_f, 0) + COALESCE(excluded.sum_sdrr_f, 0), n_sdrr_f = n_sdrr_f + excluded.n_sdrr_f,
+            sum_sdrr_l = COALESCE(sum_sdrr_l, 0) + COALESCE(excluded.sum_sdrr_l, 0), n_sdrr_l = n_sdrr_l + excluded.n_sdrr_l,
+            sum_pnn50 = COALESCE(sum_pnn50, 0) + COALESCE(excluded.sum_pnn50, 0), n_pnn50 = n_pnn50 + excluded.n_pnn50,
+            sum_pnn20 = COALESCE(sum_pnn20, 0) + COALESCE(excluded.sum_pnn20, 0), n_pnn20 = n_pnn20 + excluded.n_pnn20,
+            sum_stress_hrpa = COALESCE(sum_stress_hrpa, 0) + COALESCE(excluded.sum_stress_hrpa, 0),
+            n_stress_hrpa = n_stress_hrpa + excluded.n_stress_hrpa,
+            lowest_hr = MIN(COALESCE(lowest_hr, excluded.lowest_hr), COALESCE(excluded.lowest_hr, lowest_hr))
+    """
+
+    def __init__(self, db_path='e:/jheel_dev/DataBasesDev/artemis_hrv.db', streaming=False):
+        # streaming=True reads each file in one pass with constant memory instead of through the FIT cache
         self.db_path = db_path
+        self.streaming = streaming
         self._init_database()
 
     def _init_database(self):
@@ -62,20 +105,52 @@ class HRVProcessor:
             )
         """)
 
+        # Materialized recovery scores - one row per session, filled by calculate_recovery_scores
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS recovery_scores (
+                activity_id TEXT PRIMARY KEY,
+                timestamp DATETIME,
+                rmssd_score REAL,
+                sdrr_score REAL,
+                pnn50_score REAL,
+                recovery_score REAL,
+                computed_at TEXT
+            )
+        """)
+
+        # Daily totals, maintained by write_session_entry - sums and counts so the averages stay exact
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS daily_hrv_totalsDEV1 (
+                date TEXT PRIMARY KEY,
+                sessions INTEGER,
+                sum_rmssd REAL, n_rmssd INTEGER,
+                sum_sdrr_f REAL, n_sdrr_f INTEGER,
+                sum_sdrr_l REAL, n_sdrr_l INTEGER,
+                sum_pnn50 REAL, n_pnn50 INTEGER,
+                sum_pnn20 REAL, n_pnn20 INTEGER,
+                sum_stress_hrpa REAL, n_stress_hrpa INTEGER,
+                lowest_hr INTEGER
+            ) WITHOUT ROWID
+        """)
+        # databases from before the totals table - aggregate the existing sessions once
+        if not cursor.execute("SELECT 1 FROM daily_hrv_totalsDEV1 LIMIT 1").fetchone():
+            cursor.execute(self._upsert_daily_totals_sql.format(where="timestamp IS NOT NULL"))
+
         # Create views
+        # the daily summary used to be a GROUP BY view over all sessions; it now reads the totals by date
+        cursor.execute("DROP VIEW IF EXISTS daily_hrv_summaryDEV1")
         cursor.execute("""
-            CREATE VIEW IF NOT EXISTS daily_hrv_summaryDEV1 AS
+            CREATE VIEW daily_hrv_summaryDEV1 AS
             SELECT 
-                DATE(timestamp) as date,
-                AVG(hrv_rmssd) as avg_rmssd,
-                AVG(hrv_sdrr_f) as avg_sdrr_f,
-                AVG(hrv_sdrr_l) as avg_sdrr_l,
-                AVG(hrv_pnn50) as avg_pnn50,
-                AVG(hrv_pnn20) as avg_pnn20,
-                AVG(stress_hrpa) as avg_stress_hrpa,
-                MIN(min_hr) as lowest_hr
-            FROM hrv_sessionsDEV1
-            GROUP BY DATE(timestamp)
+                date,
+                sum_rmssd / n_rmssd as avg_rmssd,
+                sum_sdrr_f / n_sdrr_f as avg_sdrr_f,
+                sum_sdrr_l / n_sdrr_l as avg_sdrr_l,
+                sum_pnn50 / n_pnn50 as avg_pnn50,
+                sum_pnn20 / n_pnn20 as avg_pnn20,
+                sum_stress_hrpa / n_stress_hrpa as avg_stress_hrpa,
+                lowest_hr
+            FROM daily_hrv_totalsDEV1
         """)
 
         cursor.execute("""
@@ -95,41 +170,46 @@ class HRVProcessor:
         conn.commit()
         conn.close()
 
-    def write_record_entry(self, conn, fit_file, activity_id, message_fields, record_num):
-        """Write a record message into the records DEV1 table"""
+    def record_row(self, activity_id, message_fields, record_num):
+        """Row of the records DEV1 table for one record message"""
+        return (
+            activity_id,
+            record_num,
+            # fit_file.utc_datetime_to_local(message_fields.timestamp),
+            message_fields.get('timestamp'),
+            message_fields.get('hrv_s'),
+            message_fields.get('hrv_btb'),
+            message_fields.get('hrv_hr'),
+            message_fields.get('stress_hrp')
+        )
+
+    def write_record_entries(self, conn, activity_id, records, batch_size=1000):
+        """Write the record messages of one file into the records DEV1 table
+
+        records yields the message field dicts in file order. Rows already stored are
+        skipped by the (activity_id, record) primary key, so no lookup is needed per
+        record. The caller commits once per file.
+        """
         try:
             cursor = conn.cursor()
-            
-            # Check if record exists
-            cursor.execute("""
-                SELECT 1 FROM hrv_recordsDEV1 
-                WHERE activity_id = ? AND record = ?
-            """, (activity_id, record_num))
-            
-            if not cursor.fetchone():
-                record = (
-                    activity_id,
-                    record_num,
-                    # fit_file.utc_datetime_to_local(message_fields.timestamp),
-                    message_fields.get('timestamp'),
-                    message_fields.get('hrv_s'),
-                    message_fields.get('hrv_btb'),
-                    message_fields.get('hrv_hr'),
-                    message_fields.get('stress_hrp')
-                )
-                
-                cursor.execute("""
-                    INSERT INTO hrv_recordsDEV1 
-                    (activity_id, record, timestamp, hrv_s, hrv_btb, hrv_hr, stress_hrp)
-                    VALUES (?, ?, ?, ?, ?, ?,?)
-                """, record)
-                
-                logger.debug(f"Writing HRV record for {activity_id}, record {record_num}")
-            
+            written = 0
+            batch = []
+            for record_num, message_fields in enumerate(records):
+                batch.append(self.record_row(activity_id, message_fields, record_num))
+                if len(batch) >= batch_size:
+                    cursor.executemany(self._insert_record_sql, batch)
+                    written += len(batch)
+                    batch = []
+            if batch:
+                cursor.executemany(self._insert_record_sql, batch)
+                written += len(batch)
+
+            logger.debug(f"Writing {written} HRV records for {activity_id}")
             return True
-            
+
         except Exception as e:
-            logger.error(f"Error writing record entry: {e}")
+            logger.error(f"Error writing record entries: {e}")
+            conn.rollback()
             return False
 
     def write_session_entry(self, conn, fit_file, activity_id, message_fields):
@@ -163,6 +243,9 @@ class HRVProcessor:
                      hrv_sdrr_l, hrv_pnn50, hrv_pnn20, stress_hrpa)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """, session)
+                # add the new session to its day in the same transaction
+                cursor.execute(self._upsert_daily_totals_sql.format(
+                    where="activity_id = ? AND timestamp IS NOT NULL"), (activity_id,))
                 
                 logger.debug(f"Writing HRV session for {activity_id}")
             
@@ -172,39 +255,99 @@ class HRVProcessor:
             logger.error(f"Error writing session entry: {e}")
             return False
 
+    def is_hrv_activity(self, header_messages):
+        """True when the messages ahead of the first record name the fbb Monitor+HRV app"""
+        for name, fields in header_messages:
+            if name == 'developer_data_id' and tuple(fields.get('application_id') or ()) == tuple(self._application_id):
+                return True
+            # file_id field 110 is not in the FIT profile - fitparse and fit_session_reader name it unknown_110
+            if name == 'file_id' and fields.get('unknown_110') == "F3b Monitor+HRV":
+                return True
+        return False
+
     def process_fit_file(self, fit_file_path):
         """Process a single FIT file"""
+        if self.streaming:
+            return self.process_fit_file_streaming(fit_file_path)
+        try:
+            # decoded messages come from the shared FIT cache - decoded once for all parsers;
+            # every file is processed here, only the streaming mode skips non-HRV activities early
+            fit_file = get_decoded_fit(fit_file_path)
+
+            conn = sqlite3.connect(self.db_path)
+            try:
+                activity_id = os.path.basename(fit_file_path)
+                
+                # all records of the file go in with executemany, in the same transaction as its session
+                if not self.write_record_entries(conn, activity_id, fit_file.messages('record')):
+                    logger.error(f"Skipping {fit_file_path} - its records were not written")
+                    return False
+                for fields_dict in fit_file.messages('session'):
+                    if not self.write_session_entry(conn, fit_file, activity_id, fields_dict):
+                        conn.rollback()
+                        logger.error(f"Skipping {fit_file_path} - its session was not written")
+                        return False
+                
+                conn.commit()
+                logger.info(f"Successfully processed {fit_file_path}")
+                return True
+                
+            except Exception as e:
+                logger.error(f"Error processing file {fit_file_path}: {e}")
+                return False
+                
+            finally:
+                conn.close()
+
+        except Exception as e:
+            logger.error(f"Error opening file {fit_file_path}: {e}")
+            return False
+
+    def process_fit_file_streaming(self, fit_file_path):
+        """Process a single FIT file in one streaming pass
+
+        file_id and developer_data_id come before the first record, so a non-HRV activity
+        is skipped without decoding its records. The records of an HRV activity go straight
+        from the reader into the batched writer, so memory stays flat for overnight recordings.
+        """
         try:
-            fit_file = FitFile(fit_file_path)
+            messages = iter_fit_messages(fit_file_path, HRV_MESSAGES)
             
-            # Check if this is an HRV activity by looking for field 110
-            messages = list(fit_file.messages)
-            is_hrv_activity = True
-            for message in messages:
-                if message.name == 'file_id':
-                    fields_dict = {field.name: field.value for field in message.fields}
-                    app_name = fields_dict.get('field 110')  # or field number 110
-                    if app_name == "F3b Monitor+HRV":
-                        is_hrv_activity = True
+            # Check if this is an HRV activity from the messages ahead of the first record
+            header_messages = []
+            first_message = None
+            for name, fields_dict in messages:
+                if name in ('record', 'session'):
+                    first_message = (name, fields_dict)
                     break
+                header_messages.append((name, fields_dict))
                     
-            if not is_hrv_activity:
+            if not self.is_hrv_activity(header_messages):
+                messages.close()
                 logger.info(f"Skipping {fit_file_path} - not an HRV activity")
                 return False
 
             conn = sqlite3.connect(self.db_path)
             try:
-                record_num = 0
                 activity_id = os.path.basename(fit_file_path)
+                sessions = []
+
+                def record_fields():
+                    # sessions are few - they are kept aside and written after the records
+                    for name, fields_dict in itertools.chain([first_message] if first_message else [], messages):
+                        if name == 'record':
+                            yield fields_dict
+                        elif name == 'session':
+                            sessions.append(fields_dict)
                 
-                for message in messages:
-                    if message.name == 'record':
-                        fields_dict = {field.name: field.value for field in message.fields}
-                        self.write_record_entry(conn, fit_file, activity_id, fields_dict, record_num)
-                        record_num += 1
-                    elif message.name == 'session':
-                        fields_dict = {field.name: field.value for field in message.fields}
-                        self.write_session_entry(conn, fit_file, activity_id, fields_dict)
+                if not self.write_record_entries(conn, activity_id, record_fields()):
+                    logger.error(f"Skipping {fit_file_path} - its records were not written")
+                    return False
+                for fields_dict in sessions:
+                    if not self.write_session_entry(conn, None, activity_id, fields_dict):
+                        conn.rollback()
+                        logger.error(f"Skipping {fit_file_path} - its session was not written")
+                        return False
                 
                 conn.commit()
                 logger.info(f"Successfully processed {fit_file_path}")
@@ -291,10 +434,64 @@ class HRVProcessor:
                 return None
         return None
 
+    def calculate_recovery_scores(self, incremental=True):
+        """Score all sessions at once and store them in the recovery_scores table
+
+        The sessions are read in one query and scored column-wise with the formula of
+        calculate_recovery_score. With incremental=True only sessions that have no stored
+        score yet are read. Sessions missing rmssd, sdrr_l or pnn50 are stored with a NULL
+        score, so they are not read again. Returns activity_id and recovery_score of the
+        sessions scored in this call.
+        """
+        conn = sqlite3.connect(self.db_path)
+        try:
+            query = """
+                SELECT s.activity_id, s.timestamp, s.hrv_rmssd, s.hrv_sdrr_l, s.hrv_pnn50
+                FROM hrv_sessionsDEV1 s
+            """
+            if incremental:
+                query += """
+                LEFT JOIN recovery_scores r ON r.activity_id = s.activity_id
+                WHERE r.activity_id IS NULL
+                """
+            df = pd.read_sql_query(query, conn)
+            if df.empty:
+                logger.info("No new sessions to score")
+                return df.reindex(columns=['activity_id', 'recovery_score'])
+
+            rmssd = pd.to_numeric(df['hrv_rmssd'], errors='coerce')
+            sdrr_l = pd.to_numeric(df['hrv_sdrr_l'], errors='coerce')
+            pnn50 = pd.to_numeric(df['hrv_pnn50'], errors='coerce')
+            df['rmssd_score'] = np.minimum(100, rmssd / 2)
+            df['sdrr_score'] = np.minimum(100, sdrr_l / 2)
+            df['pnn50_score'] = pnn50
+            # NaN in any component leaves the score NaN - insufficient data
+            df['recovery_score'] = ((df['rmssd_score'] + df['sdrr_score'] + df['pnn50_score']) / 3).round(2)
+            df['computed_at'] = datetime.now().isoformat(timespec='seconds')
+
+            columns = ['activity_id', 'timestamp', 'rmssd_score', 'sdrr_score', 'pnn50_score',
+                       'recovery_score', 'computed_at']
+            rows = df[columns].astype(object).where(df[columns].notna(), None).itertuples(index=False, name=None)
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO recovery_scores ({', '.join(columns)})
+                VALUES ({', '.join('?' * len(columns))})
+            """, rows)
+            conn.commit()
+            logger.info(f"Stored recovery scores for {len(df)} sessions")
+            return df[['activity_id', 'recovery_score']]
+
+        except Exception as e:
+            logger.error(f"Error calculating recovery scores: {e}")
+            conn.rollback()
+            return None
 
-def process_activities_folder(folder_path):
+        finally:
+            conn.close()
+
+
+def process_activities_folder(folder_path, streaming=False):
     """Process all FIT files in the specified folder"""
-    processor = HRVProcessor()
+    processor = HRVProcessor(streaming=streaming)
     
     if not os.path.exists(folder_path):
         logger.error(f"Folder {folder_path} does not exist")
@@ -308,26 +505,51 @@ def process_activities_folder(folder_path):
     
     return processor
 
+def watch_activities_folder(folder_path, processor=None, settle_time=5.0, snapshot=None):
+    """Long-running mode - process each new FIT file as soon as it lands in the folder
+
+    snapshot (fit_watcher.folder_snapshot) taken before an initial process_activities_folder
+    hands over the files that landed while it ran.
+    """
+    processor = processor or HRVProcessor()
+    
+    if not os.path.exists(folder_path):
+        logger.error(f"Folder {folder_path} does not exist")
+        return
+    
+    logger.info(f"Watching {folder_path} for new HRV activities (Ctrl+C to stop)")
+    try:
+        watch_folder(folder_path, processor.process_fit_file, settle_time=settle_time, snapshot=snapshot)
+    except KeyboardInterrupt:
+        logger.info("Watch stopped")
+    
+    return processor
+
 def main():
     # Process activities from the test folder
-    processor = process_activities_folder('c:/users/stma/healthdata/fitfiles/activities')
+    # --stream reads each file in one constant-memory pass (long overnight recordings) instead of the FIT cache
+    folder_path = 'c:/users/stma/healthdata/fitfiles/activities'
+    # the watch baseline is taken before the folder pass, so files synced during it are not missed
+    snapshot = folder_snapshot(folder_path) if '--watch' in sys.argv and os.path.exists(folder_path) else None
+    processor = process_activities_folder(folder_path, streaming='--stream' in sys.argv)
     # processor = process_activities_folder('c:/users/stma/healthdata/fitfiles/activities2025')
     
     if processor:
-        # Connect to database to get activity IDs
+        # Score the sessions added since the last run (--rescore rescores all), then read all stored scores in one query
+        processor.calculate_recovery_scores(incremental='--rescore' not in sys.argv)
         conn = sqlite3.connect(processor.db_path)
         cursor = conn.cursor()
-        
-        # Get all activity IDs
-        cursor.execute("SELECT activity_id FROM hrv_sessionsDEV1")
+        cursor.execute("""
+            SELECT s.activity_id, r.recovery_score
+            FROM hrv_sessionsDEV1 s
+            LEFT JOIN recovery_scores r ON r.activity_id = s.activity_id
+        """)
         activities = cursor.fetchall()
         conn.close()
         
         # Print recovery scores for each activity
         print("\nRecovery Scores:")
-        for activity in activities:
-            activity_id = activity[0]
-            recovery_score = processor.calculate_recovery_score(activity_id)
+        for activity_id, recovery_score in activities:
             if recovery_score is not None:
                 print(f"Activity {activity_id}: Recovery Score = {recovery_score}")
             else:
@@ -341,6 +563,10 @@ def main():
                 print(f"{metric}: {value:.2f}")
         else:
             print("No HRV data available for analysis")
+    
+    # --watch keeps running and processes new activities as they are synced
+    if '--watch' in sys.argv:
+        watch_activities_folder(folder_path, processor, snapshot=snapshot)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -4,6 +4,19 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime
 import sqlite3
+from hrv_baseline import update_baseline, readiness
+
+# metric columns of the latest record stored per analysis run
+LATEST_METRICS = ('sd1', 'sd2', 'sdnn', 'mean_rr', 'mean_hr', 'hrv_rmssd', 'pnn50', 'vlf', 'lf', 'hf',
+                  'lf_nu', 'hf_nu', 'sd2_sd1_ratio', 'lf_hf_ratio')
+
+# analyze_hrv_status categories and their hrv_analysis_statusHRV columns
+STATUS_COLUMNS = {
+    'Autonomic Balance': 'autonomic_balance',
+    'Stress Level': 'stress_level',
+    'Recovery Status': 'recovery_status',
+    'HRV Baseline': 'hrv_baseline',
+}
 
 class EnhancedHRVAnalysis:
     def __init__(self):
@@ -12,36 +25,31 @@ class EnhancedHRVAnalysis:
         self.load_data_from_db()
     
     def create_analysis_tables(self):
-        """Create tables for storing analysis results if they don't exist"""
+        """Create the typed result tables (one row per analysis run, history kept) and the dashboard view"""
         try:
             conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
             
-            # Create table for latest records
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS hrv_latest_recordsHRV (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    analysis_date TIMESTAMP,
-                    metric_name TEXT,
-                    metric_value TEXT  -- Changed to TEXT to handle all types
-                )
+            # Latest record - one wide row per run
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS hrv_analysis_latestHRV (
+                    analysis_date TEXT PRIMARY KEY,
+                    record_date TEXT,
+                    {', '.join(f'{metric} REAL' for metric in LATEST_METRICS)}
+                ) WITHOUT ROWID
             """)
             
-            # Create table for HRV status analysis
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS hrv_status_analysisHRV (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    analysis_date TIMESTAMP,
-                    category TEXT,
-                    status TEXT
-                )
+            # HRV status - one column per category
+            conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS hrv_analysis_statusHRV (
+                    analysis_date TEXT PRIMARY KEY,
+                    {', '.join(f'{column} TEXT' for column in STATUS_COLUMNS.values())}
+                ) WITHOUT ROWID
             """)
             
-            # Create table for summary statistics
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS hrv_summary_statsHRV (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    analysis_date TIMESTAMP,
+            # Summary statistics - one row per metric and run
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS hrv_analysis_statsHRV (
+                    analysis_date TEXT,
                     metric TEXT,
                     count REAL,
                     mean REAL,
@@ -50,117 +58,71 @@ class EnhancedHRVAnalysis:
                     q25 REAL,
                     q50 REAL,
                     q75 REAL,
-                    max REAL
-                )
+                    max REAL,
+                    PRIMARY KEY (analysis_date, metric)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_hrv_analysis_stats_metric "
+                         "ON hrv_analysis_statsHRV (metric, analysis_date)")
+            
+            # Dashboard: latest record and status of every run, newest first by the analysis_date keys
+            conn.execute("""
+                CREATE VIEW IF NOT EXISTS hrv_analysis_dashboardHRV AS
+                SELECT l.*, s.autonomic_balance, s.stress_level, s.recovery_status, s.hrv_baseline
+                FROM hrv_analysis_latestHRV l
+                LEFT JOIN hrv_analysis_statusHRV s ON s.analysis_date = l.analysis_date
             """)
             
             conn.commit()
         except sqlite3.Error as e:
             print(f"Error creating tables: {e}")
         finally:
-            if conn:
+            if 'conn' in locals():
                 conn.close()
 
-    def store_latest_records(self):
-        """Store the latest record values in the database"""
+    def store_analysis_results(self):
+        """Store the latest record, the HRV status and the summary statistics of this run in one transaction
+        
+        Earlier runs are kept - every table is keyed by analysis_date.
+        """
         if self.hrv_log is None or self.hrv_log.empty:
             return
-            
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            latest = self.hrv_log.iloc[-1]
-            analysis_date = datetime.now()
-            
-            # Clear previous entries
-            cursor.execute("DELETE FROM hrv_latest_recordsHRV")
-            
-            # Store new entries
-            for column in latest.index:
-                # Handle different data types
-                if column == 'date':
-                    value = str(latest[column])  # Store date as string
-                else:
-                    # For numerical values
-                    value = float(latest[column]) if pd.notnull(latest[column]) else None
-                    
-                cursor.execute("""
-                    INSERT INTO hrv_latest_recordsHRV (analysis_date, metric_name, metric_value)
-                    VALUES (?, ?, ?)
-                """, (analysis_date, column, value))
-                
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error storing latest records: {e}")
-        except ValueError as e:
-            print(f"Value conversion error: {e}")
-        finally:
-            if conn:
-                conn.close()
-
-    def store_hrv_status(self):
-        """Store HRV status analysis in the database"""
-        try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            status = self.analyze_hrv_status()
-            analysis_date = datetime.now()
-            
-            # Clear previous entries
-            cursor.execute("DELETE FROM hrv_status_analysisHRV")
-            
-            # Store new entries
-            for category, status_value in status.items():
-                cursor.execute("""
-                    INSERT INTO hrv_status_analysisHRV (analysis_date, category, status)
-                    VALUES (?, ?, ?)
-                """, (analysis_date, category, status_value))
-                
-            conn.commit()
-        except sqlite3.Error as e:
-            print(f"Error storing HRV status: {e}")
-        finally:
-            if conn:
-                conn.close()
-
-    def store_summary_stats(self):
-        """Store summary statistics in the database"""
+        
+        analysis_date = datetime.now().isoformat(timespec='seconds')
+        
+        latest = self.hrv_log.iloc[-1]
+        latest_row = [analysis_date, str(latest['date'])] + [
+            float(latest[metric]) if metric in latest.index and pd.notnull(latest[metric]) else None
+            for metric in LATEST_METRICS
+        ]
+        
+        status = self.analyze_hrv_status()
+        status_row = [analysis_date] + [status.get(category) for category in STATUS_COLUMNS]
+        
+        stats = self.generate_summary_stats().T[['count', 'mean', 'std', 'min', '25%', '50%', '75%', 'max']]
+        stats = stats.astype(object).where(stats.notna(), None)
+        stats_rows = [(analysis_date, metric, *values) for metric, values in zip(stats.index, stats.values.tolist())]
+        
         try:
             conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            summary_stats = self.generate_summary_stats()
-            analysis_date = datetime.now()
-            
-            # Clear previous entries
-            cursor.execute("DELETE FROM hrv_summary_statsHRV")
-            
-            # Store new entries
-            for metric in summary_stats.columns:
-                cursor.execute("""
-                    INSERT INTO hrv_summary_statsHRV 
+            with conn:
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO hrv_analysis_latestHRV
+                    VALUES ({', '.join('?' * len(latest_row))})
+                """, latest_row)
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO hrv_analysis_statusHRV
+                    VALUES ({', '.join('?' * len(status_row))})
+                """, status_row)
+                conn.executemany("""
+                    INSERT OR REPLACE INTO hrv_analysis_statsHRV
                     (analysis_date, metric, count, mean, std, min, q25, q50, q75, max)
                     VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                """, (
-                    analysis_date,
-                    metric,
-                    float(summary_stats[metric]['count']),
-                    float(summary_stats[metric]['mean']),
-                    float(summary_stats[metric]['std']),
-                    float(summary_stats[metric]['min']),
-                    float(summary_stats[metric]['25%']),
-                    float(summary_stats[metric]['50%']),
-                    float(summary_stats[metric]['75%']),
-                    float(summary_stats[metric]['max'])
-                ))
-                
-            conn.commit()
+                """, stats_rows)
         except sqlite3.Error as e:
-            print(f"Error storing summary statistics: {e}")
+            print(f"Error storing analysis results: {e}")
         finally:
-            if conn:
+            if 'conn' in locals():
                 conn.close()
     
     def load_data_from_db(self):
@@ -192,6 +154,9 @@ class EnhancedHRVAnalysis:
             self.hrv_log['sd2_sd1_ratio'] = self.hrv_log['sd2'] / self.hrv_log['sd1']
             self.hrv_log['lf_hf_ratio'] = self.hrv_log['lf'] / self.hrv_log['hf']
             
+            # add the new nights to the lnRMSSD baseline (hrv_baseline.py)
+            update_baseline(self.db_path, 'hrv_sessionsFBB')
+            
         except sqlite3.Error as e:
             print(f"Error connecting to database: {e}")
         finally:
@@ -290,6 +255,17 @@ class EnhancedHRVAnalysis:
             
         latest = self.hrv_log.iloc[-1]
         
+        # 7-day lnRMSSD against the athlete's 60-day normal range - one keyed read of hrv_baseline
+        try:
+            conn = sqlite3.connect(self.db_path)
+            baseline = readiness(conn, str(latest['date']))
+        except sqlite3.Error as e:
+            print(f"Error reading HRV baseline: {e}")
+            baseline = None
+        finally:
+            if 'conn' in locals():
+                conn.close()
+        
         # Handle potential NULL/None values with safe comparisons
         analysis = {
             'Autonomic Balance': 'Balanced' if (
@@ -311,6 +287,12 @@ class EnhancedHRVAnalysis:
             ) else 'Needs Improvement'
         }
         
+        # the fixed RMSSD threshold is only used until the baseline has enough nights
+        if baseline is not None and baseline['status'] != 'building baseline':
+            analysis['Recovery Status'] = 'Needs Improvement' if baseline['status'] == 'below normal' else 'Good'
+        if baseline is not None:
+            analysis['HRV Baseline'] = baseline['status']
+        
         return analysis
 
     def generate_summary_stats(self):
@@ -330,25 +312,25 @@ def main():
     hrv_analysis.create_analysis_tables()
    
    
-    # Print and store the latest record values
+    # Print the latest record values
     if hrv_analysis.hrv_log is not None and not hrv_analysis.hrv_log.empty:
         latest = hrv_analysis.hrv_log.iloc[-1]
         print("\nLatest record values:")
         for column in latest.index:
             print(f"{column}: {latest[column]}")
-        hrv_analysis.store_latest_records()
     
-    # Generate, print and store HRV status analysis
+    # Generate and print HRV status analysis
     status = hrv_analysis.analyze_hrv_status()
     print("\nHRV Status Analysis:")
     for key, value in status.items():
         print(f"{key}: {value}")
-    hrv_analysis.store_hrv_status()
     
-    # Generate, print and store summary statistics
+    # Generate and print summary statistics
     print("\nSummary Statistics:")
     print(hrv_analysis.generate_summary_stats())
-    hrv_analysis.store_summary_stats()
+    
+    # Store all results of this run together
+    hrv_analysis.store_analysis_results()
     
     # Generate visualizations
     hrv_analysis.visualize_comprehensive_hrv()
@@ -0,0 +1,260 @@
+"""Content-addressed cache of decoded FIT files shared by the jHeel parsers.
+
+Several scripts decode the same activity archive with fitparse.  ``FitCache``
+decodes a file once and stores the result under the SHA-1 of its content, so
+every later run - of any parser - loads the decoded messages instead of paying
+the fitparse cost again.  A renamed or copied file hits the same entry, and a
+modified file gets a new one.
+
+Each entry is a single ``.npz`` file:
+
+* ``record`` messages are stored column-wise as typed arrays (int64, float64,
+  datetime64 for timestamps), with a mask of the None values and a mask of the
+  messages that carry the field, so ``messages('record')`` gives back the same
+  dicts as fitparse - ints as ints, None as None;
+* every other message type (session, file_id, field_description, ...) is
+  stored as a small JSON table, in file order.
+
+The cache directory defaults to ``~/.jheel/fit_cache`` and can be moved with
+the ``JHEEL_FIT_CACHE`` environment variable so all scripts share one cache.
+"""
+
+import datetime
+import hashlib
+import io
+import json
+import logging
+import os
+import zipfile
+
+import numpy as np
+from fitparse import FitFile
+
+
+logger = logging.getLogger(__file__)
+
+
+CACHE_VERSION = 2
+DEFAULT_CACHE_DIR = os.environ.get('JHEEL_FIT_CACHE', os.path.join(os.path.expanduser('~'), '.jheel', 'fit_cache'))
+
+
+def content_hash(data):
+    """SHA-1 hex digest of the raw file content - the cache key."""
+    return hashlib.sha1(data).hexdigest()
+
+
+def _encode_json(value):
+    if isinstance(value, datetime.datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, datetime.time):
+        return {'__time__': value.isoformat()}
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': bytes(value).hex()}
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f'Cannot store {type(value).__name__} in the FIT cache')
+
+
+def _decode_json(obj):
+    if '__datetime__' in obj:
+        return datetime.datetime.fromisoformat(obj['__datetime__'])
+    if '__time__' in obj:
+        return datetime.time.fromisoformat(obj['__time__'])
+    if '__bytes__' in obj:
+        return bytes.fromhex(obj['__bytes__'])
+    return obj
+
+
+def _to_column(values):
+    """Turn one record field into a typed array, or None when it is not numeric/timestamp.
+
+    None values are stored as 0 / NaN / NaT - the validity mask tells them apart.
+    """
+    kinds = {type(v) for v in values if v is not None}
+    if not kinds:
+        return None
+    if kinds <= {int, bool}:
+        return np.array([0 if v is None else v for v in values], dtype=np.int64)
+    if kinds <= {int, float, bool}:
+        return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+    if kinds == {datetime.datetime}:
+        return np.array(['NaT' if v is None else v for v in values], dtype='datetime64[us]')
+    return None
+
+
+def _mask(flags):
+    """Bool array of flags, or None when every flag is set - the common case is not stored."""
+    mask = np.array(flags, dtype=bool)
+    return None if mask.all() else mask
+
+
+def _to_python(value):
+    """Array element back to the plain Python value fitparse would have produced."""
+    if isinstance(value, np.datetime64):
+        return value.astype('datetime64[us]').astype(datetime.datetime)
+    if isinstance(value, np.floating):
+        return float(value)
+    if isinstance(value, np.integer):
+        return int(value)
+    return value
+
+
+class DecodedFit:
+    """Decoded messages of one FIT file, as stored in the cache."""
+
+    def __init__(self, records, tables, valid=None, present=None):
+        # records: {field_name: ndarray or list}, all of the same length
+        # tables: {message_name: [{field_name: value}, ...]} for every other message type
+        # valid / present: {field_name: bool array} - the value is not None / the message has the
+        # field; a field without a mask is valid / present in every record
+        self.records = records
+        self.tables = tables
+        self.valid = valid or {}
+        self.present = present or {}
+
+    @property
+    def record_count(self):
+        return len(next(iter(self.records.values()))) if self.records else 0
+
+    @property
+    def sessions(self):
+        return self.tables.get('session', [])
+
+    @property
+    def file_id(self):
+        file_ids = self.tables.get('file_id', [])
+        return file_ids[0] if file_ids else {}
+
+    def messages(self, name):
+        """Iterate {field_name: value} dicts for one message type, like fitparse's msg.fields."""
+        if name != 'record':
+            yield from self.tables.get(name, [])
+            return
+        columns = [(field_name, column, self.valid.get(field_name), self.present.get(field_name))
+                   for field_name, column in self.records.items()]
+        for i in range(self.record_count):
+            fields = {}
+            for field_name, column, valid, present in columns:
+                if present is not None and not present[i]:
+                    continue
+                fields[field_name] = None if valid is not None and not valid[i] else _to_python(column[i])
+            yield fields
+
+    @classmethod
+    def from_fit_data(cls, data):
+        """Decode raw FIT content with fitparse."""
+        fit_file = FitFile(data)
+        record_rows = []
+        tables = {}
+        for msg in fit_file.get_messages():
+            fields = {field.name: field.value for field in msg.fields}
+            if msg.name == 'record':
+                record_rows.append(fields)
+            else:
+                tables.setdefault(msg.name, []).append(fields)
+
+        names = []
+        for fields in record_rows:
+            for field_name in fields:
+                if field_name not in names:
+                    names.append(field_name)
+
+        records, valid, present = {}, {}, {}
+        for field_name in names:
+            values = [fields.get(field_name) for fields in record_rows]
+            column = _to_column(values)
+            records[field_name] = column if column is not None else values
+            masks = ((valid, [v is not None for v in values]),
+                     (present, [field_name in fields for fields in record_rows]))
+            for masks_by_field, flags in masks:
+                mask = _mask(flags)
+                if mask is not None:
+                    masks_by_field[field_name] = mask
+        return cls(records, tables, valid, present)
+
+    def to_bytes(self):
+        arrays = {'version': np.array(CACHE_VERSION)}
+        extra_records = {}
+        for field_name, column in self.records.items():
+            if isinstance(column, np.ndarray):
+                arrays[f'record/{field_name}'] = column
+            else:
+                extra_records[field_name] = column
+        for field_name, mask in self.valid.items():
+            arrays[f'record_valid/{field_name}'] = mask
+        for field_name, mask in self.present.items():
+            arrays[f'record_present/{field_name}'] = mask
+        arrays['record_extra'] = np.array(json.dumps(extra_records, default=_encode_json))
+        arrays['record_order'] = np.array(json.dumps(list(self.records)))
+        arrays['tables'] = np.array(json.dumps(self.tables, default=_encode_json))
+        buffer = io.BytesIO()
+        np.savez(buffer, **arrays)
+        return buffer.getvalue()
+
+    @classmethod
+    def from_file(cls, path):
+        with np.load(path, allow_pickle=False) as npz:
+            if int(npz['version']) != CACHE_VERSION:
+                raise ValueError(f'Cache entry {path} has an old format version')
+            extra_records = json.loads(str(npz['record_extra']), object_hook=_decode_json)
+            records, valid, present = {}, {}, {}
+            for field_name in json.loads(str(npz['record_order'])):
+                key = f'record/{field_name}'
+                records[field_name] = npz[key] if key in npz.files else extra_records[field_name]
+                if f'record_valid/{field_name}' in npz.files:
+                    valid[field_name] = npz[f'record_valid/{field_name}']
+                if f'record_present/{field_name}' in npz.files:
+                    present[field_name] = npz[f'record_present/{field_name}']
+            tables = json.loads(str(npz['tables']), object_hook=_decode_json)
+        return cls(records, tables, valid, present)
+
+
+class FitCache:
+    """Decode each distinct FIT file once; serve every later request from disk."""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or DEFAULT_CACHE_DIR
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], f'{digest}.v{CACHE_VERSION}.npz')
+
+    def get(self, fit_file_path):
+        """Return the DecodedFit for a file, decoding and storing it on a cache miss."""
+        with open(fit_file_path, 'rb') as f:
+            data = f.read()
+        digest = content_hash(data)
+        path = self.entry_path(digest)
+
+        if os.path.exists(path):
+            try:
+                decoded = DecodedFit.from_file(path)
+                self.hits += 1
+                return decoded
+            except (OSError, ValueError, KeyError, zipfile.BadZipFile) as e:
+                logger.warning("Discarding unreadable cache entry %s: %s", path, e)
+
+        decoded = DecodedFit.from_fit_data(data)
+        self.misses += 1
+        self._store(path, decoded)
+        logger.debug("Cached %s as %s", fit_file_path, digest)
+        return decoded
+
+    def _store(self, path, decoded):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(decoded.to_bytes())
+        os.replace(tmp_path, path)
+
+
+_default_cache = None
+
+
+def get_decoded_fit(fit_file_path):
+    """Shortcut used by the parsers - one FitCache per process on the default directory."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FitCache()
+    return _default_cache.get(fit_file_path)
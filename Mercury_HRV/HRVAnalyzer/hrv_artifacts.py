@@ -0,0 +1,289 @@
+"""
+RR artifact and ectopic beat correction for the stored beat-to-beat intervals.
+
+The watch app reports Ectopic-S, Long and Short counts per session, but the hrv_btb
+stream in hrv_records is stored as received - missed beats, extra beats and premature
+beats all go into the metrics. This stage cleans the RR series of every activity:
+
+    1. missing       - NULL or outside MIN_RR_MS..MAX_RR_MS
+    2. median filter - each beat is compared to the median of the MEDIAN_WIDTH beats around it;
+                       more than MEDIAN_TOLERANCE below it is short, above it is long
+    3. percent change - a beat that changes by more than PCT_CHANGE from both neighbours in
+                       opposite directions is a spike (short or long by its sign); a short beat
+                       followed by a long one, both by more than PCT_CHANGE, is an ectopic
+                       beat with its compensatory pause - both are flagged ectopic
+    4. flagged beats are replaced by linear interpolation between the nearest good beats
+       of the same activity
+
+Like hrv_metrics, many activities are processed at once: the series are concatenated
+with a group index and every step is a vectorized NumPy operation over the batch.
+The cleaned series goes into hrv_rr_clean (one row per beat with its flag) and the
+counts per activity into hrv_artifact_stats.
+"""
+
+import logging
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+from hrv_metrics import MIN_RR_MS, MAX_RR_MS
+
+logger = logging.getLogger(__name__)
+
+MEDIAN_WIDTH = 11
+MEDIAN_TOLERANCE = 0.2
+PCT_CHANGE = 0.2
+
+# beat flags stored in hrv_rr_clean
+FLAG_OK = 0
+FLAG_MISSING = 1
+FLAG_SHORT = 2
+FLAG_LONG = 3
+FLAG_ECTOPIC = 4
+
+# rows of the median filter index matrix built at once - bounds the memory of long batches
+MEDIAN_CHUNK = 500000
+
+
+def create_artifact_tables(conn):
+    """Create the hrv_rr_clean and hrv_artifact_stats tables"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_rr_clean (
+            activity_id TEXT,
+            source TEXT,
+            record INTEGER,
+            rr_clean REAL,
+            flag INTEGER,
+            PRIMARY KEY (activity_id, source, record)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_artifact_stats (
+            activity_id TEXT,
+            source TEXT,
+            n_beats INTEGER,
+            n_missing INTEGER,
+            n_short INTEGER,
+            n_long INTEGER,
+            n_ectopic INTEGER,
+            artifact_pct REAL,
+            computed_at TEXT,
+            PRIMARY KEY (activity_id, source)
+        )
+    """)
+    conn.commit()
+
+
+def group_bounds(groups):
+    """First and one-past-last index of the group of every element (groups non-decreasing)"""
+    groups = np.asarray(groups, dtype=np.int64)
+    n = len(groups)
+    starts = np.flatnonzero(np.r_[True, groups[1:] != groups[:-1]])
+    ends = np.r_[starts[1:], n]
+    lengths = ends - starts
+    return np.repeat(starts, lengths), np.repeat(ends, lengths)
+
+
+def fill_gaps(rr, valid, groups):
+    """Linear interpolation of the invalid elements from the nearest valid ones of the same group
+
+    Elements before the first or after the last valid one of a group take that value;
+    groups without any valid element stay NaN.
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    n = len(rr)
+    position = np.arange(n)
+    previous = np.maximum.accumulate(np.where(valid, position, -1))
+    following = np.minimum.accumulate(np.where(valid, position, n)[::-1])[::-1]
+
+    start, end = group_bounds(groups)
+    has_previous = previous >= start
+    has_following = following < end
+    previous_value = rr[np.clip(previous, 0, n - 1)]
+    following_value = rr[np.clip(following, 0, n - 1)]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        weight = (position - previous) / (following - previous)
+        between = previous_value + weight * (following_value - previous_value)
+    filled = np.where(has_previous & has_following, between,
+                      np.where(has_previous, previous_value,
+                               np.where(has_following, following_value, np.nan)))
+    return np.where(valid, rr, filled)
+
+
+def grouped_median_filter(rr, groups, width=MEDIAN_WIDTH):
+    """Running median of width beats centred on each beat, not crossing group boundaries
+
+    At the edges of a group the window is padded with the group's first / last beat.
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    start, end = group_bounds(groups)
+    offsets = np.arange(width) - width // 2
+    median = np.empty(len(rr))
+    for lo in range(0, len(rr), MEDIAN_CHUNK):
+        hi = min(lo + MEDIAN_CHUNK, len(rr))
+        index = np.arange(lo, hi)[:, None] + offsets
+        index = np.clip(index, start[lo:hi, None], end[lo:hi, None] - 1)
+        median[lo:hi] = np.median(rr[index], axis=1)
+    return median
+
+
+def detect_artifacts(rr, groups):
+    """Flag every beat of a concatenated RR series - returns an int8 array of FLAG_* values"""
+    rr = np.asarray(rr, dtype=np.float64)
+    groups = np.asarray(groups, dtype=np.int64)
+    n = len(rr)
+    flags = np.zeros(n, dtype=np.int8)
+
+    missing = np.isnan(rr) | (rr < MIN_RR_MS) | (rr > MAX_RR_MS)
+    flags[missing] = FLAG_MISSING
+    # the filters below look at a series with the missing beats bridged
+    bridged = fill_gaps(rr, ~missing, groups)
+
+    median = grouped_median_filter(bridged, groups)
+    with np.errstate(invalid='ignore'):
+        deviation = (bridged - median) / median
+    short = deviation < -MEDIAN_TOLERANCE
+    long = deviation > MEDIAN_TOLERANCE
+
+    # relative change to the previous beat of the same group (0 at the first beat)
+    change = np.zeros(n)
+    same_group = groups[1:] == groups[:-1]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        change[1:] = np.where(same_group, np.diff(bridged) / bridged[:-1], 0.0)
+    change_next = np.r_[change[1:], 0.0]
+    # change_next is relative to this beat - the thresholds are converted so the beat differs from
+    # the next one by more than PCT_CHANGE of the next beat
+    drop_in = change < -PCT_CHANGE
+    rise_in = change > PCT_CHANGE
+    rise_out = change_next > PCT_CHANGE / (1 - PCT_CHANGE)
+    drop_out = change_next < -PCT_CHANGE / (1 + PCT_CHANGE)
+    short |= drop_in & rise_out
+    long |= rise_in & drop_out
+
+    # premature beat and its compensatory pause: short beat, then a long one
+    ectopic = short & np.r_[long[1:] & same_group, False]
+    ectopic |= np.r_[False, ectopic[:-1]]
+
+    flags[~missing & short] = FLAG_SHORT
+    flags[~missing & long] = FLAG_LONG
+    flags[~missing & ectopic] = FLAG_ECTOPIC
+    return flags
+
+
+def clean_rr(rr, groups):
+    """Artifact-corrected RR series and the beat flags of a concatenated batch"""
+    flags = detect_artifacts(rr, groups)
+    return fill_gaps(rr, flags == FLAG_OK, groups), flags
+
+
+def artifact_counts(flags, groups, n_groups):
+    """Per-group beat and artifact counts - {name: array of n_groups}"""
+    counts = {'n_beats': np.bincount(groups, minlength=n_groups)}
+    for name, flag in (('n_missing', FLAG_MISSING), ('n_short', FLAG_SHORT), ('n_long', FLAG_LONG),
+                       ('n_ectopic', FLAG_ECTOPIC)):
+        counts[name] = np.bincount(groups, weights=flags == flag, minlength=n_groups).astype(np.int64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        counts['artifact_pct'] = 100 * np.bincount(groups, weights=flags != FLAG_OK, minlength=n_groups) \
+            / counts['n_beats']
+    return counts
+
+
+def iter_raw_batches(conn, records_table='hrv_records', column='hrv_btb', activity_ids=None, batch_activities=500):
+    """Yield (activity_ids, records, rr, groups) for batches of activities, NULL intervals as NaN
+
+    Unlike hrv_metrics.iter_rr_batches nothing is dropped - the record numbers of the
+    cleaned series line up with records_table.
+    """
+    query = f"SELECT activity_id, record, {column} FROM {records_table}"
+    params = []
+    if activity_ids is not None:
+        activity_ids = list(activity_ids)
+        if not activity_ids:
+            return
+        query += f" WHERE activity_id IN ({', '.join('?' * len(activity_ids))})"
+        params = activity_ids
+    query += " ORDER BY activity_id, record"
+
+    def batch():
+        return (batch_ids, np.array(batch_records, dtype=np.int64),
+                np.array(batch_rr, dtype=np.float64), np.array(batch_groups, dtype=np.int64))
+
+    cursor = conn.execute(query, params)
+    batch_ids, batch_records, batch_rr, batch_groups = [], [], [], []
+    current = None
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        for activity_id, record, value in rows:
+            if activity_id != current:
+                if len(batch_ids) == batch_activities:
+                    yield batch()
+                    batch_ids, batch_records, batch_rr, batch_groups = [], [], [], []
+                batch_ids.append(activity_id)
+                current = activity_id
+            batch_records.append(record)
+            batch_rr.append(np.nan if value is None else value)
+            batch_groups.append(len(batch_ids) - 1)
+    if batch_ids:
+        yield batch()
+
+
+def iter_clean_series(conn, records_table='hrv_records', column='hrv_btb', activity_ids=None, batch_activities=500):
+    """Yield lists of (activity_id, rr) per batch - the artifact-corrected series without the beats left NaN"""
+    for batch_ids, records, rr, groups in iter_raw_batches(conn, records_table, column, activity_ids,
+                                                           batch_activities):
+        cleaned, _ = clean_rr(rr, groups)
+        bounds = np.flatnonzero(np.diff(groups)) + 1
+        yield [(activity_id, series[np.isfinite(series)])
+               for activity_id, series in zip(batch_ids, np.split(cleaned, bounds))]
+
+
+def correct_artifacts(db_path, records_table='hrv_records', column='hrv_btb', activity_ids=None,
+                      batch_activities=500):
+    """Clean the RR series of every activity (or of activity_ids) and store the series and the artifact counts
+
+    Returns the number of activities processed.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        create_artifact_tables(conn)
+        computed_at = datetime.now().isoformat(timespec='seconds')
+        activities = 0
+        for batch_ids, records, rr, groups in iter_raw_batches(conn, records_table, column, activity_ids,
+                                                               batch_activities):
+            cleaned, flags = clean_rr(rr, groups)
+            counts = artifact_counts(flags, groups, len(batch_ids))
+
+            ids = np.array(batch_ids, dtype=object)[groups]
+            cleaned = np.round(cleaned, 1).astype(object)
+            cleaned[np.isnan(cleaned.astype(np.float64))] = None
+            conn.executemany("DELETE FROM hrv_rr_clean WHERE activity_id = ? AND source = ?",
+                             [(activity_id, column) for activity_id in batch_ids])
+            conn.executemany("INSERT INTO hrv_rr_clean VALUES (?, ?, ?, ?, ?)",
+                             zip(ids.tolist(), [column] * len(ids), records.tolist(), cleaned.tolist(),
+                                 flags.tolist()))
+
+            columns = [counts[name].tolist() for name in
+                       ('n_beats', 'n_missing', 'n_short', 'n_long', 'n_ectopic', 'artifact_pct')]
+            conn.executemany("INSERT OR REPLACE INTO hrv_artifact_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             [(activity_id, column, *values, computed_at)
+                              for activity_id, values in zip(batch_ids, zip(*columns))])
+            conn.commit()
+            activities += len(batch_ids)
+            logger.info(f"Artifact correction done for {activities} activities")
+        return activities
+    finally:
+        conn.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    activities = correct_artifacts('e:/jheel_dev/DataBasesDev/artemis_hrv.db')
+    print(f"RR artifacts corrected for {activities} activities")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+"""
+Per-athlete HRV baseline and normal range - readiness for any date with one keyed read.
+
+For every night with sessions in hrv_sessionsFBB the hrv_baseline table holds:
+
+    ln_rmssd        mean ln(RMSSD) of the night's sessions
+    baseline_7d     7-day rolling mean of ln_rmssd
+    cv_7d           coefficient of variation (%) of ln_rmssd over the same 7 days
+    normal_mean     60-day mean of ln_rmssd, and normal_sd its standard deviation
+    normal_low/high the normal band: normal_mean -/+ NORMAL_BAND_SD * normal_sd
+    status          baseline_7d below / within / above the band, or 'building baseline'
+                    while the 60 days hold fewer than MIN_NORMAL_NIGHTS nights
+
+Windows are calendar days (time_rolling.DailyRolling). update_baseline only reads the
+sessions not processed yet: the nights from the earliest new one onward are recomputed
+with the stored nights of the 59 days before it, so a daily refresh touches a handful
+of rows. Rows are keyed (athlete, date) in a WITHOUT ROWID table - readiness() is a
+single index lookup.
+"""
+
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from time_rolling import DailyRolling
+
+logger = logging.getLogger(__name__)
+
+BASELINE_DAYS = 7
+NORMAL_DAYS = 60
+NORMAL_BAND_SD = 0.5
+MIN_NORMAL_NIGHTS = 14
+
+BASELINE_COLUMNS = ('n_sessions', 'ln_rmssd', 'baseline_7d', 'cv_7d', 'normal_mean', 'normal_sd',
+                    'normal_low', 'normal_high', 'status')
+
+
+def create_baseline_tables(conn):
+    """Create the hrv_baseline table and the list of sessions it includes"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_baseline (
+            athlete TEXT,
+            date TEXT,
+            n_sessions INTEGER,
+            ln_rmssd REAL,
+            baseline_7d REAL,
+            cv_7d REAL,
+            normal_mean REAL,
+            normal_sd REAL,
+            normal_low REAL,
+            normal_high REAL,
+            status TEXT,
+            computed_at TEXT,
+            PRIMARY KEY (athlete, date)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_baseline_sessions (
+            athlete TEXT,
+            activity_id TEXT,
+            PRIMARY KEY (athlete, activity_id)
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+
+def baseline_rows(dates, ln_rmssd, n_sessions):
+    """Baseline columns (BASELINE_COLUMNS order) of consecutive nights - one entry per night"""
+    rolling = DailyRolling(dates, pd.DataFrame({'ln_rmssd': ln_rmssd}))
+    baseline = rolling.window(f'{BASELINE_DAYS}D', 'mean')['ln_rmssd'].to_numpy()
+    baseline_sd = rolling.window(f'{BASELINE_DAYS}D', 'std')['ln_rmssd'].to_numpy()
+    normal_mean = rolling.window(f'{NORMAL_DAYS}D', 'mean')['ln_rmssd'].to_numpy()
+    normal_sd = rolling.window(f'{NORMAL_DAYS}D', 'std')['ln_rmssd'].to_numpy()
+    normal_nights = rolling.window(f'{NORMAL_DAYS}D', 'count')['ln_rmssd'].to_numpy()
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        cv = 100 * baseline_sd / baseline
+    low = normal_mean - NORMAL_BAND_SD * normal_sd
+    high = normal_mean + NORMAL_BAND_SD * normal_sd
+    building = normal_nights < MIN_NORMAL_NIGHTS
+    status = np.where(building, 'building baseline',
+                      np.where(baseline < low, 'below normal',
+                               np.where(baseline > high, 'above normal', 'within normal')))
+
+    def column(values):
+        return [None if v != v else round(v, 4) for v in values.tolist()]
+
+    low, high = np.where(building, np.nan, low), np.where(building, np.nan, high)
+    # ln_rmssd is kept unrounded - later updates recompute the windows from the stored nights
+    return list(zip(np.asarray(n_sessions).tolist(), np.asarray(ln_rmssd, dtype=float).tolist(), column(baseline),
+                    column(cv), column(normal_mean), column(normal_sd), column(low), column(high), status.tolist()))
+
+
+def update_baseline(db_path, sessions_table='hrv_sessionsFBB', athlete='default'):
+    """Add the sessions not included yet to the athlete's baseline
+
+    Returns the number of nights (re)computed.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        create_baseline_tables(conn)
+        new_sessions = conn.execute(f"""
+            SELECT s.activity_id, DATE(s.date) FROM {sessions_table} s
+            LEFT JOIN hrv_baseline_sessions b ON b.athlete = ? AND b.activity_id = s.activity_id
+            WHERE b.activity_id IS NULL AND s.hrv_rmssd > 0
+        """, (athlete,)).fetchall()
+        if not new_sessions:
+            return 0
+
+        # every night from the earliest new one is recomputed, on top of the stored nights before it
+        start = min(day for _, day in new_sessions)
+        history_start = (datetime.strptime(start, '%Y-%m-%d') - timedelta(days=NORMAL_DAYS - 1)).strftime('%Y-%m-%d')
+        history = pd.read_sql_query("""
+            SELECT date, ln_rmssd, n_sessions FROM hrv_baseline
+            WHERE athlete = ? AND date >= ? AND date < ?
+        """, conn, params=(athlete, history_start, start))
+
+        sessions = pd.read_sql_query(f"""
+            SELECT DATE(date) AS date, hrv_rmssd FROM {sessions_table}
+            WHERE DATE(date) >= ? AND hrv_rmssd > 0
+        """, conn, params=(start,))
+        sessions['ln_rmssd'] = np.log(sessions['hrv_rmssd'].astype(float))
+        nights = sessions.groupby('date')['ln_rmssd'].agg(['mean', 'count']).reset_index()
+        nights.columns = ['date', 'ln_rmssd', 'n_sessions']
+
+        nights = pd.concat([history, nights], ignore_index=True).sort_values('date', ignore_index=True)
+        rows = baseline_rows(pd.to_datetime(nights['date']), nights['ln_rmssd'].to_numpy(dtype=float),
+                             nights['n_sessions'].to_numpy())
+        computed_at = datetime.now().isoformat(timespec='seconds')
+        updated = [(athlete, date) + row + (computed_at,)
+                   for date, row in zip(nights['date'].tolist(), rows) if date >= start]
+
+        conn.executemany(f"""
+            INSERT OR REPLACE INTO hrv_baseline (athlete, date, {', '.join(BASELINE_COLUMNS)}, computed_at)
+            VALUES ({', '.join('?' * (len(BASELINE_COLUMNS) + 3))})
+        """, updated)
+        conn.executemany("INSERT OR IGNORE INTO hrv_baseline_sessions VALUES (?, ?)",
+                         [(athlete, activity_id) for activity_id, _ in new_sessions])
+        conn.commit()
+        logger.info(f"Baseline updated for {len(updated)} nights from {start} ({len(new_sessions)} new sessions)")
+        return len(updated)
+    finally:
+        conn.close()
+
+
+def readiness(conn, date=None, athlete='default'):
+    """Baseline row of the last night on or before date (default: the latest) as a dict, or None"""
+    date = date or '9999-12-31'
+    if not isinstance(date, str):
+        date = date.strftime('%Y-%m-%d')
+    cursor = conn.execute(f"""
+        SELECT date, {', '.join(BASELINE_COLUMNS)} FROM hrv_baseline
+        WHERE athlete = ? AND date <= ?
+        ORDER BY date DESC LIMIT 1
+    """, (athlete, date[:10]))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_path = 'e:/jheel_dev/DataBasesDev/artemis_hrv.db'
+    nights = update_baseline(db_path)
+    print(f"Baseline updated for {nights} nights")
+    conn = sqlite3.connect(db_path)
+    try:
+        print(readiness(conn))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""
+Hash-cached process-pool loop shared by the per-activity HRV engines.
+
+hrv_spectral, hrv_dfa and hrv_entropy store one result per activity with the SHA-1 of
+the RR series it was computed from (plus the engine's settings). compute_changed hashes
+every series of a batch, sends only the activities whose hash changed to the engine's
+worker in chunks over a process pool, and hands the worker's rows to the engine's
+writer. Every batch is committed, so an interrupted run keeps what it computed.
+"""
+
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def series_hash(rr, settings):
+    """Cache key of an RR series - its content plus the settings string of the engine"""
+    return hashlib.sha1(np.ascontiguousarray(rr, dtype=np.float64).tobytes() + settings.encode()).hexdigest()
+
+
+def compute_changed(conn, batches, settings, cached, worker, write_rows, max_workers=None, chunk_size=10,
+                    name='metrics'):
+    """Run worker over a process pool for the activities whose RR series changed
+
+    batches yields lists of (activity_id, rr); an activity is skipped when
+    series_hash(rr, settings) equals cached[activity_id]. worker gets chunks of
+    (activity_id, rr_hash, rr) and returns a list of rows, which write_rows(conn, rows)
+    stores. Every batch is committed. Returns the number of rows written.
+    """
+    computed = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for batch in batches:
+            pending = []
+            for activity_id, series in batch:
+                digest = series_hash(series, settings)
+                if cached.get(activity_id) != digest:
+                    pending.append((activity_id, digest, series))
+            if not pending:
+                continue
+
+            futures = [executor.submit(worker, pending[i:i + chunk_size])
+                       for i in range(0, len(pending), chunk_size)]
+            for future in as_completed(futures):
+                rows = future.result()
+                write_rows(conn, rows)
+                computed += len(rows)
+            conn.commit()
+            logger.info(f"Computed {name} for {computed} activities")
+    return computed
@@ -0,0 +1,243 @@
+"""
+DFA alpha1 engine - aerobic / anaerobic threshold heart rate from in-run beat-to-beat intervals.
+
+Detrended fluctuation analysis over rolling 2 minute windows of the RR series
+(hrv_btb or RRint in hrv_records), every 5 seconds:
+
+    1. the series is artifact-corrected (hrv_artifacts.clean_rr) - DFA is very sensitive
+       to missed and ectopic beats
+    2. profile = cumulative sum of the RR deviations
+    3. for every box of n beats (n = 4..16) the profile is detrended by a least-squares
+       line; F(n) = RMS of the residuals over the boxes of the window
+    4. alpha1 = slope of log F(n) against log n
+
+The least-squares fit of a box does not change when a line is added to the profile,
+so one profile of the whole activity serves every window. The residual sum of squares
+of every box of every length is computed at once from cumulative sums over a
+sliding view of the profile; the boxes of a window are then summed with per-scale
+strided prefix sums. A whole run takes milliseconds instead of a polyfit per box.
+
+alpha1 falls with intensity: 0.75 marks the aerobic threshold (HRVT1), 0.5 the
+anaerobic threshold (HRVT2). A line fitted to alpha1 against the window heart rate
+gives the heart rate at both values.
+
+The alpha1 series is stored in hrv_dfa and the thresholds in hrv_dfa_thresholds, with
+a hash of each activity's RR series so a rerun only computes changed activities.
+"""
+
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+from hrv_artifacts import iter_clean_series
+from hrv_cache import compute_changed
+
+logger = logging.getLogger(__name__)
+
+WINDOW_S = 120
+STEP_S = 5
+MIN_SCALE = 4
+MAX_SCALE = 16
+# windows with fewer beats are skipped - 4 boxes of the largest scale
+MIN_WINDOW_BEATS = 4 * MAX_SCALE
+
+AEROBIC_ALPHA1 = 0.75
+ANAEROBIC_ALPHA1 = 0.5
+# windows used for the threshold fit, and the heart rate spread the fit needs
+FIT_ALPHA1_RANGE = (0.25, 1.5)
+MIN_FIT_HR_SPAN = 15
+# hashed with every RR series - a change of settings recomputes the cached activities
+DFA_SETTINGS = f'{WINDOW_S}|{STEP_S}|{MIN_SCALE}|{MAX_SCALE}'
+
+
+def create_dfa_tables(conn):
+    """Create the hrv_dfa (alpha1 series) and hrv_dfa_thresholds tables"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_dfa (
+            activity_id TEXT,
+            source TEXT,
+            t_s INTEGER,
+            n_beats INTEGER,
+            mean_hr REAL,
+            alpha1 REAL,
+            PRIMARY KEY (activity_id, source, t_s)
+        ) WITHOUT ROWID
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_dfa_thresholds (
+            activity_id TEXT,
+            source TEXT,
+            rr_hash TEXT,
+            start_time TEXT,
+            n_windows INTEGER,
+            slope REAL,
+            r2 REAL,
+            hrvt1_hr REAL,
+            hrvt2_hr REAL,
+            computed_at TEXT,
+            PRIMARY KEY (activity_id, source)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS hrv_dfa_thresholds_start ON hrv_dfa_thresholds (start_time)")
+    conn.commit()
+
+
+def box_residuals(profile, max_scale=MAX_SCALE):
+    """Residual sum of squares of the least-squares line through every box of the profile
+
+    Returns ss of shape (len(profile), max_scale): ss[p, n - 1] is the residual of the box
+    profile[p:p + n]; NaN where the box runs past the end.
+    """
+    profile = np.asarray(profile, dtype=np.float64)
+    padded = np.r_[profile, np.full(max_scale - 1, np.nan)]
+    boxes = sliding_window_view(padded, max_scale)
+    # relative to the first point of the box - small numbers for the sums of squares
+    y = boxes - boxes[:, :1]
+    k = np.arange(max_scale, dtype=np.float64)
+    n = k + 1
+
+    # running sums along the box give every box length at once
+    s_y = np.cumsum(y, axis=1)
+    s_yy = np.cumsum(y * y, axis=1)
+    s_ky = np.cumsum(k * y, axis=1)
+    s_k = np.cumsum(k)
+    s_kk = np.cumsum(k * k)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sxx = s_kk - s_k * s_k / n
+        sxy = s_ky - s_k * s_y / n
+        syy = s_yy - s_y * s_y / n
+        ss = syy - sxy * sxy / sxx
+    return np.clip(ss, 0, None)
+
+
+def window_bounds(rr, window_s=WINDOW_S, step_s=STEP_S):
+    """(t_s, lo, hi) of the windows of beats ending in (t - window_s, t], every step_s seconds"""
+    beat_end = np.cumsum(rr) / 1000.0
+    t_s = np.arange(window_s, beat_end[-1] + 1e-9, step_s, dtype=np.float64)
+    lo = np.searchsorted(beat_end, t_s - window_s, side='right')
+    hi = np.searchsorted(beat_end, t_s, side='right')
+    return t_s, lo, hi
+
+
+def dfa_alpha1(rr, window_s=WINDOW_S, step_s=STEP_S, min_scale=MIN_SCALE, max_scale=MAX_SCALE):
+    """Rolling DFA alpha1 of one RR series (ms)
+
+    Returns (t_s, n_beats, mean_hr, alpha1) arrays, one entry per window; alpha1 is NaN
+    for windows with fewer than MIN_WINDOW_BEATS beats.
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    empty = np.empty(0)
+    if len(rr) < MIN_WINDOW_BEATS or rr.sum() / 1000.0 < window_s:
+        return empty, np.empty(0, dtype=np.int64), empty, empty
+
+    t_s, lo, hi = window_bounds(rr, window_s, step_s)
+    n_beats = hi - lo
+    prefix = np.r_[0.0, np.cumsum(rr)]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_hr = 60000.0 * n_beats / (prefix[hi] - prefix[lo])
+
+    profile = np.cumsum(rr - rr.mean())
+    ss = box_residuals(profile, max_scale)
+
+    scales = np.arange(min_scale, max_scale + 1)
+    log_scales = np.log10(scales)
+    weights = (log_scales - log_scales.mean()) / ((log_scales - log_scales.mean()) ** 2).sum()
+
+    log_f = np.empty((len(t_s), len(scales)))
+    for i, n in enumerate(scales):
+        # strided prefix sums: cum[p] = ss[p] + ss[p - n] + ss[p - 2n] + ...
+        column = np.nan_to_num(ss[:, n - 1])
+        pad = -len(column) % n
+        cum = np.cumsum(np.r_[column, np.zeros(pad)].reshape(-1, n), axis=0).ravel()
+        boxes = n_beats // n
+        last = lo + (boxes - 1) * n
+        with np.errstate(invalid='ignore', divide='ignore'):
+            total = cum[np.clip(last, 0, None)] - np.where(lo >= n, cum[np.clip(lo - n, 0, None)], 0.0)
+            log_f[:, i] = 0.5 * np.log10(total / (boxes * n))
+
+    alpha1 = log_f @ weights
+    alpha1[n_beats < MIN_WINDOW_BEATS] = np.nan
+    return t_s, n_beats, mean_hr, alpha1
+
+
+def threshold_hr(mean_hr, alpha1):
+    """Heart rate at alpha1 = 0.75 and 0.5 from a line fitted to alpha1 against heart rate
+
+    Returns (n_windows, slope, r2, hrvt1_hr, hrvt2_hr); the heart rates are None when the
+    run does not cover enough intensities or alpha1 does not fall with heart rate.
+    """
+    mask = np.isfinite(alpha1) & np.isfinite(mean_hr) & \
+        (alpha1 >= FIT_ALPHA1_RANGE[0]) & (alpha1 <= FIT_ALPHA1_RANGE[1])
+    hr, alpha = mean_hr[mask], alpha1[mask]
+    n_windows = int(mask.sum())
+    if n_windows < 3 or hr.max() - hr.min() < MIN_FIT_HR_SPAN:
+        return n_windows, None, None, None, None
+
+    slope, intercept = np.polyfit(hr, alpha, 1)
+    residual = alpha - (slope * hr + intercept)
+    total = ((alpha - alpha.mean()) ** 2).sum()
+    r2 = float(1 - (residual ** 2).sum() / total) if total > 0 else None
+    if slope >= 0:
+        return n_windows, float(slope), r2, None, None
+    return (n_windows, float(slope), r2,
+            float((AEROBIC_ALPHA1 - intercept) / slope), float((ANAEROBIC_ALPHA1 - intercept) / slope))
+
+
+def dfa_chunk(items):
+    """Process pool worker - [(activity_id, digest, rr), ...] -> [(activity_id, digest, series rows, thresholds), ...]"""
+    results = []
+    for activity_id, digest, rr in items:
+        try:
+            t_s, n_beats, mean_hr, alpha1 = dfa_alpha1(rr)
+            series = [(int(round(t)), n, round(hr, 1), round(a, 4))
+                      for t, n, hr, a in zip(t_s.tolist(), n_beats.tolist(), mean_hr.tolist(), alpha1.tolist())
+                      if a == a]
+            results.append((activity_id, digest, series, threshold_hr(mean_hr, alpha1)))
+        except Exception as e:
+            logger.error(f"Error computing DFA alpha1 for {activity_id}: {e}")
+    return results
+
+
+def compute_dfa(db_path, records_table='hrv_records', column='hrv_btb', max_workers=None, chunk_size=10):
+    """Compute the alpha1 series and thresholds of every changed activity
+
+    Activities whose RR series hash matches hrv_dfa_thresholds are not recomputed.
+    Returns the number of activities computed.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        create_dfa_tables(conn)
+        cached = dict(conn.execute("SELECT activity_id, rr_hash FROM hrv_dfa_thresholds WHERE source = ?", (column,)))
+        start_times = dict(conn.execute(f"SELECT activity_id, MIN(timestamp) FROM {records_table} GROUP BY activity_id"))
+        computed_at = datetime.now().isoformat(timespec='seconds')
+
+        def write_rows(conn, rows):
+            for activity_id, digest, series, thresholds in rows:
+                conn.execute("DELETE FROM hrv_dfa WHERE activity_id = ? AND source = ?", (activity_id, column))
+                conn.executemany("INSERT INTO hrv_dfa VALUES (?, ?, ?, ?, ?, ?)",
+                                 [(activity_id, column) + row for row in series])
+                conn.execute("INSERT OR REPLACE INTO hrv_dfa_thresholds VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                             (activity_id, column, digest, start_times.get(activity_id)) + thresholds
+                             + (computed_at,))
+
+        return compute_changed(conn, iter_clean_series(conn, records_table, column), DFA_SETTINGS, cached,
+                               dfa_chunk, write_rows, max_workers, chunk_size, 'DFA alpha1')
+    finally:
+        conn.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_path = 'e:/jheel_dev/DataBasesDev/artemis_hrv.db'
+    for column in ('hrv_btb', 'RRint'):
+        computed = compute_dfa(db_path, column=column, max_workers=os.cpu_count())
+        print(f"hrv_records.{column}: DFA alpha1 computed for {computed} activities")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,250 @@
+"""
+HRV metrics engine - time-domain and Poincare metrics from the stored beat-to-beat intervals.
+
+The hrv_sessions tables keep RMSSD, SDNN, pNN50, ... as the watch app reported them,
+which differs between app versions. This engine recomputes them from the raw RR series
+in hrv_records (hrv_btb or RRint), the same way for every activity:
+
+    mean_rr, sdnn, rmssd, sdsd, nn50, pnn50, nn20, pnn20, sd1, sd2, mean_hr
+
+Many activities are processed in one batch: their RR series are concatenated into one
+array with a group index, and every metric is a handful of np.bincount reductions over
+that array - no Python loop per activity or per window. Metrics are computed for the
+whole session (window_s = 0) and for fixed windows of beat time (e.g. 60s, 300s), and
+stored in the hrv_metrics table.
+"""
+
+import logging
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# RR intervals outside this range (ms) are not beats - dropouts, zero padding, sensor noise
+MIN_RR_MS = 250
+MAX_RR_MS = 2500
+
+METRIC_COLUMNS = ('n_beats', 'mean_rr', 'sdnn', 'rmssd', 'sdsd', 'nn50', 'pnn50', 'nn20', 'pnn20',
+                  'sd1', 'sd2', 'mean_hr')
+
+
+def create_metrics_table(conn):
+    """Create the hrv_metrics table - one row per activity, RR source and window"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_metrics (
+            activity_id TEXT,
+            source TEXT,
+            window_s INTEGER,
+            window_index INTEGER,
+            start_s REAL,
+            n_beats INTEGER,
+            mean_rr REAL,
+            sdnn REAL,
+            rmssd REAL,
+            sdsd REAL,
+            nn50 INTEGER,
+            pnn50 REAL,
+            nn20 INTEGER,
+            pnn20 REAL,
+            sd1 REAL,
+            sd2 REAL,
+            mean_hr REAL,
+            computed_at TEXT,
+            PRIMARY KEY (activity_id, source, window_s, window_index)
+        )
+    """)
+    conn.commit()
+
+
+def grouped_metrics(rr, groups, n_groups):
+    """Time-domain and Poincare metrics of every group of a concatenated RR series
+
+    rr is a float array of intervals in ms, groups the group index of each interval
+    (non-decreasing, consecutive intervals of a group are consecutive beats).
+    Returns {metric: array of n_groups}; metrics of groups too short to define them are NaN.
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    groups = np.asarray(groups, dtype=np.int64)
+
+    n = np.bincount(groups, minlength=n_groups).astype(np.float64)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_rr = np.bincount(groups, weights=rr, minlength=n_groups) / n
+        # two-pass variance - subtract the group mean first, stable for long recordings
+        deviation = rr - mean_rr[groups]
+        sdnn = np.sqrt(np.bincount(groups, weights=deviation * deviation, minlength=n_groups) / (n - 1))
+
+        # successive differences, only between beats of the same group
+        same_group = groups[1:] == groups[:-1]
+        diff = np.diff(rr)[same_group]
+        diff_groups = groups[1:][same_group]
+        n_diff = np.bincount(diff_groups, minlength=n_groups).astype(np.float64)
+        mean_diff = np.bincount(diff_groups, weights=diff, minlength=n_groups) / n_diff
+        rmssd = np.sqrt(np.bincount(diff_groups, weights=diff * diff, minlength=n_groups) / n_diff)
+        diff_deviation = diff - mean_diff[diff_groups]
+        sdsd = np.sqrt(np.bincount(diff_groups, weights=diff_deviation * diff_deviation, minlength=n_groups)
+                       / (n_diff - 1))
+        sdsd[n_diff < 2] = np.nan
+
+        abs_diff = np.abs(diff)
+        nn50 = np.bincount(diff_groups, weights=abs_diff > 50, minlength=n_groups)
+        nn20 = np.bincount(diff_groups, weights=abs_diff > 20, minlength=n_groups)
+        pnn50 = 100 * nn50 / n_diff
+        pnn20 = 100 * nn20 / n_diff
+
+        # Poincare descriptors from SDSD and SDNN
+        sd1 = np.sqrt(0.5) * sdsd
+        sd2 = np.sqrt(np.clip(2 * sdnn * sdnn - 0.5 * sdsd * sdsd, 0, None))
+        mean_hr = 60000 / mean_rr
+
+    return {
+        'n_beats': n.astype(np.int64),
+        'mean_rr': mean_rr,
+        'sdnn': sdnn,
+        'rmssd': rmssd,
+        'sdsd': sdsd,
+        'nn50': nn50.astype(np.int64),
+        'pnn50': pnn50,
+        'nn20': nn20.astype(np.int64),
+        'pnn20': pnn20,
+        'sd1': sd1,
+        'sd2': sd2,
+        'mean_hr': mean_hr,
+    }
+
+
+def window_groups(rr, activity_groups, window_s):
+    """Split each activity into windows of window_s seconds of beat time
+
+    Returns (groups, keys): the window group of every interval and, per window group,
+    (activity group, window index, start second).
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    activity_groups = np.asarray(activity_groups, dtype=np.int64)
+
+    # start time of each beat since the start of its activity - cumulative sum restarted at each activity
+    beat_start = np.cumsum(rr) / 1000.0 - rr / 1000.0
+    starts = np.flatnonzero(np.r_[True, activity_groups[1:] != activity_groups[:-1]])
+    beat_start -= np.repeat(beat_start[starts], np.diff(np.r_[starts, len(rr)]))
+
+    window_index = (beat_start // window_s).astype(np.int64)
+
+    # both indexes are non-decreasing, so a new group starts wherever either one changes
+    new_group = np.r_[True, (activity_groups[1:] != activity_groups[:-1]) | (window_index[1:] != window_index[:-1])]
+    groups = np.cumsum(new_group) - 1
+    first = np.flatnonzero(new_group)
+    keys = list(zip(activity_groups[first].tolist(), window_index[first].tolist(),
+                    (window_index[first] * float(window_s)).tolist()))
+    return groups, keys
+
+
+def compute_metrics(activity_ids, rr, activity_groups, windows=(0,)):
+    """Metric rows for a batch of activities, for the whole session (0) and every window length in windows"""
+    rows = []
+    if len(rr) == 0:
+        return rows
+
+    n_activities = len(activity_ids)
+    for window_s in windows:
+        if window_s:
+            groups, keys = window_groups(rr, activity_groups, window_s)
+        else:
+            groups = activity_groups
+            keys = [(a, 0, 0.0) for a in range(n_activities)]
+
+        metrics = grouped_metrics(rr, groups, len(keys))
+        columns = [metrics[name].tolist() for name in METRIC_COLUMNS]
+        for (activity_group, window_index, start_s), values in zip(keys, zip(*columns)):
+            if values[0] == 0:
+                continue
+            # NaN (metric undefined for too few beats) is stored as NULL
+            values = [None if v != v else v for v in values]
+            rows.append((activity_ids[activity_group], window_s, window_index, start_s, *values))
+    return rows
+
+
+def iter_rr_batches(conn, records_table='hrv_records', column='hrv_btb', activity_ids=None, batch_activities=500):
+    """Yield (activity_ids, rr, groups) for batches of activities, read in record order
+
+    Intervals outside MIN_RR_MS..MAX_RR_MS are dropped.
+    """
+    query = f"""
+        SELECT activity_id, {column} FROM {records_table}
+        WHERE {column} BETWEEN ? AND ?
+    """
+    params = [MIN_RR_MS, MAX_RR_MS]
+    if activity_ids is not None:
+        activity_ids = list(activity_ids)
+        if not activity_ids:
+            return
+        query += f" AND activity_id IN ({', '.join('?' * len(activity_ids))})"
+        params += activity_ids
+    query += " ORDER BY activity_id, record"
+
+    cursor = conn.execute(query, params)
+    batch_ids, batch_rr, batch_groups = [], [], []
+    current = None
+    while True:
+        rows = cursor.fetchmany(100000)
+        if not rows:
+            break
+        for activity_id, value in rows:
+            if activity_id != current:
+                if len(batch_ids) == batch_activities:
+                    yield batch_ids, np.array(batch_rr, dtype=np.float64), np.array(batch_groups, dtype=np.int64)
+                    batch_ids, batch_rr, batch_groups = [], [], []
+                batch_ids.append(activity_id)
+                current = activity_id
+            batch_rr.append(value)
+            batch_groups.append(len(batch_ids) - 1)
+    if batch_ids:
+        yield batch_ids, np.array(batch_rr, dtype=np.float64), np.array(batch_groups, dtype=np.int64)
+
+
+def split_batch(batch_ids, rr, groups):
+    """Per-activity RR arrays of a batch from iter_rr_batches"""
+    bounds = np.flatnonzero(np.diff(groups)) + 1
+    return list(zip(batch_ids, np.split(rr, bounds)))
+
+
+def recompute_metrics(db_path, records_table='hrv_records', column='hrv_btb', windows=(0, 60, 300),
+                      activity_ids=None, batch_activities=500):
+    """Recompute and store the metrics of every activity (or of activity_ids) from the RR series in records_table"""
+    conn = sqlite3.connect(db_path)
+    try:
+        create_metrics_table(conn)
+        computed_at = datetime.now().isoformat(timespec='seconds')
+        insert = f"""
+            INSERT OR REPLACE INTO hrv_metrics
+            (activity_id, window_s, window_index, start_s, {', '.join(METRIC_COLUMNS)}, source, computed_at)
+            VALUES ({', '.join('?' * (len(METRIC_COLUMNS) + 6))})
+        """
+        activities = 0
+        rows_written = 0
+        for batch_ids, rr, groups in iter_rr_batches(conn, records_table, column, activity_ids, batch_activities):
+            rows = compute_metrics(batch_ids, rr, groups, windows)
+            conn.executemany(insert, [row + (column, computed_at) for row in rows])
+            conn.commit()
+            activities += len(batch_ids)
+            rows_written += len(rows)
+            logger.info(f"Computed HRV metrics for {activities} activities ({rows_written} rows)")
+        return activities
+    finally:
+        conn.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_path = 'e:/jheel_dev/DataBasesDev/artemis_hrv.db'
+    # beat-to-beat intervals of the fbb plugin records; RRint carries the same series from newer app versions
+    for records_table, column in (('hrv_records', 'hrv_btb'), ('hrv_records', 'RRint'), ('hrv_recordsDEV1', 'hrv_btb')):
+        try:
+            activities = recompute_metrics(db_path, records_table, column)
+            print(f"{records_table}.{column}: metrics recomputed for {activities} activities")
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Skipping {records_table}.{column}: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,179 @@
+"""
+Sliding-window RMSSD / SDNN over beat streams - 30s, 60s and 5 min windows.
+
+The fbb plugin stores the device's own hrvrmssd30s per record. This module computes
+rolling RMSSD and SDNN from the beat-to-beat intervals for any window length, without
+recomputing each window from scratch (O(n*w)):
+
+* SlidingWindowHRV keeps running sums of RR, RR^2 and squared successive differences
+  for the beats of the last window_s seconds. Each new beat is added and the beats that
+  fell out of the window are evicted by time - O(1) amortized per beat, for live/in-run use.
+* rolling_hrv computes the same windows for a whole recording at once: prefix sums of the
+  same quantities, and np.searchsorted on the beat times for the eviction boundary.
+  A whole night of beats takes a few milliseconds.
+
+The windowed series are stored, sampled every step_s seconds, in the compact
+hrv_rolling table (one row per activity, window and time step, WITHOUT ROWID).
+"""
+
+import logging
+import math
+import sqlite3
+from collections import deque
+
+import numpy as np
+
+from hrv_metrics import iter_rr_batches, split_batch
+
+logger = logging.getLogger(__name__)
+
+WINDOWS_S = (30, 60, 300)
+STEP_S = 5
+
+
+class SlidingWindowHRV:
+    """Streaming RMSSD / SDNN of the beats in the last window_s seconds"""
+
+    def __init__(self, window_s):
+        self.window_s = window_s
+        self.beats = deque()        # (end time s, rr - reference, squared difference to the previous beat)
+        self.time = 0.0
+        self.reference = None       # first RR - sums are kept around it to limit cancellation
+        self.previous = None
+        self.sum_rr = 0.0
+        self.sum_rr2 = 0.0
+        # squared successive differences of the beats after the first one in the window
+        self.sum_diff2 = 0.0
+
+    def push(self, rr):
+        """Add one RR interval (ms) and return (rmssd, sdnn) of the current window"""
+        if self.reference is None:
+            self.reference = rr
+        self.time += rr / 1000.0
+        value = rr - self.reference
+        diff2 = 0.0 if self.previous is None else (rr - self.previous) ** 2
+        self.previous = rr
+
+        if self.beats:
+            self.sum_diff2 += diff2
+        self.beats.append((self.time, value, diff2))
+        self.sum_rr += value
+        self.sum_rr2 += value * value
+
+        # evict by time - the beats that ended before the window start
+        while self.beats and self.beats[0][0] <= self.time - self.window_s:
+            _, old_value, _ = self.beats.popleft()
+            self.sum_rr -= old_value
+            self.sum_rr2 -= old_value * old_value
+            if self.beats:
+                # the new first beat's difference pointed to the evicted beat
+                self.sum_diff2 -= self.beats[0][2]
+        return self.rmssd, self.sdnn
+
+    @property
+    def n_beats(self):
+        return len(self.beats)
+
+    @property
+    def rmssd(self):
+        n = len(self.beats)
+        return math.sqrt(max(self.sum_diff2, 0.0) / (n - 1)) if n > 1 else None
+
+    @property
+    def sdnn(self):
+        n = len(self.beats)
+        if n < 2:
+            return None
+        variance = (self.sum_rr2 - self.sum_rr * self.sum_rr / n) / (n - 1)
+        return math.sqrt(max(variance, 0.0))
+
+
+def rolling_hrv(rr, window_s, step_s=STEP_S):
+    """Rolling RMSSD / SDNN of one recording, sampled every step_s seconds from the first full window
+
+    Returns (t_s, n_beats, rmssd, sdnn) arrays; t_s is the window end in seconds since the first beat started.
+    """
+    rr = np.asarray(rr, dtype=np.float64)
+    if len(rr) < 2:
+        return np.empty(0), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+
+    beat_end = np.cumsum(rr) / 1000.0
+    t_s = np.arange(window_s, beat_end[-1] + 1e-9, step_s, dtype=np.float64)
+
+    # prefix sums around the first RR; prefix[i] = sum of the first i beats
+    value = rr - rr[0]
+    sum_rr = np.r_[0.0, np.cumsum(value)]
+    sum_rr2 = np.r_[0.0, np.cumsum(value * value)]
+    # sum_diff2[i] = squared differences between beats 0..i-1
+    sum_diff2 = np.r_[0.0, 0.0, np.cumsum(np.diff(rr) ** 2)]
+
+    # window = beats ending in (t - window_s, t]
+    lo = np.searchsorted(beat_end, t_s - window_s, side='right')
+    hi = np.searchsorted(beat_end, t_s, side='right')
+    n = hi - lo
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        total = sum_rr[hi] - sum_rr[lo]
+        variance = (sum_rr2[hi] - sum_rr2[lo] - total * total / n) / (n - 1)
+        sdnn = np.sqrt(np.clip(variance, 0, None))
+        rmssd = np.sqrt(np.clip(sum_diff2[hi] - sum_diff2[np.minimum(lo + 1, hi)], 0, None) / (n - 1))
+    sdnn[n < 2] = np.nan
+    rmssd[n < 2] = np.nan
+    return t_s, n, rmssd, sdnn
+
+
+def create_rolling_table(conn):
+    """Create the compact hrv_rolling table"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_rolling (
+            activity_id TEXT,
+            window_s INTEGER,
+            t_s INTEGER,
+            n_beats INTEGER,
+            rmssd REAL,
+            sdnn REAL,
+            PRIMARY KEY (activity_id, window_s, t_s)
+        ) WITHOUT ROWID
+    """)
+    conn.commit()
+
+
+def rolling_rows(activity_id, rr, windows=WINDOWS_S, step_s=STEP_S):
+    """hrv_rolling rows of one recording for every window length"""
+    rows = []
+    for window_s in windows:
+        t_s, n, rmssd, sdnn = rolling_hrv(rr, window_s, step_s)
+        for t, count, r, s in zip(t_s.tolist(), n.tolist(), rmssd.round(2).tolist(), sdnn.round(2).tolist()):
+            if count >= 2:
+                rows.append((activity_id, window_s, int(round(t)), count, r, s))
+    return rows
+
+
+def compute_rolling(db_path, records_table='hrv_records', column='hrv_btb', windows=WINDOWS_S, step_s=STEP_S,
+                    activity_ids=None):
+    """Compute and store the rolling series of every activity (or of activity_ids)"""
+    conn = sqlite3.connect(db_path)
+    try:
+        create_rolling_table(conn)
+        activities = 0
+        for batch_ids, rr, groups in iter_rr_batches(conn, records_table, column, activity_ids):
+            for activity_id, series in split_batch(batch_ids, rr, groups):
+                conn.execute("DELETE FROM hrv_rolling WHERE activity_id = ?", (activity_id,))
+                conn.executemany("INSERT INTO hrv_rolling VALUES (?, ?, ?, ?, ?, ?)",
+                                 rolling_rows(activity_id, series, windows, step_s))
+            conn.commit()
+            activities += len(batch_ids)
+            logger.info(f"Rolling HRV stored for {activities} activities")
+        return activities
+    finally:
+        conn.close()
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    activities = compute_rolling('e:/jheel_dev/DataBasesDev/artemis_hrv.db')
+    print(f"Rolling RMSSD/SDNN stored for {activities} activities")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+HRV spectral engine - VLF / LF / HF power from the stored beat-to-beat intervals.
+
+UnifiedHRVAnalysis and EnhancedHRVAnalysis read vlf, lf, hf, lf_nu and hf_nu from
+hrv_sessionsFBB, but the watch app only fills them in some versions. This engine
+computes them from the RR series in hrv_recordsFBB for every session:
+
+    1. the RR tachogram is resampled to an even 4 Hz grid (cubic spline)
+    2. Welch periodogram (scipy.signal.welch) - Hann-windowed, linearly detrended
+       300s segments with 50% overlap
+    3. the PSD (ms^2/Hz) is integrated over the bands
+         VLF 0.0033-0.04 Hz, LF 0.04-0.15 Hz, HF 0.15-0.4 Hz
+       LF and HF in normalized units are 100 * LF / (LF + HF) and 100 * HF / (LF + HF)
+
+Results are cached in the hrv_spectra table with the SHA-1 of each activity's RR
+series and the spectral settings, so a rerun only computes activities whose beats
+changed (hrv_cache.compute_changed spreads them over a process pool in chunks).
+The session columns are filled where the app left them empty (or always, with
+overwrite=True), so lf_hf_ratio and total_power exist for every session.
+"""
+
+import logging
+import os
+import sqlite3
+from datetime import datetime
+
+import numpy as np
+from scipy import signal
+from scipy.integrate import trapezoid
+from scipy.interpolate import CubicSpline
+
+from hrv_cache import compute_changed
+from hrv_metrics import iter_rr_batches, split_batch
+
+logger = logging.getLogger(__name__)
+
+RESAMPLE_HZ = 4.0
+SEGMENT_S = 300
+VLF_BAND = (0.0033, 0.04)
+LF_BAND = (0.04, 0.15)
+HF_BAND = (0.15, 0.4)
+
+# shortest recordings the bands are computed for - VLF needs a full 300s cycle
+MIN_DURATION_S = 120
+MIN_VLF_DURATION_S = 300
+
+SPECTRAL_COLUMNS = ('duration_s', 'vlf', 'lf', 'hf', 'lf_nu', 'hf_nu', 'lf_hf_ratio', 'total_power',
+                    'lf_peak', 'hf_peak')
+# hashed with every RR series - a change of settings recomputes the cached spectra
+SPECTRAL_SETTINGS = f'{RESAMPLE_HZ}|{SEGMENT_S}|{VLF_BAND}|{LF_BAND}|{HF_BAND}'
+
+
+def create_spectra_table(conn):
+    """Create the hrv_spectra table - band powers per activity and RR source, with the RR content hash"""
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS hrv_spectra (
+            activity_id TEXT,
+            source TEXT,
+            rr_hash TEXT,
+            duration_s REAL,
+            vlf REAL,
+            lf REAL,
+            hf REAL,
+            lf_nu REAL,
+            hf_nu REAL,
+            lf_hf_ratio REAL,
+            total_power REAL,
+            lf_peak REAL,
+            hf_peak REAL,
+            computed_at TEXT,
+            PRIMARY KEY (activity_id, source)
+        )
+    """)
+    conn.commit()
+
+
+def resample_rr(rr, fs=RESAMPLE_HZ):
+    """Evenly sampled tachogram (ms) of an RR series, at fs Hz"""
+    beat_time = np.cumsum(rr) / 1000.0
+    grid = np.arange(beat_time[0], beat_time[-1], 1.0 / fs)
+    return CubicSpline(beat_time, rr)(grid)
+
+
+def welch_psd(x, fs=RESAMPLE_HZ, segment_s=SEGMENT_S):
+    """One-sided Welch PSD of an evenly sampled signal - returns (freqs, psd in units^2/Hz)"""
+    nperseg = min(len(x), int(segment_s * fs))
+    return signal.welch(x, fs=fs, window='hann', nperseg=nperseg, noverlap=nperseg // 2, detrend='linear')
+
+
+def band_power(freqs, psd, band):
+    mask = (freqs >= band[0]) & (freqs < band[1])
+    if mask.sum() < 2:
+        return 0.0
+    return float(trapezoid(psd[mask], freqs[mask]))
+
+
+def band_peak(freqs, psd, band):
+    mask = (freqs >= band[0]) & (freqs < band[1])
+    if not mask.any():
+        return None
+    return float(freqs[mask][np.argmax(psd[mask])])
+
+
+def spectral_metrics(rr):
+    """Band powers of one RR series (ms) as a tuple in SPECTRAL_COLUMNS order; None where undefined"""
+    rr = np.asarray(rr, dtype=np.float64)
+    duration_s = float(rr.sum() / 1000.0)
+    if duration_s < MIN_DURATION_S or len(rr) < 3:
+        return (duration_s,) + (None,) * (len(SPECTRAL_COLUMNS) - 1)
+
+    freqs, psd = welch_psd(resample_rr(rr))
+    vlf = band_power(freqs, psd, VLF_BAND) if duration_s >= MIN_VLF_DURATION_S else None
+    lf = band_power(freqs, psd, LF_BAND)
+    hf = band_power(freqs, psd, HF_BAND)
+    lf_nu = 100 * lf / (lf + hf) if lf + hf > 0 else None
+    hf_nu = 100 * hf / (lf + hf) if lf + hf > 0 else None
+    lf_hf_ratio = lf / hf if hf > 0 else None
+    total_power = vlf + lf + hf if vlf is not None else None
+    return (duration_s, vlf, lf, hf, lf_nu, hf_nu, lf_hf_ratio, total_power,
+            band_peak(freqs, psd, LF_BAND), band_peak(freqs, psd, HF_BAND))
+
+
+def spectral_chunk(items):
+    """Process pool worker - [(activity_id, rr_hash, rr), ...] -> [(activity_id, rr_hash, *metrics), ...]"""
+    results = []
+    for activity_id, digest, rr in items:
+        try:
+            results.append((activity_id, digest) + spectral_metrics(rr))
+        except Exception as e:
+            logger.error(f"Error computing spectrum for {activity_id}: {e}")
+    return results
+
+
+def recompute_spectra(db_path, records_table='hrv_recordsFBB', sessions_table='hrv_sessionsFBB', column='hrv_btb',
+                      max_workers=None, chunk_size=25, overwrite=False):
+    """Compute the band powers of every changed activity and fill the session columns
+
+    Activities whose RR series hash matches hrv_spectra are not recomputed.
+    Returns the number of activities computed.
+    """
+    conn = sqlite3.connect(db_path)
+    try:
+        create_spectra_table(conn)
+        cached = dict(conn.execute("SELECT activity_id, rr_hash FROM hrv_spectra WHERE source = ?", (column,)))
+        computed_at = datetime.now().isoformat(timespec='seconds')
+        insert = f"""
+            INSERT OR REPLACE INTO hrv_spectra
+            (activity_id, rr_hash, {', '.join(SPECTRAL_COLUMNS)}, source, computed_at)
+            VALUES ({', '.join('?' * (len(SPECTRAL_COLUMNS) + 4))})
+        """
+
+        def write_rows(conn, rows):
+            conn.executemany(insert, [row + (column, computed_at) for row in rows])
+
+        batches = (split_batch(batch_ids, rr, groups)
+                   for batch_ids, rr, groups in iter_rr_batches(conn, records_table, column))
+        computed = compute_changed(conn, batches, SPECTRAL_SETTINGS, cached, spectral_chunk, write_rows,
+                                   max_workers, chunk_size, 'spectra')
+
+        fill_session_columns(conn, sessions_table, column, overwrite)
+        return computed
+    finally:
+        conn.close()
+
+
+def fill_session_columns(conn, sessions_table='hrv_sessionsFBB', source='hrv_btb', overwrite=False):
+    """Copy the band powers into the session table - only where the app left them empty unless overwrite"""
+    condition = "" if overwrite else f"""
+        AND {sessions_table}.vlf IS NULL AND {sessions_table}.lf IS NULL AND {sessions_table}.hf IS NULL"""
+    cursor = conn.execute(f"""
+        UPDATE {sessions_table}
+        SET vlf = s.vlf, lf = s.lf, hf = s.hf, lf_nu = s.lf_nu, hf_nu = s.hf_nu
+        FROM (SELECT activity_id, vlf, lf, hf, lf_nu, hf_nu FROM hrv_spectra WHERE source = ?) AS s
+        WHERE {sessions_table}.activity_id = s.activity_id {condition}
+    """, (source,))
+    conn.commit()
+    logger.info(f"Filled spectral columns of {cursor.rowcount} sessions in {sessions_table}")
+    return cursor.rowcount
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    db_path = 'e:/jheel_dev/DataBasesDev/artemis_hrv.db'
+    computed = recompute_spectra(db_path, max_workers=os.cpu_count())
+    print(f"Spectra computed for {computed} activities")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ Unified HRV Analysis System
 Combines analysis from multiple HRV data sources and provides enhanced analytics
 """
 
+import json
+import sys
 import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
@@ -13,6 +15,9 @@ from scipy import stats
 from sklearn.preprocessing import StandardScaler
 import logging
 from typing import Dict, List, Optional, Tuple
+from time_rolling import DailyRolling
+from hrv_entropy import compute_entropy, pending_activity_ids
+from hrv_baseline import update_baseline, readiness
 import warnings
 warnings.filterwarnings('ignore')
 
@@ -23,20 +28,59 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# rolling windows in calendar days - see time_rolling
+ROLLING_WINDOWS = [7, 14, 30]
+# metric -> prefix of its rolling average columns
+ROLLING_METRICS = {'hrv_rmssd': 'rmssd', 'lf_hf_ratio': 'lf_hf', 'total_power': 'total_power'}
+# z-score column -> standardized metric
+ZSCORE_METRICS = {'rmssd_zscore': 'hrv_rmssd', 'stress_index': 'lf_hf_ratio'}
+DERIVED_COLUMNS = (
+    ['sd2_sd1_ratio', 'lf_hf_ratio', 'total_power', 'normalized_rmssd', 'complexity_index']
+    + [f'{prefix}_{window}d_avg' for window in ROLLING_WINDOWS for prefix in ROLLING_METRICS.values()]
+    + list(ZSCORE_METRICS)
+)
+# session columns the derived metrics are computed from - hashed per stored row, so a session whose
+# inputs are filled in later (entropy, band powers) is derived again
+DERIVED_INPUTS = ['sd1', 'sd2', 'mean_rr', 'hrv_rmssd', 'vlf', 'lf', 'hf', 'sample_entropy']
+# the inputs of the rolling averages and z-scores - a change there invalidates the rolling state
+ROLLING_INPUTS = ['hrv_rmssd', 'vlf', 'lf', 'hf']
+# sample entropy scored as 100 in training readiness - resting RR series are about 1 to 2.5, so the
+# 0.3-weighted term stays in the range of the former log(sd1 * sd2) * 10 term (about 70 to 85)
+SAMPEN_FULL_SCORE = 2.5
+
+
+def input_hashes(frame: pd.DataFrame, columns: List[str]) -> pd.Series:
+    """Hex hash of each row's values of columns - NaN and NULL hash alike"""
+    return pd.util.hash_pandas_object(frame[columns].astype(float), index=False).map('{:016x}'.format)
+
 class UnifiedHRVAnalysis:
-    def __init__(self, db_path='e:/jheel_dev/DataBasesDev/artemis_hrv.db'):
+    def __init__(self, db_path='e:/jheel_dev/DataBasesDev/artemis_hrv.db', incremental=False):
+        # incremental=True reuses the stored derived metrics and only computes sessions added since the last run
         self.db_path = db_path
+        self.incremental = incremental
         self.hrv_data = None
+        self.activity_ids = None
         self.analysis_results = {}
         self.load_data()
         self.create_analysis_tables()
 
     def load_data(self) -> None:
-        """Load all HRV data from hrv_sessionsFBB table"""
+        """Load all HRV data from hrv_sessionsFBB table, with the sample / approximate entropy of each session"""
         try:
             conn = sqlite3.connect(self.db_path)
+            # entropy of the sessions not analysed yet (hrv_entropy.py) - cached per session
+            pending = pending_activity_ids(conn, 'hrv_sessionsFBB', 'hrv_btb')
+            if pending:
+                try:
+                    compute_entropy(self.db_path, 'hrv_recordsFBB', 'hrv_btb', activity_ids=pending)
+                except sqlite3.Error as e:
+                    logger.warning(f"Entropy not computed for {len(pending)} sessions: {e}")
+            # new nights into the lnRMSSD baseline (hrv_baseline.py)
+            update_baseline(self.db_path, 'hrv_sessionsFBB')
+            
             query = """
                 SELECT 
+                    s.activity_id,
                     date,
                     sd1,
                     sd2,
@@ -49,17 +93,27 @@ class UnifiedHRVAnalysis:
                     lf,
                     hf,
                     lf_nu,
-                    hf_nu
-                FROM hrv_sessionsFBB
+                    hf_nu,
+                    e.sampen AS sample_entropy,
+                    e.apen AS approximate_entropy
+                FROM hrv_sessionsFBB s
+                LEFT JOIN hrv_entropy e ON e.activity_id = s.activity_id AND e.source = 'hrv_btb'
                 ORDER BY date
             """
             self.hrv_data = pd.read_sql_query(query, conn)
+            # activity ids key the stored derived metrics - kept out of the numeric frame
+            self.activity_ids = self.hrv_data.pop('activity_id')
+            entropy_columns = ['sample_entropy', 'approximate_entropy']
+            self.hrv_data[entropy_columns] = self.hrv_data[entropy_columns].astype(float)
             
             # Convert date column to datetime
             self.hrv_data['date'] = pd.to_datetime(self.hrv_data['date'])
             
             # Calculate derived metrics
-            self.calculate_derived_metrics()
+            if self.incremental:
+                self.update_derived_metrics(conn)
+            else:
+                self.calculate_derived_metrics()
             
             logger.info(f"Loaded {len(self.hrv_data)} HRV records")
             
@@ -80,14 +134,15 @@ class UnifiedHRVAnalysis:
             # Advanced metrics
             self.hrv_data['total_power'] = self.hrv_data['vlf'] + self.hrv_data['lf'] + self.hrv_data['hf']
             self.hrv_data['normalized_rmssd'] = self.hrv_data['hrv_rmssd'] / self.hrv_data['mean_rr']
-            self.hrv_data['complexity_index'] = np.log(self.hrv_data['sd2'] * self.hrv_data['sd1'])
+            # sample entropy of the beat series - NaN for sessions without beat records
+            self.hrv_data['complexity_index'] = self.hrv_data['sample_entropy']
             
-            # Rolling calculations
-            windows = [7, 14, 30]
-            for window in windows:
-                self.hrv_data[f'rmssd_{window}d_avg'] = self.hrv_data['hrv_rmssd'].rolling(window).mean()
-                self.hrv_data[f'lf_hf_{window}d_avg'] = self.hrv_data['lf_hf_ratio'].rolling(window).mean()
-                self.hrv_data[f'total_power_{window}d_avg'] = self.hrv_data['total_power'].rolling(window).mean()
+            # Rolling calculations - calendar-day windows, all metrics from the same daily bins
+            rolling = DailyRolling(self.hrv_data['date'], self.hrv_data[list(ROLLING_METRICS)])
+            for window in ROLLING_WINDOWS:
+                averages = rolling.window(f'{window}D')
+                for metric, prefix in ROLLING_METRICS.items():
+                    self.hrv_data[f'{prefix}_{window}d_avg'] = averages[metric]
             
             # Standardized scores
             scaler = StandardScaler()
@@ -100,6 +155,172 @@ class UnifiedHRVAnalysis:
             logger.error(f"Error calculating derived metrics: {e}")
             raise
 
+    def _create_derived_tables(self, conn) -> None:
+        """Tables of the incremental mode - derived columns per session and the rolling / z-score state"""
+        columns = ',\n'.join(f'                {column} FLOAT' for column in DERIVED_COLUMNS)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS hrv_unified_derived (
+                activity_id TEXT PRIMARY KEY,
+                date DATE,
+{columns},
+                input_hash TEXT,
+                rolling_hash TEXT
+            )
+        """)
+        # tables of earlier versions have no input hashes - their rows count as changed
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(hrv_unified_derived)")}
+        for column in ('input_hash', 'rolling_hash'):
+            if column not in existing:
+                conn.execute(f"ALTER TABLE hrv_unified_derived ADD COLUMN {column} TEXT")
+        # one row per metric: streaming count / mean / sum of squared deviations for the
+        # z-scores, and the [date, value] pairs of the days the rolling windows still reach
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS hrv_unified_derived_state (
+                metric TEXT PRIMARY KEY,
+                count INTEGER,
+                mean FLOAT,
+                m2 FLOAT,
+                tail TEXT,
+                last_date TEXT
+            )
+        """)
+
+    def _store_derived_metrics(self, conn, rows: pd.DataFrame, state: Dict[str, dict], replace_all: bool) -> None:
+        """Write the derived columns of rows and the rolling / z-score state in one transaction"""
+        if replace_all:
+            conn.execute("DELETE FROM hrv_unified_derived")
+        columns = ['activity_id', 'date'] + DERIVED_COLUMNS + ['input_hash', 'rolling_hash']
+        frame = rows[DERIVED_COLUMNS].replace([np.inf, -np.inf], np.nan)
+        frame.insert(0, 'date', rows['date'].dt.strftime('%Y-%m-%d %H:%M:%S'))
+        frame.insert(0, 'activity_id', self.activity_ids.loc[rows.index].to_numpy())
+        frame['input_hash'] = input_hashes(rows, DERIVED_INPUTS)
+        frame['rolling_hash'] = input_hashes(rows, ROLLING_INPUTS)
+        conn.executemany(
+            f"INSERT OR REPLACE INTO hrv_unified_derived ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+            frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None))
+        conn.executemany(
+            "INSERT OR REPLACE INTO hrv_unified_derived_state VALUES (?, ?, ?, ?, ?, ?)",
+            [(metric, values['count'], values['mean'], values['m2'], json.dumps(values['tail']), values['last_date'])
+             for metric, values in state.items()])
+        conn.commit()
+
+    def _derived_state(self, previous: Optional[Dict[str, dict]] = None,
+                       new_rows: Optional[pd.DataFrame] = None) -> Dict[str, dict]:
+        """Rolling / z-score state after new_rows (all of hrv_data when there is no previous state)
+
+        The streaming mean and variance are merged per batch (Chan et al.), so a refresh
+        only touches the new values. Non-finite values are left out, as StandardScaler
+        leaves out NaN.
+        """
+        rows = self.hrv_data if new_rows is None else new_rows
+        last_date = self.hrv_data['date'].max()
+        # the longest window of a later session starts after this day
+        tail_start = (last_date.floor('D') - pd.Timedelta(days=max(ROLLING_WINDOWS) - 1)).strftime('%Y-%m-%d')
+        last_date = last_date.strftime('%Y-%m-%d %H:%M:%S')
+        row_dates = rows['date'].dt.strftime('%Y-%m-%d %H:%M:%S').tolist()
+        state = {}
+        for metric in set(ROLLING_METRICS) | set(ZSCORE_METRICS.values()):
+            values = rows[metric].astype(float).to_numpy()
+            finite = values[np.isfinite(values)]
+            count, mean, m2 = len(finite), (finite.mean() if len(finite) else 0.0), 0.0
+            if count:
+                m2 = float(((finite - mean) ** 2).sum())
+            tail = [[date, value] for date, value in zip(row_dates, values.tolist())]
+            if previous and metric in previous:
+                old = previous[metric]
+                total = old['count'] + count
+                if count:
+                    delta = mean - old['mean']
+                    mean = old['mean'] + delta * count / total
+                    m2 = old['m2'] + m2 + delta * delta * old['count'] * count / total
+                else:
+                    mean, m2 = old['mean'], old['m2']
+                count = total
+                tail = old['tail'] + tail
+            tail = [[date, None if v is None or v != v else v] for date, v in tail if date >= tail_start]
+            state[metric] = {'count': count, 'mean': float(mean), 'm2': float(m2), 'tail': tail,
+                             'last_date': last_date}
+        return state
+
+    def update_derived_metrics(self, conn) -> None:
+        """Incremental calculate_derived_metrics - only new sessions and sessions whose inputs changed are computed
+
+        The stored rows are read back as they are. New sessions get their ratios directly,
+        their rolling averages from the stored sessions of the last days and their z-scores from the
+        streaming mean / variance that include them; z-scores of earlier sessions stay as
+        they were stored. A stored session whose input hash changed (e.g. its entropy arrived
+        later) gets its ratios again. A session dated before the last processed one, or a stored
+        session whose rolling inputs changed, invalidates the rolling state, and everything is
+        recomputed once.
+        """
+        try:
+            self._create_derived_tables(conn)
+            stored = pd.read_sql_query("SELECT * FROM hrv_unified_derived", conn).drop(columns='date')
+            state = {row[0]: {'count': row[1], 'mean': row[2], 'm2': row[3], 'tail': json.loads(row[4]),
+                              'last_date': row[5]}
+                     for row in conn.execute("SELECT * FROM hrv_unified_derived_state")}
+
+            stored_rows = self.activity_ids.isin(stored['activity_id'])
+            new_rows = ~stored_rows
+            # stored derived columns and input hashes, in the order of hrv_data
+            stored = stored.set_index('activity_id').reindex(self.activity_ids)
+            changed = stored_rows & (stored['input_hash'].to_numpy()
+                                     != input_hashes(self.hrv_data, DERIVED_INPUTS).to_numpy())
+            rolling_changed = stored_rows & (stored['rolling_hash'].to_numpy()
+                                             != input_hashes(self.hrv_data, ROLLING_INPUTS).to_numpy())
+            last_date = pd.to_datetime(next(iter(state.values()))['last_date']) if state else None
+            # tails of plain values come from row-count windows and cannot be reused
+            dated_tails = all(isinstance(entry, list) for values in state.values() for entry in values['tail'])
+            if not state or not dated_tails or not stored_rows.any() or rolling_changed.any() or \
+                    (new_rows.any() and self.hrv_data.loc[new_rows, 'date'].min() < last_date):
+                logger.info("No usable derived state - computing derived metrics for all sessions")
+                self.calculate_derived_metrics()
+                self._store_derived_metrics(conn, self.hrv_data, self._derived_state(), replace_all=True)
+                return
+
+            for column in DERIVED_COLUMNS:
+                self.hrv_data[column] = stored[column].to_numpy(dtype=float)
+            derive = new_rows | changed
+            if not derive.any():
+                logger.info("Derived metrics up to date - no new or changed sessions")
+                return
+
+            rows = self.hrv_data.loc[derive]
+            self.hrv_data.loc[derive, 'sd2_sd1_ratio'] = rows['sd2'] / rows['sd1']
+            self.hrv_data.loc[derive, 'lf_hf_ratio'] = rows['lf'] / rows['hf']
+            self.hrv_data.loc[derive, 'total_power'] = rows['vlf'] + rows['lf'] + rows['hf']
+            self.hrv_data.loc[derive, 'normalized_rmssd'] = rows['hrv_rmssd'] / rows['mean_rr']
+            self.hrv_data.loc[derive, 'complexity_index'] = rows['sample_entropy']
+            if not new_rows.any():
+                self._store_derived_metrics(conn, self.hrv_data.loc[derive], state, replace_all=False)
+                logger.info(f"Calculated derived metrics for {int(changed.sum())} changed sessions")
+                return
+            new = self.hrv_data.loc[new_rows]
+
+            # rolling averages over the stored tail followed by the new values
+            for metric, prefix in ROLLING_METRICS.items():
+                tail = state[metric]['tail']
+                dates = pd.to_datetime([date for date, _ in tail]).append(pd.DatetimeIndex(new['date']))
+                series = pd.Series([value for _, value in tail] + new[metric].tolist(), dtype=float)
+                rolling = DailyRolling(dates, series)
+                for window in ROLLING_WINDOWS:
+                    self.hrv_data.loc[new_rows, f'{prefix}_{window}d_avg'] = \
+                        rolling.window(f'{window}D').iloc[-len(new):, 0].to_numpy()
+
+            state = self._derived_state(state, new)
+            for column, metric in ZSCORE_METRICS.items():
+                variance = state[metric]['m2'] / state[metric]['count'] if state[metric]['count'] else 0.0
+                # StandardScaler leaves constant features unscaled
+                scale = np.sqrt(variance) if variance > 0 else 1.0
+                self.hrv_data.loc[new_rows, column] = (new[metric] - state[metric]['mean']) / scale
+
+            self._store_derived_metrics(conn, self.hrv_data.loc[derive], state, replace_all=False)
+            logger.info(f"Calculated derived metrics for {int(new_rows.sum())} new and {int(changed.sum())} changed sessions")
+
+        except Exception as e:
+            logger.error(f"Error updating derived metrics: {e}")
+            raise
+
     def create_analysis_tables(self) -> None:
         """Create or update tables for enhanced analysis results"""
         try:
@@ -193,10 +414,13 @@ class UnifiedHRVAnalysis:
                 ).clip(0, 100)
                 
                 # Training Readiness Score
+                # sessions without beat records (no sample entropy) take the median complexity
+                complexity = self.hrv_data['complexity_index'].fillna(self.hrv_data['complexity_index'].median())
+                complexity_score = (complexity / SAMPEN_FULL_SCORE * 100).clip(0, 100)
                 metrics['training_readiness'] = (
                     (metrics['recovery_score'] * 0.4) +
                     ((100 - metrics['stress_index']) * 0.3) +
-                    (self.hrv_data['complexity_index'] * 10 * 0.3)
+                    (complexity_score * 0.3)
                 ).clip(0, 100)
                 
                 # Cardiovascular Health Score
@@ -228,20 +452,28 @@ class UnifiedHRVAnalysis:
             daily_avg = self.hrv_data.groupby(self.hrv_data['date'].dt.hour)['hrv_rmssd'].mean()
             patterns['circadian_consistency'] = 1 - daily_avg.std() / daily_avg.mean()
             
+            # 7-day windows of every metric below from one set of daily bins
+            weekly = DailyRolling(self.hrv_data['date'], pd.DataFrame({
+                'hrv_rmssd': self.hrv_data['hrv_rmssd'],
+                'recovery_change': self.hrv_data['recovery_score'].diff(),
+                'stress_index': self.hrv_data['stress_index'],
+                'recovery_score': self.hrv_data['recovery_score'],
+            }))
+            weekly_mean = weekly.window('7D', 'mean')
+            weekly_std = weekly.window('7D', 'std')
+            
             # Anomaly Detection
-            rolling_mean = self.hrv_data['hrv_rmssd'].rolling(window=7).mean()
-            rolling_std = self.hrv_data['hrv_rmssd'].rolling(window=7).std()
-            patterns['anomaly_scores'] = abs(self.hrv_data['hrv_rmssd'] - rolling_mean) / rolling_std
+            patterns['anomaly_scores'] = abs(self.hrv_data['hrv_rmssd'] - weekly_mean['hrv_rmssd']) / weekly_std['hrv_rmssd']
             
             # Recovery Pattern Analysis
             patterns['recovery_consistency'] = (
-                self.hrv_data['recovery_score'].diff().rolling(window=7).std() * -1 + 100
+                weekly_std['recovery_change'] * -1 + 100
             ).clip(0, 100)
             
             # Adaptation Capacity
             stress_recovery_ratio = (
-                self.hrv_data['stress_index'].rolling(window=7).mean() /
-                self.hrv_data['recovery_score'].rolling(window=7).mean()
+                weekly_mean['stress_index'] /
+                weekly_mean['recovery_score']
             )                                   
             patterns['adaptation_capacity'] = (1 - stress_recovery_ratio) * 100
             
@@ -289,6 +521,16 @@ class UnifiedHRVAnalysis:
             # Clean up temporary column
             self.hrv_data = self.hrv_data.drop('recovery_score', axis=1, errors='ignore')
             
+            # 7-day lnRMSSD baseline and 60-day normal range of the latest night, stored by hrv_baseline
+            conn = sqlite3.connect(self.db_path)
+            try:
+                baseline = readiness(conn, self.hrv_data['date'].max())
+            finally:
+                conn.close()
+            if baseline is not None:
+                for key in ('baseline_7d', 'cv_7d', 'normal_low', 'normal_high', 'status'):
+                    trends[f'ln_rmssd_{key}'] = baseline[key]
+            
             return trends
             
         except Exception as e:
@@ -308,24 +550,29 @@ class UnifiedHRVAnalysis:
             
             risk_scores = {}
             
+            # 30-day windows of every metric below from one set of daily bins
+            monthly = DailyRolling(self.hrv_data['date'], self.hrv_data[
+                ['hrv_rmssd', 'lf_hf_ratio', 'total_power', 'stress_index', 'recovery_score', 'sdnn']])
+            monthly_mean = monthly.window('30D', 'mean')
+            
             # Autonomic Dysfunction Risk
             risk_scores['autonomic_risk'] = (
-                (1 - self.hrv_data['hrv_rmssd'].rolling(30).mean() / 100) * 0.4 +
-                (self.hrv_data['lf_hf_ratio'].rolling(30).std() / 2) * 0.3 +
-                (1 - self.hrv_data['total_power'].rolling(30).mean() / 10000) * 0.3
+                (1 - monthly_mean['hrv_rmssd'] / 100) * 0.4 +
+                (monthly.window('30D', 'std')['lf_hf_ratio'] / 2) * 0.3 +
+                (1 - monthly_mean['total_power'] / 10000) * 0.3
             ) * 100
             
             # Stress Accumulation Risk
             risk_scores['stress_accumulation'] = (
-                self.hrv_data['stress_index'].rolling(30).mean() * 0.5 +
-                (1 - self.hrv_data['recovery_score'].rolling(30).mean() / 100) * 0.5
+                monthly_mean['stress_index'] * 0.5 +
+                (1 - monthly_mean['recovery_score'] / 100) * 0.5
             ) * 100
             
             # Cardiovascular Risk
             risk_scores['cardiovascular_risk'] = (
-                (1 - self.hrv_data['sdnn'].rolling(30).mean() / 100) * 0.4 +
-                (self.hrv_data['lf_hf_ratio'].rolling(30).mean() / 4) * 0.3 +
-                (1 - self.hrv_data['total_power'].rolling(30).mean() / 10000) * 0.3
+                (1 - monthly_mean['sdnn'] / 100) * 0.4 +
+                (monthly_mean['lf_hf_ratio'] / 4) * 0.3 +
+                (1 - monthly_mean['total_power'] / 10000) * 0.3
             ) * 100
             
             # Remove temporary columns
@@ -569,6 +816,9 @@ class UnifiedHRVAnalysis:
     - LF/HF Ratio Trend: {lf_hf_trend:.2f}
     - Recovery Score Trend: {recovery_trend:.2f}
 
+    lnRMSSD Baseline:
+    {self._format_baseline(trends)}
+
     Recommendations:
     {self._generate_recommendations()}
     """
@@ -579,6 +829,16 @@ class UnifiedHRVAnalysis:
             raise
         
         
+    def _format_baseline(self, trends: Dict[str, float]) -> str:
+        """7-day lnRMSSD baseline line of the summary report"""
+        if 'ln_rmssd_status' not in trends:
+            return "- No baseline available"
+        if trends['ln_rmssd_normal_low'] is None:
+            return f"- 7-Day Mean: {trends['ln_rmssd_baseline_7d']:.2f} ({trends['ln_rmssd_status']})"
+        return (f"- 7-Day Mean: {trends['ln_rmssd_baseline_7d']:.2f} "
+                f"(normal {trends['ln_rmssd_normal_low']:.2f}-{trends['ln_rmssd_normal_high']:.2f}, "
+                f"CV {trends['ln_rmssd_cv_7d'] or 0:.1f}%) - {trends['ln_rmssd_status']}")
+        
     def _generate_recommendations(self) -> str:
         """Generate personalized recommendations based on HRV analysis"""
         metrics = self.calculate_health_metrics()
@@ -602,7 +862,8 @@ def main():
     """Main execution function"""
     try:
         # Initialize the HRV analysis system
-        hrv_analyzer = UnifiedHRVAnalysis()
+        # derived metrics are refreshed for new sessions only; --full recomputes them for all sessions
+        hrv_analyzer = UnifiedHRVAnalysis(incremental='--full' not in sys.argv)
         logger.info("HRV Analysis System initialized successfully")
 
         # Store all analysis results
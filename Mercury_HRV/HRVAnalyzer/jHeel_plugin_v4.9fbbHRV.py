@@ -7,6 +7,8 @@ import os
 import logging
 import datetime
 from fbb_hrv_plugin import fbb_hrv
+from fit_cache import get_decoded_fit
+from fit_dispatcher import FitConsumer
 
 # Set up logging
 # Get the current date and time
@@ -22,94 +24,100 @@ logging.basicConfig(filename=f'e:/jHeel_Dev/gProjects/Artemis/Logs_Dev/Prod_jhee
 logging.info('Starting script...')
 print('Starting script...')
  
+# fbb_hrv rows - shared by execute_fbb_hrv_plugin and the single-pass dispatcher consumers
+# OR REPLACE: parsing a file again replaces its rows instead of failing on the primary keys
+hrv_records_insert_sql = '''
+    INSERT OR REPLACE INTO hrv_records (activity_id, record, timestamp, hrv_s, hrv_btb, hrv_hr, rrhr, rawHR, RRint, hrv, rmssd, sdnn, SaO2_C, trndG_hrv, rR, bb, stress, stress_hra, hrvrmssd30s)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?,?,?)
+'''
+
+hrv_sessions_insert_sql = '''
+    INSERT OR REPLACE INTO hrv_sessions (
+        activity_id, timestamp, sport, name, min_hr, hrv_rmssd, hrv_sdrr_f, 
+        hrv_sdrr_l, hrv_pnn50, hrv_pnn20, session_hrv, stress_hrpa, dBeats, sBeats, NN50, NN20, armssd, asdnn, SaO2, trnd_hrv, recovery, sdnn, sdsd, sd1, sd2, mean_rr, mean_hr, RMSSD, pNN50, PNN20, vlf, lf, hf,  lf_nu, hf_nu
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
+'''
+
+def hrv_record_row(activity_id, fields, record_num):
+    return (
+        activity_id,
+        record_num,
+        fields.get('timestamp'),
+        fields.get('hrv_s'),
+        fields.get('hrv_btb'),
+        fields.get('hrv_hr'),
+        fields.get('rrhr'),
+        fields.get('rawHR'),
+        fields.get('RRint'),
+        fields.get('hrv'),
+        fields.get('rmssd'),
+        fields.get('sdnn'),
+        fields.get('SaO2_C'),
+        fields.get('trndG_hrv'),
+        fields.get('rR'),
+        fields.get('bb'),
+        fields.get('stress'),
+        fields.get('stress_hra'),
+        fields.get('hrvrmssd30s')
+    )
+
+def hrv_session_row(activity_id, fields):
+    return (
+        activity_id,
+        fields.get('timestamp'),
+        fields.get('sport'),
+        fields.get('name'),
+        fields.get('min_hr'),
+        fields.get('hrv_rmssd'),
+        fields.get('hrv_sdrr_f'),
+        fields.get('hrv_sdrr_l'),
+        fields.get('hrv_pnn50'),
+        fields.get('hrv_pnn20'),
+        fields.get('session_hrv'),
+        fields.get('stress_hrpa'),
+        fields.get('dBeats'),
+        fields.get('sBeats'),
+        fields.get('NN50'),
+        fields.get('NN20'),
+        fields.get('armssd'),
+        fields.get('asdnn'),
+        fields.get('SaO2'),
+        fields.get('trnd_hrv'),
+        fields.get('recovery'),
+        fields.get('SDNN'),
+        fields.get('SDSD'),
+        fields.get('SD1'),
+        fields.get('SD2'),
+        fields.get('Mean RR'),
+        fields.get('Mean HR'),
+        fields.get('RMSSD'),
+        fields.get('pNN50'),
+        fields.get('PNN20'),
+        fields.get('VLF'),
+        fields.get('LF'),
+        fields.get('HF'),
+        fields.get('LFnu'),
+        fields.get('HFnu')
+    )
+
 def execute_fbb_hrv_plugin(fit_file_path, activity_id):
     try:
-        fit_file = FitFile(fit_file_path)
+        # decoded messages come from the shared FIT cache - decoded once for all parsers
+        decoded_fit = get_decoded_fit(fit_file_path)
         
         # Connect to database
         conn = sqlite3.connect('e:/jheel_dev/DataBasesDev/artemis_hrv.db')
         cursor = conn.cursor()
         
         # Process records
-        record_num = 0
-        for msg in fit_file.messages:
-            if msg.name == 'record':
-                fields = {field.name: field.value for field in msg.fields}
-                
-                cursor.execute('''
-                    INSERT INTO hrv_records (activity_id, record, timestamp, hrv_s, hrv_btb, hrv_hr, rrhr, rawHR, RRint, hrv, rmssd, sdnn, SaO2_C, trndG_hrv, rR, bb, stress, stress_hra, hrvrmssd30s)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?,?,?)
-                ''', (
-                    activity_id,
-                    record_num,
-                    fields.get('timestamp'),
-                    fields.get('hrv_s'),
-                    fields.get('hrv_btb'),
-                    fields.get('hrv_hr'),
-                    fields.get('rrhr'),
-                    fields.get('rawHR'),
-                    fields.get('RRint'),
-                    fields.get('hrv'),
-                    fields.get('rmssd'),
-                    fields.get('sdnn'),
-                    fields.get('SaO2_C'),
-                    fields.get('trndG_hrv'),
-                    fields.get('rR'),
-                    fields.get('bb'),
-                    fields.get('stress'),
-                    fields.get('stress_hra'),
-                    fields.get('hrvrmssd30s')
-                ))
-                record_num += 1
-            
-            # Process session data
-            elif msg.name == 'session':
-                fields = {field.name: field.value for field in msg.fields}
-                
-                cursor.execute('''
-                    INSERT INTO hrv_sessions (
-                        activity_id, timestamp, sport, name, min_hr, hrv_rmssd, hrv_sdrr_f, 
-                        hrv_sdrr_l, hrv_pnn50, hrv_pnn20, session_hrv, stress_hrpa, dBeats, sBeats, NN50, NN20, armssd, asdnn, SaO2, trnd_hrv, recovery, sdnn, sdsd, sd1, sd2, mean_rr, mean_hr, RMSSD, pNN50, PNN20, vlf, lf, hf,  lf_nu, hf_nu
-                    )
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?,?, ?, ?, ?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-                ''', (
-                    activity_id,
-                    fields.get('timestamp'),
-                    fields.get('sport'),
-                    fields.get('name'),
-                    fields.get('min_hr'),
-                    fields.get('hrv_rmssd'),
-                    fields.get('hrv_sdrr_f'),
-                    fields.get('hrv_sdrr_l'),
-                    fields.get('hrv_pnn50'),
-                    fields.get('hrv_pnn20'),
-                    fields.get('session_hrv'),
-                    fields.get('stress_hrpa'),
-                    fields.get('dBeats'),
-                    fields.get('sBeats'),
-                    fields.get('NN50'),
-                    fields.get('NN20'),
-                    fields.get('armssd'),
-                    fields.get('asdnn'),
-                    fields.get('SaO2'),
-                    fields.get('trnd_hrv'),
-                    fields.get('recovery'),
-                    fields.get('SDNN'),
-                    fields.get('SDSD'),
-                    fields.get('SD1'),
-                    fields.get('SD2'),
-                    fields.get('Mean RR'),
-                    fields.get('Mean HR'),
-                    fields.get('RMSSD'),
-                    fields.get('pNN50'),
-                    fields.get('PNN20'),
-                    fields.get('VLF'),
-                    fields.get('LF'),
-                    fields.get('HF'),
-                    fields.get('LFnu'),
-                    fields.get('HFnu')
-                ))
-        
+        cursor.executemany(hrv_records_insert_sql, [hrv_record_row(activity_id, fields, record_num)
+                                                    for record_num, fields in enumerate(decoded_fit.messages('record'))])
+
+        # Process session data
+        cursor.executemany(hrv_sessions_insert_sql, [hrv_session_row(activity_id, fields)
+                                                     for fields in decoded_fit.messages('session')])
+
         conn.commit()
         conn.close()
         
@@ -117,6 +125,36 @@ def execute_fbb_hrv_plugin(fit_file_path, activity_id):
     except Exception as e:
         logging.error(f'Error executing fbb_hrv plugin: {e}')
 
+# Batch writers for the dispatcher consumers
+
+def write_hrv_records(rows):
+    conn = sqlite3.connect('e:/jheel_dev/DataBasesDev/artemis_hrv.db')
+    try:
+        conn.executemany(hrv_records_insert_sql, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+def write_hrv_sessions(rows):
+    conn = sqlite3.connect('e:/jheel_dev/DataBasesDev/artemis_hrv.db')
+    try:
+        conn.executemany(hrv_sessions_insert_sql, rows)
+        conn.commit()
+    finally:
+        conn.close()
+
+# Consumers for fit_dispatcher - the fbb HRV record/session writer fed from a single decode per file
+
+def fit_consumers():
+    return [
+        FitConsumer('fbb_hrv_records', ('record',),
+                    lambda activity_id, fields, index: hrv_record_row(activity_id, fields, index),
+                    write_hrv_records),
+        FitConsumer('fbb_hrv_sessions', ('session',),
+                    lambda activity_id, fields, index: hrv_session_row(activity_id, fields),
+                    write_hrv_sessions),
+    ]
+
 def create_table_if_not_exists():
     conn = sqlite3.connect(r'e:/jheel_dev/DataBasesDev/artemis_hrv.db')
     cursor = conn.cursor()
@@ -149,6 +187,8 @@ def create_table_if_not_exists():
             rR INTEGER,
             bb INTEGER,
             stress INTEGER,
+            stress_hra INTEGER,
+            hrvrmssd30s INTEGER,
             PRIMARY KEY (activity_id, record)
         )
     ''')
@@ -239,81 +279,74 @@ def parse_fit_file(file_path, activity_id):
     # First execute the HRV plugin
     execute_fbb_hrv_plugin(file_path, activity_id)
     
-    # Then continue with existing processing
-    fit_file = FitFile(file_path)
-    messages = fit_file.messages
-    
+    # Then continue with existing processing - served from the FIT cache filled by the plugin above
     session_data = []
 
-    for msg in messages:
-
-            if msg.name == 'session':
-                fields = msg.fields
-                field_dict = {field.name: field.value for field in fields}
-                
-                timestamp = field_dict.get('timestamp')
-                activity_id = activity_id
-                stress_hrpa = field_dict.get('stress_hrpa')
-                HR_RS_Deviation_Index = field_dict.get('HR-RS Deviation Index')
-                hrv_sdrr_f = field_dict.get('hrv_sdrr_f')
-                hrv_pnn50 = field_dict.get('hrv_pnn50')
-                hrv_pnn20 = field_dict.get('hrv_pnn20')
-                rmssd = field_dict.get('RMSSD')
-                lnrmssd = field_dict.get('lnRMSSD')
-                sdnn = field_dict.get('SDNN')
-                sdsd = field_dict.get('SDSD')
-                nn50 = field_dict.get('NN50')
-                nn20 = field_dict.get('NN20')
-                pnn20 = field_dict.get('pNN20')
-                Long = field_dict.get('Long')
-                Short = field_dict.get('Short')
-                Ectopic_S = field_dict.get('Ectopic-S')
-                hrv_rmssd = field_dict.get('hrv_rmssd')
-                SD2 = field_dict.get('SD2')
-                SD1 = field_dict.get('SD1')
-                LF = field_dict.get('LF')
-                HF = field_dict.get('HF')
-                VLF = field_dict.get('VLF')
-                pNN50 = field_dict.get('pNN50')
-                LFnu = field_dict.get('LFnu')
-                HFnu = field_dict.get('HFnu')
-                MeanHR = field_dict.get('Mean HR')
-                MeanRR = field_dict.get('Mean RR')
-
-                
-                session_data.append({
-                    'activity_id': activity_id,
-                    'timestamp': timestamp, # '2021-09-01 12:00:00
-                    'stress_hrpa' : stress_hrpa,
-                    'HR-RS_Deviation Index' : HR_RS_Deviation_Index,
-                    'hrv_sdrr_f' : hrv_sdrr_f,
-                    'hrv_pnn50' : hrv_pnn50,
-                    'hrv_pnn20' : hrv_pnn20,
-                    'RMSSD' : rmssd,
-                    'lnRMSSD' : lnrmssd,
-                    'SDNN' : sdnn,
-                    'SDSD' : sdsd,
-                    'NN50' : nn50,
-                    'NN20' : nn20,
-                    'pnn20' : pnn20,
-                    'Long' : Long,
-                    'Short' : Short,
-                    'Ectopic_S' : Ectopic_S,
-                    'hrv_rmssd' : hrv_rmssd,
-                    'SD2' : SD2,
-                    'SD1' : SD1,
-                    'HF' : HF,
-                    'LF' : LF,
-                    'VLF' : VLF,
-                    'pNN50' : pNN50,
-                    'LFnu'  : LFnu,
-                    'HFnu' : HFnu,
-                    'MeanHR' : MeanHR,
-                    'MeanRR' : MeanRR
-
-                })
-                
-                logging.info(f'Parsed session data for activity ID {activity_id}.')
+    for field_dict in get_decoded_fit(file_path).messages('session'):
+
+        timestamp = field_dict.get('timestamp')
+        activity_id = activity_id
+        stress_hrpa = field_dict.get('stress_hrpa')
+        HR_RS_Deviation_Index = field_dict.get('HR-RS Deviation Index')
+        hrv_sdrr_f = field_dict.get('hrv_sdrr_f')
+        hrv_pnn50 = field_dict.get('hrv_pnn50')
+        hrv_pnn20 = field_dict.get('hrv_pnn20')
+        rmssd = field_dict.get('RMSSD')
+        lnrmssd = field_dict.get('lnRMSSD')
+        sdnn = field_dict.get('SDNN')
+        sdsd = field_dict.get('SDSD')
+        nn50 = field_dict.get('NN50')
+        nn20 = field_dict.get('NN20')
+        pnn20 = field_dict.get('pNN20')
+        Long = field_dict.get('Long')
+        Short = field_dict.get('Short')
+        Ectopic_S = field_dict.get('Ectopic-S')
+        hrv_rmssd = field_dict.get('hrv_rmssd')
+        SD2 = field_dict.get('SD2')
+        SD1 = field_dict.get('SD1')
+        LF = field_dict.get('LF')
+        HF = field_dict.get('HF')
+        VLF = field_dict.get('VLF')
+        pNN50 = field_dict.get('pNN50')
+        LFnu = field_dict.get('LFnu')
+        HFnu = field_dict.get('HFnu')
+        MeanHR = field_dict.get('Mean HR')
+        MeanRR = field_dict.get('Mean RR')
+
+
+        session_data.append({
+            'activity_id': activity_id,
+            'timestamp': timestamp, # '2021-09-01 12:00:00
+            'stress_hrpa' : stress_hrpa,
+            'HR-RS_Deviation Index' : HR_RS_Deviation_Index,
+            'hrv_sdrr_f' : hrv_sdrr_f,
+            'hrv_pnn50' : hrv_pnn50,
+            'hrv_pnn20' : hrv_pnn20,
+            'RMSSD' : rmssd,
+            'lnRMSSD' : lnrmssd,
+            'SDNN' : sdnn,
+            'SDSD' : sdsd,
+            'NN50' : nn50,
+            'NN20' : nn20,
+            'pnn20' : pnn20,
+            'Long' : Long,
+            'Short' : Short,
+            'Ectopic_S' : Ectopic_S,
+            'hrv_rmssd' : hrv_rmssd,
+            'SD2' : SD2,
+            'SD1' : SD1,
+            'HF' : HF,
+            'LF' : LF,
+            'VLF' : VLF,
+            'pNN50' : pNN50,
+            'LFnu'  : LFnu,
+            'HFnu' : HFnu,
+            'MeanHR' : MeanHR,
+            'MeanRR' : MeanRR
+
+        })
+
+        logging.info(f'Parsed session data for activity ID {activity_id}.')
 
     return session_data
 
@@ -367,15 +400,15 @@ def insert_data_into_db(data):
 # run the script as wanted - main function - jHeel artemis data
 if __name__ == "__main__":  
     create_table_if_not_exists()
-try:
-    all_session_data = parse_all_fit_files_in_folder('c:/users/stma/healthdata/fitfiles/activities2025')
-    # all_session_data = parse_all_fit_files_in_folder('c:/users/stma/healthdata/fitfiles/activities')
-    # insert_data_into_db(all_session_data)
-    logging.info('All data inserted successfully.')
-    print('All data inserted successfully (c)smacrico ')
-except Exception as e:
-    logging.error(f'Error processing data: {e}')
-    print(f'Error processing data: {e}')
+    try:
+        all_session_data = parse_all_fit_files_in_folder('c:/users/stma/healthdata/fitfiles/activities2025')
+        # all_session_data = parse_all_fit_files_in_folder('c:/users/stma/healthdata/fitfiles/activities')
+        # insert_data_into_db(all_session_data)
+        logging.info('All data inserted successfully.')
+        print('All data inserted successfully (c)smacrico ')
+    except Exception as e:
+        logging.error(f'Error processing data: {e}')
+        print(f'Error processing data: {e}')
 
 logging.info('Script completed successfully.')
 print('Script completed successfully.')
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+Time-based rolling windows over daily bins - shared by the HRV and running analyzers.
+
+pandas .rolling(7) counts rows: a night with two recordings or a week with missing
+days moves the window by a different number of days. DailyRolling windows are in
+calendar days ('7D', '30D', ...):
+
+    * the metrics are summed into one bin per calendar day (sum, count and sum of squares
+      of the non-NaN values of every metric) - once, with np.bincount
+    * cumulative sums over the days give every window of every metric by one subtraction,
+      so all window sizes and metrics come out of the same precomputed bins
+    * each row's window ends at the row itself: the full days before its day, plus the
+      recordings of its own day up to and including it (by time, then row order) - like
+      rolling('7D', closed='right'), a morning session never sees the afternoon's values
+
+Copies of this module live next to the scripts that use it (Mercury_HRV/HRVAnalyzer,
+Apex_RunAnalyzer/runAnalysis), like fbb_hrv_plugin.py.
+"""
+
+import numpy as np
+import pandas as pd
+
+STATS = ('mean', 'std', 'sum', 'count')
+
+
+def window_days(window):
+    """Number of days of a '7D'-style window (or a plain number of days)"""
+    if isinstance(window, (int, np.integer)):
+        return int(window)
+    delta = pd.Timedelta(window)
+    if delta.days < 1 or delta != pd.Timedelta(days=delta.days):
+        raise ValueError(f"Window {window} is not a whole number of days")
+    return delta.days
+
+
+class DailyRolling:
+    """Daily bins of a set of metrics - rolling mean / std / sum / count for any number of days"""
+
+    def __init__(self, dates, values, min_periods=1):
+        # dates and values are aligned row by row; results carry the index of values
+        if isinstance(values, pd.Series):
+            values = values.to_frame()
+        self.index = values.index
+        self.columns = list(values.columns)
+        self.min_periods = min_periods
+
+        times = pd.to_datetime(pd.Series(np.asarray(dates)))
+        days = times.dt.floor('D')
+        self.first_day = days.min()
+        self.row_day = (days - self.first_day).dt.days.to_numpy(dtype=np.int64)
+        n_days = int(self.row_day.max()) + 1 if len(self.row_day) else 0
+        n_metrics = len(self.columns)
+
+        x = values.to_numpy(dtype=np.float64, copy=True)
+        x[~np.isfinite(x)] = np.nan
+        valid = ~np.isnan(x)
+        # sums are taken around each metric's mean, which keeps the variance from cancelling
+        with np.errstate(invalid='ignore'):
+            self.shift = np.nan_to_num(np.nanmean(np.where(valid, x, np.nan), axis=0)) if len(x) else np.zeros(n_metrics)
+        deviation = np.where(valid, x - self.shift, 0.0)
+
+        flat = (self.row_day[:, None] * n_metrics + np.arange(n_metrics)).ravel()
+
+        def daily(weights):
+            bins = np.bincount(flat, weights=weights.ravel(), minlength=n_days * n_metrics)
+            # cumulative over the days, with a leading row of zeros
+            return np.vstack([np.zeros(n_metrics), np.cumsum(bins.reshape(n_days, n_metrics), axis=0)])
+
+        weights = (valid.astype(np.float64), deviation, deviation * deviation)
+        self.cum_count, self.cum_sum, self.cum_sum2 = (daily(w) for w in weights)
+
+        # running sums within each row's own day, up to and including the row
+        order = np.lexsort((np.arange(len(x)), times.to_numpy()))
+        day_start = np.r_[True, self.row_day[order][1:] != self.row_day[order][:-1]] if len(x) else np.zeros(0, bool)
+        self.same_day = []
+        for w in weights:
+            running = np.cumsum(w[order], axis=0)
+            # running total at the end of the previous day, repeated over each day's rows
+            before = np.where(day_start[:, None], running - w[order], np.nan)
+            before = pd.DataFrame(before).ffill().to_numpy()
+            prefix = np.empty_like(running)
+            prefix[order] = running - before
+            self.same_day.append(prefix)
+        self._cache = {}
+
+    def _window_sums(self, days):
+        if days not in self._cache:
+            hi = self.row_day
+            lo = np.maximum(hi + 1 - days, 0)
+            self._cache[days] = tuple(cum[hi] - cum[lo] + same_day for cum, same_day in
+                                      zip((self.cum_count, self.cum_sum, self.cum_sum2), self.same_day))
+        return self._cache[days]
+
+    def window(self, window, stat='mean'):
+        """One statistic of every metric over the window ending with each row's day - DataFrame like values"""
+        n, s1, s2 = self._window_sums(window_days(window))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            if stat == 'count':
+                result = n.copy()
+            elif stat == 'sum':
+                result = s1 + n * self.shift
+            elif stat == 'mean':
+                result = self.shift + s1 / n
+            elif stat == 'std':
+                result = np.sqrt(np.clip((s2 - s1 * s1 / n) / (n - 1), 0, None))
+                result[n < 2] = np.nan
+            else:
+                raise ValueError(f"Unknown statistic {stat} - expected one of {STATS}")
+        if stat != 'count':
+            result[n < max(self.min_periods, 1)] = np.nan
+        return pd.DataFrame(result, index=self.index, columns=self.columns)
+
+    def frame(self, windows, stats=('mean',)):
+        """Every statistic of every metric for every window - columns named '<metric>_<window>_<stat>'"""
+        parts = {}
+        for window in windows:
+            for stat in stats:
+                for column, values in self.window(window, stat).items():
+                    parts[f'{column}_{window}_{stat}'] = values
+        return pd.DataFrame(parts, index=self.index)
+
+
+def time_rolling(dates, values, windows=('7D',), stats=('mean',), min_periods=1):
+    """All windows and statistics of values (DataFrame or Series) in one pass over daily bins"""
+    return DailyRolling(dates, values, min_periods).frame(windows, stats)
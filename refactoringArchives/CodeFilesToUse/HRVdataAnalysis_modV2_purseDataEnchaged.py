@@ -5,36 +5,67 @@ from sklearn.preprocessing import StandardScaler
 import seaborn as sns
 from scipy.stats import pearsonr
 import calendar
+from analysis_cache import AnalysisCache, data_version
+
+# resample rules of the weekly / monthly frames
+WEEKLY_RULE = 'W'
+MONTHLY_RULE = 'ME'
 
 class AdvancedHRVAnalysis(EnhancedHRVAnalysis):
     def __init__(self):
         super().__init__()
+        # intermediate frames shared by the plots and the report, per data version (analysis_cache.py)
+        self.cache = AnalysisCache(self.db_path)
         
     def calculate_statistics(self):
         """Calculate advanced statistical metrics"""
         stats_dict = {
-            'Weekly Stats': self.hrv_log.resample('W', on='date').agg({
-                'sdnn': ['mean', 'std', 'min', 'max'],
-                'rmssd': ['mean', 'std', 'min', 'max'],
-                'lf_hf_ratio': ['mean', 'std']
-            }),
-            'Monthly Trends': self.hrv_log.resample('M', on='date').mean(),
+            'Weekly Stats': self.calculate_weekly_stats(),
+            'Monthly Trends': self.calculate_monthly_trends(),
             'Correlations': self.calculate_correlations(),
             'Variability Index': self.calculate_variability_index()
         }
         return stats_dict
     
+    def calculate_weekly_stats(self):
+        """Weekly aggregates of the key metrics - only the newest weeks are recomputed"""
+        return self.cache.resampled('weekly_stats', self.hrv_log, WEEKLY_RULE, lambda weeks: weeks.agg({
+            'sdnn': ['mean', 'std', 'min', 'max'],
+            'rmssd': ['mean', 'std', 'min', 'max'],
+            'lf_hf_ratio': ['mean', 'std']
+        }))
+    
+    def calculate_monthly_trends(self):
+        """Monthly means of all metrics - only the newest months are recomputed"""
+        return self.cache.resampled('monthly_trends', self.hrv_log, MONTHLY_RULE, lambda months: months.mean())
+    
     def calculate_correlations(self):
         """Calculate correlations between different HRV metrics"""
         correlation_metrics = ['sdnn', 'rmssd', 'lf_hf_ratio', 'mean_hr']
-        corr_matrix = self.hrv_log[correlation_metrics].corr()
-        return corr_matrix
+        return self.cache.get('correlations', data_version(self.hrv_log),
+                              lambda: self.hrv_log[correlation_metrics].corr())
     
     def calculate_variability_index(self):
         """Calculate custom variability index"""
-        scaled_data = StandardScaler().fit_transform(
-            self.hrv_log[['sdnn', 'rmssd', 'lf_hf_ratio']])
-        return np.mean(scaled_data, axis=1)
+        def compute():
+            scaled_data = StandardScaler().fit_transform(
+                self.hrv_log[['sdnn', 'rmssd', 'lf_hf_ratio']])
+            return pd.DataFrame({'variability_index': np.mean(scaled_data, axis=1)})
+        
+        return self.cache.get('variability_index', data_version(self.hrv_log), compute)['variability_index'].values
+    
+    def calculate_decomposition(self):
+        """Seasonal decomposition (weekly period) of SDNN"""
+        def compute():
+            decomposition = seasonal_decompose(
+                self.hrv_log['sdnn'].values, 
+                period=7,  # Weekly seasonality
+                extrapolate_trend='freq'
+            )
+            return pd.DataFrame({'trend': decomposition.trend, 'seasonal': decomposition.seasonal,
+                                 'resid': decomposition.resid})
+        
+        return self.cache.get('sdnn_decomposition', data_version(self.hrv_log), compute)
 
     def visualize_advanced_metrics(self):
         """Generate advanced visualization plots"""
@@ -78,15 +109,11 @@ class AdvancedHRVAnalysis(EnhancedHRVAnalysis):
 
     def _plot_time_series_decomposition(self, ax):
         """Plot time series decomposition of HRV metrics"""
-        decomposition = seasonal_decompose(
-            self.hrv_log['sdnn'].values, 
-            period=7,  # Weekly seasonality
-            extrapolate_trend='freq'
-        )
-        
-        ax.plot(decomposition.trend, label='Trend')
-        ax.plot(decomposition.seasonal, label='Seasonal')
-        ax.plot(decomposition.resid, label='Residual')
+        decomposition = self.calculate_decomposition()
+        
+        ax.plot(decomposition['trend'].values, label='Trend')
+        ax.plot(decomposition['seasonal'].values, label='Seasonal')
+        ax.plot(decomposition['resid'].values, label='Residual')
         ax.set_title('HRV Time Series Decomposition')
         ax.legend()
 
@@ -150,7 +177,7 @@ class AdvancedHRVAnalysis(EnhancedHRVAnalysis):
 
     def _plot_long_term_trends(self, ax):
         """Plot long-term HRV trends"""
-        monthly_trend = self.hrv_log.resample('M', on='date').mean()
+        monthly_trend = self.calculate_monthly_trends()
         ax.plot(monthly_trend.index, monthly_trend['sdnn'], 'o-')
         ax.set_title('Monthly HRV Trend')
         ax.set_ylabel('SDNN (ms)')
@@ -0,0 +1,191 @@
+"""Disk cache of the intermediate frames of the HRV analysis, keyed by data version.
+
+AdvancedHRVAnalysis builds the same frames for every plot and report - the weekly
+and monthly resamples, the correlation matrix, the variability index and the
+seasonal decomposition.  ``AnalysisCache`` computes each frame once per version of
+the data, where the version is the row count plus the latest date: a run on
+unchanged data loads every frame from disk.
+
+Each entry is a directory of ``.npy`` files - the values as one float64 matrix,
+the index, and a small JSON file with the column names - so entries are opened
+with ``np.load(mmap_mode='r')`` and the frames are read-only views of the file
+instead of copies.
+
+For resamples on calendar rules ('W', 'M', 'D', ...) a new version does not redo
+the whole history: when the new data only appends rows after the previous latest
+date, the completed periods of the previous entry are reused and only the newest
+period onward is aggregated again.
+
+The cache directory defaults to ``~/.jheel/analysis_cache`` and can be moved with
+the ``JHEEL_ANALYSIS_CACHE`` environment variable. Entries of each data source (the
+database path) are kept in their own subdirectory, so two databases that happen to
+have the same row count and latest date never share frames.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+logger = logging.getLogger(__name__)
+
+
+CACHE_VERSION = 1
+DEFAULT_CACHE_DIR = os.environ.get('JHEEL_ANALYSIS_CACHE',
+                                   os.path.join(os.path.expanduser('~'), '.jheel', 'analysis_cache'))
+
+
+def data_version(data, date_column='date'):
+    """(row count, latest date) of the analysed data - the cache key of every frame built from it."""
+    max_date = data[date_column].max() if len(data) else None
+    return len(data), (None if pd.isnull(max_date) else pd.Timestamp(max_date))
+
+
+def _version_key(version):
+    rows, max_date = version
+    stamp = 'none' if max_date is None else max_date.strftime('%Y%m%dT%H%M%S%f')
+    return f'{rows}_{stamp}.v{CACHE_VERSION}'
+
+
+def save_frame(path, frame):
+    """Store a numeric DataFrame as an entry directory (written aside, then moved into place)."""
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+
+    if isinstance(frame.index, pd.DatetimeIndex):
+        index, index_kind = frame.index.to_numpy(), 'datetime'
+    else:
+        index, index_kind = np.array([str(label) for label in frame.index], dtype=str), 'str'
+    columns = [list(column) if isinstance(column, tuple) else column for column in frame.columns]
+    meta = {
+        'columns': columns,
+        'multi_columns': isinstance(frame.columns, pd.MultiIndex),
+        'index_kind': index_kind,
+        'index_name': frame.index.name,
+    }
+
+    np.save(os.path.join(tmp_path, 'values.npy'), frame.to_numpy(dtype=np.float64, na_value=np.nan))
+    np.save(os.path.join(tmp_path, 'index.npy'), index)
+    with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # another run stored the same version first
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def load_frame(path):
+    """Open an entry directory as a read-only, memory-mapped DataFrame."""
+    with open(os.path.join(path, 'meta.json')) as f:
+        meta = json.load(f)
+    values = np.load(os.path.join(path, 'values.npy'), mmap_mode='r')
+    index = np.load(os.path.join(path, 'index.npy'))
+    if meta['multi_columns']:
+        columns = pd.MultiIndex.from_tuples([tuple(column) for column in meta['columns']])
+    else:
+        columns = pd.Index(meta['columns'])
+    index = pd.DatetimeIndex(index) if meta['index_kind'] == 'datetime' else pd.Index(index.tolist())
+    index.name = meta['index_name']
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+class AnalysisCache:
+    """Compute each analysis frame once per data version; serve every later request from disk."""
+
+    def __init__(self, source, cache_dir=None):
+        # source is the database path the frames are built from - it names the subdirectory of its entries
+        source_key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_dir or DEFAULT_CACHE_DIR, source_key)
+        self.hits = 0
+        self.misses = 0
+
+    def entry_path(self, name, version):
+        return os.path.join(self.cache_dir, name, _version_key(version))
+
+    def _latest(self, name):
+        """(version, path) of the entry last stored for name, or None"""
+        try:
+            with open(os.path.join(self.cache_dir, name, 'latest.json')) as f:
+                latest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        max_date = None if latest['max_date'] is None else pd.Timestamp(latest['max_date'])
+        version = (latest['rows'], max_date)
+        return version, self.entry_path(name, version)
+
+    def _store(self, name, version, frame):
+        path = self.entry_path(name, version)
+        previous = self._latest(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_frame(path, frame)
+
+        rows, max_date = version
+        latest_path = os.path.join(self.cache_dir, name, 'latest.json')
+        with open(f'{latest_path}.{os.getpid()}.tmp', 'w') as f:
+            json.dump({'rows': rows, 'max_date': None if max_date is None else max_date.isoformat()}, f)
+        os.replace(f'{latest_path}.{os.getpid()}.tmp', latest_path)
+
+        # only the newest version of every frame is kept
+        if previous is not None and previous[1] != path:
+            shutil.rmtree(previous[1], ignore_errors=True)
+        return load_frame(path)
+
+    def get(self, name, version, compute):
+        """The frame stored for (name, version); compute() builds and stores it on a miss."""
+        path = self.entry_path(name, version)
+        if os.path.isdir(path):
+            try:
+                frame = load_frame(path)
+                self.hits += 1
+                return frame
+            except (OSError, ValueError, KeyError) as e:
+                logger.warning("Discarding unreadable cache entry %s: %s", path, e)
+                shutil.rmtree(path, ignore_errors=True)
+
+        self.misses += 1
+        frame = compute()
+        if isinstance(frame, pd.Series):
+            frame = frame.to_frame()
+        return self._store(name, version, frame)
+
+    def resampled(self, name, data, rule, aggregate, date_column='date'):
+        """aggregate(data.resample(rule, on=date_column)) for the current data version
+
+        When the data only gained rows after the previous version's latest date, the
+        previous entry's periods before its last one are reused and aggregate() runs on
+        the rows from that last period onward.
+        """
+        version = data_version(data, date_column)
+
+        def compute():
+            previous = self._latest(name)
+            if previous is None or previous[0][1] is None or version[1] is None \
+                    or isinstance(pd.tseries.frequencies.to_offset(rule), pd.offsets.Tick):
+                return aggregate(data.resample(rule, on=date_column))
+
+            (previous_rows, previous_max), previous_path = previous
+            dates = data[date_column]
+            try:
+                kept = load_frame(previous_path).iloc[:-1]
+            except (OSError, ValueError, KeyError):
+                kept = None
+            # append-only: exactly the previous rows are on or before the previous latest date
+            if kept is None or kept.empty or (dates <= previous_max).sum() != previous_rows:
+                return aggregate(data.resample(rule, on=date_column))
+
+            # calendar periods end with their label's day - later days belong to later periods
+            last_kept = kept.index[-1]
+            newest = aggregate(data[dates.dt.normalize() > last_kept.normalize()].resample(rule, on=date_column))
+            if newest.empty or newest.index[0] <= last_kept:
+                return aggregate(data.resample(rule, on=date_column))
+            logger.debug("Reusing %d periods of %s", len(kept), name)
+            return pd.concat([kept, newest.astype(np.float64)])
+
+        return self.get(name, version, compute)
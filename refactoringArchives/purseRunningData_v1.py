@@ -7,6 +7,9 @@ import os
 import logging
 import datetime
 from fitparse import FitFile
+from fit_session_reader import read_sessions
+from fit_cache import get_decoded_fit
+from fit_dispatcher import FitConsumer
 
 # Set up logging
 now = datetime.datetime.now()
@@ -61,30 +64,11 @@ def create_table_if_not_exists():
     conn.close()
 
 def parse_fit_file(file_path, activity_id):
-    fit_file = FitFile(file_path)
-    messages = fit_file.messages
+    # decoded messages come from the shared FIT cache - decoded once for all parsers
     session_data = []
 
-    for msg in messages:
-        if msg.name == 'session':
-            fields = msg.fields
-            field_dict = {field.name: field.value for field in fields}
-            
-            # Create session data with proper field name handling and default None values
-            session = {
-                'activity_id': activity_id,
-                'timestamp': field_dict.get('timestamp', None),
-                'distance': field_dict.get('total_distance', None),
-                'VO2maxSmooth': field_dict.get('VO2maxSmooth', None),
-                'VO2maxSession': field_dict.get('VO2maxSession', None),
-                'RunningEconomy': field_dict.get('Running Economy', None),
-                'HeartRateAvg': field_dict.get('avg_heart_rate', None)
-            }
-
-            # Log available fields for debugging
-            logging.debug(f"Available fields in session message: {list(field_dict.keys())}")
-            
-            session_data.append(session)
+    for field_dict in get_decoded_fit(file_path).messages('session'):
+        session_data.append(build_session(field_dict, activity_id))
 
     # Add debug logging for the first session
     if session_data:
@@ -96,6 +80,33 @@ def parse_fit_file(file_path, activity_id):
     return session_data
 
 
+def parse_fit_file_sessions_only(file_path, activity_id):
+    """Fast path - decode only the session messages, record payloads are skipped by length"""
+    session_data = [build_session(field_dict, activity_id) for field_dict in read_sessions(file_path)]
+
+    logging.info(f'Parsed session data for activity ID {activity_id}.')
+
+    return session_data
+
+
+def build_session(field_dict, activity_id):
+    """Map the {field name: value} dict of one session message to a RunAnal row"""
+    # Create session data with proper field name handling and default None values
+    session = {
+        'activity_id': activity_id,
+        'timestamp': field_dict.get('timestamp', None),
+        'distance': field_dict.get('total_distance', None),
+        'VO2maxSmooth': field_dict.get('VO2maxSmooth', None),
+        'VO2maxSession': field_dict.get('VO2maxSession', None),
+        'RunningEconomy': field_dict.get('Running Economy', None),
+        'HeartRateAvg': field_dict.get('avg_heart_rate', None)
+    }
+
+    # Log available fields for debugging
+    logging.debug(f"Available fields in session message: {list(field_dict.keys())}")
+
+    return session
+
 
 def insert_data_into_db(data):
     conn = sqlite3.connect('e:/jheel_dev/dev_learn/dbs/running_analysis.db')
@@ -140,6 +151,15 @@ def insert_data_into_db(data):
     finally:
         conn.close()
     
+# Consumer for fit_dispatcher - RunAnal sessions from the single decode per file
+def fit_consumers():
+    return [
+        FitConsumer('RunAnal', ('session',),
+                    lambda activity_id, fields, index: build_session(fields, activity_id),
+                    insert_data_into_db,
+                    setup=create_table_if_not_exists),
+    ]
+
 def parse_all_fit_files_in_folder(folder_path):
     all_session_data = []
     